@@ -1,15 +1,42 @@
-from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for
+from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for, Response, stream_with_context, after_this_request
 from flask_pymongo import PyMongo
 from bson.objectid import ObjectId
+from pymongo import UpdateOne, ReplaceOne, ReturnDocument, monitoring
+from pymongo.errors import DuplicateKeyError
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+import click
 from email.message import EmailMessage
 import smtplib
 import ssl
 import os
-import pandas as pd
 import io
+import tempfile
+import shutil
+import json
+import csv
+import itertools
+import hashlib
+import time
+import threading
+import queue
+import multiprocessing
+import zipfile
+import re
+import sys
+import bisect
+import socket
+import cProfile
+from urllib.parse import parse_qs, unquote
+from functools import lru_cache
+from collections import deque
+from xml.sax.saxutils import escape as xml_escape
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.test import EnvironBuilder
+from werkzeug.exceptions import HTTPException
+from werkzeug.middleware.proxy_fix import ProxyFix
 from dotenv import load_dotenv 
 
 load_dotenv()
@@ -17,6 +44,14 @@ load_dotenv()
 app = Flask(__name__)
 
 # --- CONFIGURATION ---
+# Number of reverse proxies in front of the app whose X-Forwarded-For entry is
+# trusted for request.remote_addr. Only the Vercel deployment (VERCEL is set by the
+# platform) has one by default; behind nginx set TRUSTED_PROXIES=1. With no proxy
+# clients could rotate the header to escape the IP rate limits.
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", "1" if os.environ.get("VERCEL") else "0"))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
 mongo_uri = os.environ.get("MONGO_URI")
 if not mongo_uri:
     raise ValueError("MONGO_URI environment variable is required")
@@ -29,18 +64,39 @@ app.config["SECRET_KEY"] = secret_key
 app.config["GMAIL_USER"] = os.environ.get("GMAIL_USER")
 app.config["GMAIL_APP_PASSWORD"] = os.environ.get("GMAIL_APP_PASSWORD")
 app.config["PASSWORD_RESET_EXPIRY_MINUTES"] = int(os.environ.get("PASSWORD_RESET_EXPIRY_MINUTES", "30"))
+# Outgoing mail server; point at a local sink (e.g. aiosmtpd on port 8025, SMTP_USE_SSL=0) for testing
+app.config["SMTP_HOST"] = os.environ.get("SMTP_HOST", "smtp.gmail.com")
+app.config["SMTP_PORT"] = int(os.environ.get("SMTP_PORT", "465"))
+app.config["SMTP_USE_SSL"] = os.environ.get("SMTP_USE_SSL", "1") not in ("0", "false", "False")
+
+# Under gunicorn --preload (see gunicorn_conf.py) this module is imported once in
+# the master and then forked. A MongoClient and background threads must not cross
+# a fork, so in that mode init_worker() runs in each worker from post_fork instead
+# of at import time.
+DEFER_WORKER_INIT = os.environ.get("PRO_DEFER_WORKER_INIT") == "1"
+
+# Serverless hosts (the vercel.json deployment) freeze background threads once a
+# response is sent and do not share the local disk between instances.
+SERVERLESS = bool(os.environ.get("VERCEL") or os.environ.get("AWS_LAMBDA_FUNCTION_NAME"))
+
+mongo = PyMongo()
 
-try:
-    mongo = PyMongo(app)
-except Exception as e:
-    print(f"Error initializing MongoDB: {e}")
-    mongo = None
+# PyMongo command listeners added by the profiling/tracing sections; the client
+# is created in init_db_client, after the whole module has loaded.
+MONGO_EVENT_LISTENERS = []
+
+
+def init_db_client():
+    try:
+        mongo.init_app(app, event_listeners=MONGO_EVENT_LISTENERS)
+    except Exception as e:
+        print(f"Error initializing MongoDB: {e}")
 
 serializer = URLSafeTimedSerializer(app.config["SECRET_KEY"])
 
 # --- HELPER: DATABASE CHECK & INITIAL SETUP ---
 def check_db():
-    if mongo is None or mongo.db is None:
+    if mongo.db is None:
         print("Database connection failed or not initialized.")
         return False
     return True
@@ -62,6 +118,27 @@ def clean_input_data(data):
             cleaned[key] = value
     return cleaned
 
+def bump_data_version(*collections):
+    """Increment the change counter of each collection (used to key cached artifacts)."""
+    for name in collections:
+        mongo.db.data_versions.update_one({'_id': name}, {'$inc': {'version': 1}}, upsert=True)
+
+def get_data_version(collections):
+    """Return a stamp like 'patients:12|expenses:40' for the given collections."""
+    return format_data_version(mongo.db.data_versions.find({'_id': {'$in': list(collections)}}), collections)
+
+def format_data_version(version_docs, collections):
+    versions = {d['_id']: d.get('version', 0) for d in version_docs}
+    return '|'.join(f"{name}:{versions.get(name, 0)}" for name in sorted(collections))
+
+def record_tombstone(collection, doc_id):
+    """Remember a hard delete so /api/sync can tell clients to drop the row."""
+    mongo.db.tombstones.insert_one({
+        'collection': collection,
+        'doc_id': str(doc_id),
+        'deleted_at': datetime.now()
+    })
+
 def ensure_initial_admin():
     """Checks for and creates the default admin user 'ImranSaab' on first run."""
     if check_db():
@@ -78,17 +155,395 @@ def ensure_initial_admin():
             mongo.db.users.insert_one(admin_user)
             print("Initial Admin user 'ImranSaab' created.")
 
-# Run initial setup outside of request context
-with app.app_context():
-    ensure_initial_admin()
+def ensure_indexes():
+    """Create the indexes the app relies on. Failures are logged, not fatal."""
+    if not check_db():
+        return
+    try:
+        mongo.db.overheads.create_index(
+            [('year', 1), ('month', 1), ('date', 1)],
+            unique=True,
+            name='overheads_year_month_date'
+        )
+        for name in SYNC_COLLECTIONS:
+            mongo.db[name].create_index('updated_at')
+        ensure_canteen_storage()
+        mongo.db.tombstones.create_index(
+            'deleted_at',
+            expireAfterSeconds=SYNC_TOMBSTONE_RETENTION_DAYS * 86400
+        )
+        mongo.db.email_outbox.create_index([('status', 1), ('next_attempt_at', 1)])
+        mongo.db.email_outbox.create_index('sent_at', expireAfterSeconds=EMAIL_RETENTION_DAYS * 86400)
+        mongo.db.email_outbox.create_index('expires_at', expireAfterSeconds=0)
+        mongo.db.rate_limits.create_index('expires_at', expireAfterSeconds=0)
+        mongo.db.report_flights.create_index('expires_at', expireAfterSeconds=0)
+        mongo.db.patients_archive.create_index('name')
+        mongo.db.patients_archive.create_index('dischargeDate')
+        mongo.db.canteen_sales_archive.create_index('patient_id')
+        mongo.db.canteen_archive_daily.create_index('date')
+        mongo.db.month_snapshots.create_index([('year', 1), ('month', 1), ('report', 1)])
+        mongo.db.month_adjustments.create_index([('year', 1), ('month', 1)])
+        mongo.db.job_runs.create_index([('job', 1), ('started_at', -1)])
+        mongo.db.job_runs.create_index('finished_at', expireAfterSeconds=JOB_RUN_RETENTION_DAYS * 86400)
+    except Exception as e:
+        print(f"Index setup error: {e}")
+
+
+
+# --- REQUEST TRACING ---
+#
+# With TRACE_EXPORTER=jsonl or TRACE_EXPORTER=otlp, every request becomes a root
+# span, every PyMongo command it issues a child span, and the export phases
+# (row writing, workbook save, bill rendering) are wrapped in trace_span(). An
+# incoming W3C traceparent header is continued, and the trace id is returned
+# in X-Trace-Id and prefixed to anything printed while the request runs, so the
+# existing error prints can be matched to their trace.
+#
+# Spans are batched by a background thread and written as OTLP/JSON: one
+# ExportTraceServiceRequest per line in TRACE_FILE, or POSTed to an OTLP/HTTP
+# collector at OTEL_EXPORTER_OTLP_TRACES_ENDPOINT. Both can be read by the
+# OpenTelemetry collector (the file through its otlpjsonfile receiver).
+
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', '').lower()
+TRACING = TRACE_EXPORTER in ('jsonl', 'otlp')
+TRACE_FILE = os.environ.get('TRACE_FILE', os.path.join(tempfile.gettempdir(), 'pro_crm_traces.jsonl'))
+TRACE_OTLP_ENDPOINT = os.environ.get('OTEL_EXPORTER_OTLP_TRACES_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_SERVICE_NAME = os.environ.get('OTEL_SERVICE_NAME', 'pro-crm')
+TRACE_SAMPLE_RATIO = float(os.environ.get('TRACE_SAMPLE_RATIO', '1'))
+TRACE_BATCH_SIZE = 512
+TRACE_FLUSH_SECONDS = 2
+TRACE_QUEUE_MAX = 10000  # Spans beyond this are dropped rather than buffered
+
+# OTLP span kinds and status codes
+SPAN_KIND_INTERNAL, SPAN_KIND_SERVER, SPAN_KIND_CLIENT = 1, 2, 3
+SPAN_STATUS_OK, SPAN_STATUS_ERROR = 1, 2
+
+trace_local = threading.local()
+trace_queue = queue.Queue(maxsize=TRACE_QUEUE_MAX)
+_trace_exporter_thread = None
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind', 'start_ns', 'end_ns', 'attributes', 'status', 'message')
+
+    def __init__(self, name, trace_id, parent_id=None, kind=SPAN_KIND_INTERNAL, attributes=None, start_ns=None):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.status = None
+        self.message = None
+
+    def set_error(self, message):
+        self.status = SPAN_STATUS_ERROR
+        self.message = str(message)
+
+    def end(self, end_ns=None):
+        self.end_ns = end_ns or time.time_ns()
+        try:
+            trace_queue.put_nowait(self)
+        except queue.Full:
+            pass
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': otlp_attributes(self.attributes),
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        if self.status:
+            span['status'] = {'code': self.status, 'message': self.message or ''}
+        return span
+
+
+def otlp_attributes(attributes):
+    encoded = []
+    for key, value in attributes.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            encoded.append({'key': key, 'value': {'boolValue': value}})
+        elif isinstance(value, int):
+            encoded.append({'key': key, 'value': {'intValue': str(value)}})
+        elif isinstance(value, float):
+            encoded.append({'key': key, 'value': {'doubleValue': value}})
+        else:
+            encoded.append({'key': key, 'value': {'stringValue': str(value)}})
+    return encoded
+
+
+def current_span():
+    stack = getattr(trace_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def current_trace_id():
+    span = current_span()
+    return span.trace_id if span else None
+
+
+class trace_span:
+    """
+    Context manager for a child of the current span (or of `parent`, a Span
+    from another thread). Without either it does nothing, so background work
+    is only traced when it belongs to a traced request.
+    """
+
+    def __init__(self, name, attributes=None, parent=None, kind=SPAN_KIND_INTERNAL):
+        self.name = name
+        self.parent = parent
+        self.kind = kind
+        self.attributes = attributes
+        self.span = None
+
+    def __enter__(self):
+        parent = self.parent or current_span()
+        if not TRACING or parent is None:
+            return None
+        self.span = Span(self.name, parent.trace_id, parent.span_id, self.kind, self.attributes)
+        if not hasattr(trace_local, 'stack'):
+            trace_local.stack = []
+        trace_local.stack.append(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.span is None:
+            return False
+        trace_local.stack.remove(self.span)
+        if exc is not None:
+            self.span.set_error(f"{exc_type.__name__}: {exc}")
+        self.span.end()
+        return False
+
+
+class TraceCommandListener(monitoring.CommandListener):
+    """Turns each PyMongo command issued under a span into a client child span."""
+
+    def started(self, event):
+        parent = current_span()
+        if parent is None:
+            return
+        target = event.command.get(event.command_name)
+        collection = target if isinstance(target, str) else None
+        span = Span(
+            f"{event.command_name} {collection}" if collection else event.command_name,
+            parent.trace_id, parent.span_id, SPAN_KIND_CLIENT,
+            {
+                'db.system': 'mongodb',
+                'db.name': event.database_name,
+                'db.operation': event.command_name,
+                'db.mongodb.collection': collection,
+                'net.peer.name': event.connection_id[0] if event.connection_id else None,
+            }
+        )
+        if not hasattr(trace_local, 'pending'):
+            trace_local.pending = {}
+        trace_local.pending[event.request_id] = span
+
+    def _finish(self, event, error=None):
+        span = getattr(trace_local, 'pending', {}).pop(event.request_id, None)
+        if span is None:
+            return
+        if error:
+            span.set_error(error)
+        span.end(span.start_ns + event.duration_micros * 1000)
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event, event.failure.get('errmsg', 'command failed'))
+
+
+def parse_traceparent(value):
+    """Return (trace_id, parent_span_id, sampled) from a W3C traceparent header, or None."""
+    match = re.fullmatch(r'00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})', (value or '').strip())
+    if not match or match.group(1) == '0' * 32 or match.group(2) == '0' * 16:
+        return None
+    return match.group(1), match.group(2), int(match.group(3), 16) & 1 == 1
+
+
+class TracedResponse:
+    """Keeps the root span open while a (possibly streamed) response body is iterated."""
+
+    def __init__(self, app_iter, span):
+        self.app_iter = app_iter
+        self.span = span
+        self.chunks = None
+
+    def __iter__(self):
+        self.chunks = iter(self.app_iter)
+        return self
+
+    def __next__(self):
+        trace_local.stack = [self.span]
+        try:
+            return next(self.chunks)
+        finally:
+            trace_local.stack = []
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.span.end()
+
+
+def tracing_middleware(wsgi_app):
+    def middleware(environ, start_response):
+        incoming = parse_traceparent(environ.get('HTTP_TRACEPARENT'))
+        if incoming:
+            trace_id, parent_id, sampled = incoming
+        else:
+            trace_id, parent_id = os.urandom(16).hex(), None
+            sampled = TRACE_SAMPLE_RATIO >= 1 or int.from_bytes(os.urandom(2), 'big') < TRACE_SAMPLE_RATIO * 65536
+        if not sampled:
+            return wsgi_app(environ, start_response)
+
+        method = environ.get('REQUEST_METHOD', 'GET')
+        span = Span(f"{method} {environ.get('PATH_INFO', '/')}", trace_id, parent_id, SPAN_KIND_SERVER, {
+            'http.method': method,
+            'http.target': environ.get('PATH_INFO', '/') + (f"?{environ['QUERY_STRING']}" if environ.get('QUERY_STRING') else ''),
+            'http.user_agent': environ.get('HTTP_USER_AGENT'),
+        })
+
+        def traced_start_response(status, headers, exc_info=None):
+            code = int(status.split(' ', 1)[0])
+            span.attributes['http.status_code'] = code
+            if code >= 500:
+                span.set_error(status)
+            return start_response(status, list(headers) + [('X-Trace-Id', trace_id)], exc_info)
+
+        trace_local.stack = [span]
+        try:
+            app_iter = wsgi_app(environ, traced_start_response)
+        except Exception as e:
+            span.set_error(f"{type(e).__name__}: {e}")
+            span.end()
+            raise
+        finally:
+            trace_local.stack = []
+        return TracedResponse(app_iter, span)
+    return middleware
+
+
+@app.before_request
+def name_trace_span():
+    """Name the root span after the matched route rather than the raw path."""
+    span = current_span()
+    if span is not None and span.kind == SPAN_KIND_SERVER and request.url_rule is not None:
+        span.name = f"{request.method} {request.url_rule.rule}"
+        span.attributes['http.route'] = request.url_rule.rule
+
+
+class TraceTaggedStream:
+    """Wraps stdout so lines printed under a span start with its trace id."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.at_line_start = threading.local()
+
+    def write(self, text):
+        trace_id = current_trace_id()
+        if trace_id and text and getattr(self.at_line_start, 'value', True) and text != '\n':
+            text = f"[trace_id={trace_id}] {text}"
+        if text:
+            self.at_line_start.value = text.endswith('\n')
+        return self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def export_spans(spans):
+    payload = json.dumps({'resourceSpans': [{
+        'resource': {'attributes': otlp_attributes({'service.name': TRACE_SERVICE_NAME, 'process.pid': os.getpid()})},
+        'scopeSpans': [{'scope': {'name': 'pro-crm'}, 'spans': [s.to_otlp() for s in spans]}],
+    }]})
+    if TRACE_EXPORTER == 'otlp':
+        from urllib.request import Request, urlopen
+        req = Request(TRACE_OTLP_ENDPOINT, data=payload.encode('utf-8'), headers={'Content-Type': 'application/json'})
+        with urlopen(req, timeout=5) as resp:
+            resp.read()
+    else:
+        with open(TRACE_FILE, 'a', encoding='utf-8') as f:
+            f.write(payload + '\n')
+
+
+def trace_exporter_loop():
+    while True:
+        spans = [trace_queue.get()]
+        deadline = time.monotonic() + TRACE_FLUSH_SECONDS
+        while len(spans) < TRACE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                spans.append(trace_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            export_spans(spans)
+        except Exception as e:
+            print(f"Trace Export Error: {e}")
+
+
+def start_trace_exporter():
+    """Start the span exporter thread for this process (after any fork)."""
+    global _trace_exporter_thread
+    if not TRACING or (_trace_exporter_thread is not None and _trace_exporter_thread.is_alive()):
+        return
+    _trace_exporter_thread = threading.Thread(target=trace_exporter_loop, name='trace-exporter', daemon=True)
+    _trace_exporter_thread.start()
+
+
+if TRACING:
+    app.wsgi_app = tracing_middleware(app.wsgi_app)
+    MONGO_EVENT_LISTENERS.append(TraceCommandListener())
+    sys.stdout = TraceTaggedStream(sys.stdout)
+
+
+# --- READ QUERY SPECS ---
+#
+# The hot read routes describe their queries as {name: (collection, kind, args)}
+# with kind one of 'find', 'count' or 'aggregate'. run_read_queries executes a
+# spec on PyMongo; asgi.py runs the same specs concurrently on Motor, so both
+# deployments share one definition of every query and every response builder.
+
+def run_read_queries(queries):
+    """Execute a read-query spec on PyMongo and return {name: result}."""
+    results = {}
+    for name, (collection, kind, args) in queries.items():
+        coll = mongo.db[collection]
+        if kind == 'count':
+            results[name] = coll.count_documents(args['filter'])
+        elif kind == 'aggregate':
+            results[name] = list(coll.aggregate(args['pipeline']))
+        else:
+            cursor = coll.find(args['filter'], args.get('projection'))
+            if args.get('sort'):
+                cursor = cursor.sort(args['sort'])
+            results[name] = list(cursor)
+    return results
 
 
 def normalize_email(value):
     return value.strip().lower() if isinstance(value, str) else value
 
 
-def send_password_reset_email(to_email, username, token):
-    """Send a password reset email using Gmail SMTP credentials."""
+def queue_password_reset_email(to_email, username, token):
+    """Queue a password reset email in the outbox. Returns False if mail is not configured."""
     gmail_user = app.config.get("GMAIL_USER")
     gmail_pass = app.config.get("GMAIL_APP_PASSWORD")
 
@@ -101,29 +556,312 @@ def send_password_reset_email(to_email, username, token):
     reset_link = f"{base_url}{connector}reset_token={token}"
     expires_in = app.config.get("PASSWORD_RESET_EXPIRY_MINUTES", 30)
 
-    message = EmailMessage()
-    message["Subject"] = "Reset your PRO account password"
-    message["From"] = gmail_user
-    message["To"] = to_email
-    message.set_content(
+    body = (
         f"Hello {username},\n\n"
         "We received a request to reset your password. "
         f"Use the link below to set a new password (valid for {expires_in} minutes).\n\n"
         f"{reset_link}\n\n"
         "If you did not request this, you can safely ignore this email."
     )
+    # The link is useless once the token expires, so the message is deleted then too.
+    # Serverless hosts have no delivery thread, so the first attempt is made here.
+    queue_email(to_email, "Reset your PRO account password", body,
+                expires_at=datetime.now() + timedelta(minutes=expires_in), send_now=SERVERLESS)
+    return True
+
+
+# --- EMAIL OUTBOX ---
+#
+# Mail is written to the email_outbox collection and delivered by a background
+# thread, so requests never wait on SMTP. Serverless hosts freeze threads after
+# the response and start no worker: there the password reset is sent inline, and
+# each /api/auth/forgot call retries up to EMAIL_INLINE_DRAIN_LIMIT earlier
+# messages that are due (nothing else drains the outbox on those hosts). The
+# worker keeps one authenticated connection open between messages and retries
+# failures with exponential backoff; a message claimed by a worker that died is
+# picked up again after EMAIL_CLAIM_TIMEOUT_SECONDS. Every message carries an
+# expires_at (a TTL index removes it, sent or failed), and expired messages are
+# not retried.
+
+EMAIL_MAX_ATTEMPTS = 6
+EMAIL_RETRY_BASE_SECONDS = 30
+EMAIL_RETRY_MAX_SECONDS = 3600
+EMAIL_CLAIM_TIMEOUT_SECONDS = 300
+EMAIL_POLL_SECONDS = 15
+SMTP_IDLE_SECONDS = 60  # Close the pooled connection after this long unused
+EMAIL_RETENTION_DAYS = 30
+EMAIL_INLINE_DRAIN_LIMIT = 3
+
+email_outbox_wakeup = threading.Event()
+email_worker_lock = threading.Lock()
+email_worker_thread = None
+smtp_state = {'server': None, 'last_used': 0.0}
+smtp_lock = threading.Lock()  # The pooled connection is shared by the worker and inline sends
+
+
+def queue_email(to_email, subject, body, expires_at=None, send_now=False):
+    """
+    Add a message to the outbox. With send_now the first attempt is made in the
+    calling request and the worker only retries; otherwise the worker is woken.
+    """
+    now = datetime.now()
+    doc = {
+        "to": to_email,
+        "subject": subject,
+        "body": body,
+        "status": "sending" if send_now else "pending",
+        "attempts": 1 if send_now else 0,
+        "next_attempt_at": now,
+        "created_at": now,
+        "expires_at": expires_at or now + timedelta(days=EMAIL_RETENTION_DAYS),
+    }
+    if send_now:
+        doc["claimed_at"] = now
+    doc["_id"] = mongo.db.email_outbox.insert_one(doc).inserted_id
+
+    if send_now and deliver_outbox_message(doc):
+        return doc["_id"]
+    if not SERVERLESS:
+        start_email_worker()
+        email_outbox_wakeup.set()
+    return doc["_id"]
+
+
+def email_retry_delay(attempts):
+    """Seconds to wait before the next delivery attempt (30s, 60s, 120s, ... capped)."""
+    return min(EMAIL_RETRY_BASE_SECONDS * (2 ** max(attempts - 1, 0)), EMAIL_RETRY_MAX_SECONDS)
+
+
+def close_smtp_connection():
+    server = smtp_state['server']
+    smtp_state['server'] = None
+    if server is not None:
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+
+def get_smtp_connection():
+    """Return the pooled SMTP connection, reconnecting if it went idle or dropped."""
+    server = smtp_state['server']
+    if server is not None:
+        if time.time() - smtp_state['last_used'] > SMTP_IDLE_SECONDS:
+            close_smtp_connection()
+        else:
+            try:
+                if server.noop()[0] == 250:
+                    return server
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            close_smtp_connection()
+
+    host = app.config["SMTP_HOST"]
+    port = app.config["SMTP_PORT"]
+    if app.config["SMTP_USE_SSL"]:
+        server = smtplib.SMTP_SSL(host, port, context=ssl.create_default_context(), timeout=30)
+    else:
+        server = smtplib.SMTP(host, port, timeout=30)
+    server.ehlo()
+    # Local test sinks usually do not offer AUTH
+    if server.has_extn('auth') and app.config.get("GMAIL_APP_PASSWORD"):
+        server.login(app.config["GMAIL_USER"], app.config["GMAIL_APP_PASSWORD"])
+    smtp_state['server'] = server
+    smtp_state['last_used'] = time.time()
+    return server
+
+
+def claim_outbox_message():
+    """Atomically take the next due message, including ones stuck in a dead worker."""
+    now = datetime.now()
+    return mongo.db.email_outbox.find_one_and_update(
+        {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "sending", "claimed_at": {"$lt": now - timedelta(seconds=EMAIL_CLAIM_TIMEOUT_SECONDS)}},
+        ], "expires_at": {"$not": {"$lte": now}}},
+        {"$set": {"status": "sending", "claimed_at": now}, "$inc": {"attempts": 1}},
+        sort=[("next_attempt_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def deliver_outbox_message(doc):
+    """Send one claimed message and record the outcome."""
+    message = EmailMessage()
+    message["Subject"] = doc["subject"]
+    message["From"] = app.config.get("GMAIL_USER")
+    message["To"] = doc["to"]
+    message.set_content(doc["body"])
 
     try:
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context) as server:
-            server.login(gmail_user, gmail_pass)
-            server.send_message(message)
+        with smtp_lock:
+            get_smtp_connection().send_message(message)
+            smtp_state['last_used'] = time.time()
+        mongo.db.email_outbox.update_one(
+            {"_id": doc["_id"]},
+            {"$set": {"status": "sent", "sent_at": datetime.now()}, "$unset": {"claimed_at": "", "last_error": ""}}
+        )
         return True
     except Exception as e:
-        print(f"Failed to send reset email: {e}")
+        print(f"Email Delivery Error ({doc['to']}, attempt {doc['attempts']}): {e}")
+        with smtp_lock:
+            close_smtp_connection()
+        update = {"last_error": str(e)}
+        if doc["attempts"] >= EMAIL_MAX_ATTEMPTS:
+            update["status"] = "failed"
+        else:
+            update["status"] = "pending"
+            update["next_attempt_at"] = datetime.now() + timedelta(seconds=email_retry_delay(doc["attempts"]))
+        mongo.db.email_outbox.update_one({"_id": doc["_id"]}, {"$set": update, "$unset": {"claimed_at": ""}})
         return False
 
 
+def drain_email_outbox(limit=None):
+    """Deliver every message that is currently due (at most `limit` attempts). Returns the number sent."""
+    sent = attempted = 0
+    while limit is None or attempted < limit:
+        attempted += 1
+        doc = claim_outbox_message()
+        if doc is None:
+            return sent
+        if deliver_outbox_message(doc):
+            sent += 1
+    return sent
+
+
+def email_worker_loop():
+    while True:
+        email_outbox_wakeup.wait(EMAIL_POLL_SECONDS)
+        email_outbox_wakeup.clear()
+        try:
+            drain_email_outbox()
+            with smtp_lock:
+                if smtp_state['server'] is not None and time.time() - smtp_state['last_used'] > SMTP_IDLE_SECONDS:
+                    close_smtp_connection()
+        except Exception as e:
+            print(f"Email Worker Error: {e}")
+
+
+def start_email_worker():
+    """Start the delivery thread once per process."""
+    global email_worker_thread
+    with email_worker_lock:
+        if email_worker_thread is None or not email_worker_thread.is_alive():
+            email_worker_thread = threading.Thread(target=email_worker_loop, name="email-outbox", daemon=True)
+            email_worker_thread.start()
+
+
+# --- RATE LIMITING ---
+#
+# Sliding-window log limiter for the auth routes. Attempts are checked before
+# the user lookup, so a burst of bad logins is rejected without running the
+# password hash. Each attempt is counted against both the username and the
+# client IP; a successful login clears the username window.
+#
+# RATE_LIMIT_BACKEND=memory (default) keeps windows per process;
+# RATE_LIMIT_BACKEND=mongo shares them across workers through rate_limits.
+
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMITS = {
+    # action: {key kind: (max attempts, window seconds)}
+    'login': {'user': (10, 300), 'ip': (30, 300)},
+    'forgot': {'user': (3, 900), 'ip': (10, 900)},
+}
+
+RATE_LIMIT_SWEEP_SECONDS = 60
+RATE_LIMIT_MAX_WINDOW = max(window for limits in RATE_LIMITS.values() for _, window in limits.values())
+
+rate_limit_windows = {}
+rate_limit_lock = threading.Lock()
+rate_limit_swept_at = 0
+
+
+def sweep_rate_limit_windows(now):
+    """Drop keys with no attempt inside the longest window. Caller holds rate_limit_lock."""
+    global rate_limit_swept_at
+    if now - rate_limit_swept_at < RATE_LIMIT_SWEEP_SECONDS:
+        return
+    rate_limit_swept_at = now
+    stale = [key for key, hits in rate_limit_windows.items()
+             if not hits or hits[-1] <= now - RATE_LIMIT_MAX_WINDOW]
+    for key in stale:
+        del rate_limit_windows[key]
+
+
+def memory_rate_limit_hit(key, limit, window):
+    """Record an attempt unless the window is full. Returns seconds to wait, 0 if allowed."""
+    now = time.time()
+    with rate_limit_lock:
+        sweep_rate_limit_windows(now)
+        hits = rate_limit_windows.setdefault(key, deque())
+        while hits and hits[0] <= now - window:
+            hits.popleft()
+        if len(hits) >= limit:
+            return hits[0] + window - now
+        hits.append(now)
+        return 0
+
+
+def mongo_rate_limit_hit(key, limit, window):
+    """Same as memory_rate_limit_hit, stored in rate_limits so all workers share it."""
+    now = datetime.now()
+    window_start = now - timedelta(seconds=window)
+    mongo.db.rate_limits.update_one({"_id": key}, {"$pull": {"hits": {"$lte": window_start}}})
+    try:
+        # Matches only while fewer than `limit` hits remain; a full window makes the upsert collide
+        mongo.db.rate_limits.update_one(
+            {"_id": key, f"hits.{limit - 1}": {"$exists": False}},
+            {"$push": {"hits": now}, "$set": {"expires_at": now + timedelta(seconds=window)}},
+            upsert=True
+        )
+        return 0
+    except DuplicateKeyError:
+        doc = mongo.db.rate_limits.find_one({"_id": key}) or {}
+        oldest = min(doc.get("hits") or [now])
+        return max((oldest + timedelta(seconds=window) - now).total_seconds(), 1)
+
+
+def rate_limit_hit(key, limit, window):
+    if RATE_LIMIT_BACKEND == 'mongo':
+        try:
+            return mongo_rate_limit_hit(key, limit, window)
+        except Exception as e:
+            print(f"Rate Limit Backend Error: {e}")  # Fall back to this process's window
+    return memory_rate_limit_hit(key, limit, window)
+
+
+def rate_limit_reset(key):
+    with rate_limit_lock:
+        rate_limit_windows.pop(key, None)
+    if RATE_LIMIT_BACKEND == 'mongo':
+        try:
+            mongo.db.rate_limits.delete_one({"_id": key})
+        except Exception as e:
+            print(f"Rate Limit Backend Error: {e}")
+
+
+def rate_limit_keys(action, username):
+    keys = {'ip': f"{action}:ip:{request.remote_addr or 'unknown'}"}
+    if username:
+        keys['user'] = f"{action}:user:{str(username).strip().lower()}"
+    return keys
+
+
+def throttle_auth(action, username):
+    """Return a 429 response if this attempt is over the limit, otherwise None."""
+    for kind, key in rate_limit_keys(action, username).items():
+        limit, window = RATE_LIMITS[action][kind]
+        retry_after = rate_limit_hit(key, limit, window)
+        if retry_after:
+            retry_after = int(retry_after) + 1
+            response = jsonify({"error": f"Too many attempts. Try again in {retry_after} seconds."})
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 429
+    return None
+
+
 # --- AUTHENTICATION ROUTES ---
 
 def login_required(f):
@@ -146,6 +884,28 @@ def role_required(roles):
         return wrapper
     return decorator
 
+def days_since_admission(admission_date, now=None):
+    """Whole days since an admission date (ISO string or datetime); 0 if missing or unparseable."""
+    if not admission_date:
+        return 0
+    try:
+        if isinstance(admission_date, str):
+            admission_dt = datetime.fromisoformat(admission_date.replace('Z', '+00:00'))
+        else:
+            admission_dt = admission_date
+        days_diff = ((now or datetime.now()) - admission_dt).days
+        return max(0, days_diff)
+    except:
+        return 0
+
+def _safe_int(raw_val: object) -> int:
+    """Best-effort int conversion that strips non-digits."""
+    try:
+        cleaned = ''.join(ch for ch in str(raw_val or '0') if ch.isdigit() or ch == '-')
+        return int(cleaned) if cleaned not in ('', '-') else 0
+    except Exception:
+        return 0
+
 def calculate_prorated_fee(monthly_fee, days_elapsed):
     """
     Calculate prorated fee based on days elapsed.
@@ -223,9 +983,13 @@ def index():
 def login():
     if not check_db(): return jsonify({"error": "Database error"}), 500
     data = clean_input_data(request.json)
+    limited = throttle_auth('login', data.get('username'))
+    if limited:
+        return limited
     user = mongo.db.users.find_one({"username": data['username']})
     
     if user and check_password_hash(user['password'], data['password']):
+        rate_limit_reset(rate_limit_keys('login', data['username'])['user'])
         session['user_id'] = str(user['_id'])
         session['username'] = user['username']
         session['role'] = user['role']
@@ -252,6 +1016,10 @@ def forgot_password():
     if not username or not email:
         return jsonify({"error": "Username and email are required"}), 400
 
+    limited = throttle_auth('forgot', username)
+    if limited:
+        return limited
+
     if not app.config.get("GMAIL_USER") or not app.config.get("GMAIL_APP_PASSWORD"):
         return jsonify({"error": "Email service not configured"}), 500
 
@@ -267,10 +1035,21 @@ def forgot_password():
         return jsonify({"error": "Username and email do not match our records."}), 400
 
     token = serializer.dumps({"user_id": str(user['_id']), "email": registered_email}, salt="password-reset")
-    sent = send_password_reset_email(registered_email, user.get('name', user['username']), token)
-    if not sent:
+    try:
+        queued = queue_password_reset_email(registered_email, user.get('name', user['username']), token)
+    except Exception as e:
+        print(f"Reset Email Queue Error: {e}")
+        queued = False
+    if not queued:
         return jsonify({"error": "Could not send reset email. Please try again or contact support."}), 500
 
+    if SERVERLESS:
+        # No worker runs here; retry earlier failed messages while this request is alive
+        try:
+            drain_email_outbox(limit=EMAIL_INLINE_DRAIN_LIMIT)
+        except Exception as e:
+            print(f"Email Outbox Drain Error: {e}")
+
     return jsonify({"message": "Reset email sent to your registered address."})
 
 
@@ -326,7 +1105,9 @@ def check_session():
             "is_logged_in": True,
             "username": session.get('username'),
             "role": session.get('role'),
-            "user_id": session.get('user_id')
+            "user_id": session.get('user_id'),
+            "live_events": LIVE_EVENTS_ENABLED,
+            "export_jobs": EXPORT_JOBS_ENABLED
         })
     return jsonify({"is_logged_in": False})
 
@@ -395,104 +1176,243 @@ def change_password():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# --- REQUEST COALESCING ---
+#
+# When several users open the same report at once, only the first request
+# computes it; concurrent requests for the same key wait and share the result.
+# Nothing is cached once the computation finishes. Threads of one process
+# coalesce in memory. With COALESCE_BACKEND=mongo, workers also coalesce through
+# a lock document in report_flights: the worker holding it computes and stores
+# the JSON result there, and the others poll for it.
+
+COALESCE_BACKEND = os.environ.get('COALESCE_BACKEND', 'memory')
+COALESCE_WAIT_SECONDS = 30
+COALESCE_POLL_SECONDS = 0.05
+
+inflight_reports = {}
+inflight_reports_lock = threading.Lock()
+
+
+def single_flight(key, compute):
+    """Run compute() once per key across concurrent callers in this process."""
+    with inflight_reports_lock:
+        flight = inflight_reports.get(key)
+        leader = flight is None
+        if leader:
+            flight = {'done': threading.Event(), 'result': None, 'error': None}
+            inflight_reports[key] = flight
+
+    if not leader:
+        with trace_span('coalesce.wait', {'coalesce.key': key}):
+            flight['done'].wait()
+        if flight['error'] is not None:
+            raise flight['error']
+        return flight['result']
+
+    try:
+        if COALESCE_BACKEND == 'mongo':
+            flight['result'] = mongo_single_flight(key, compute)
+        else:
+            flight['result'] = compute()
+        return flight['result']
+    except Exception as e:
+        flight['error'] = e
+        raise
+    finally:
+        with inflight_reports_lock:
+            inflight_reports.pop(key, None)
+        flight['done'].set()
+
+
+def claim_report_flight(key, flight_id, now):
+    """Take the Mongo lock for key if it is free, finished or expired. Returns True on success."""
+    lock = {'status': 'running', 'flight_id': flight_id, 'started_at': now,
+            'expires_at': now + timedelta(seconds=COALESCE_WAIT_SECONDS)}
+    try:
+        mongo.db.report_flights.insert_one({'_id': key, **lock})
+        return True
+    except DuplicateKeyError:
+        taken = mongo.db.report_flights.find_one_and_update(
+            {'_id': key, '$or': [{'status': 'done'}, {'expires_at': {'$lt': now}}]},
+            {'$set': lock, '$unset': {'payload': ''}}
+        )
+        return taken is not None
+
+
+def mongo_single_flight(key, compute):
+    """Coalesce compute() across workers; results travel as JSON through report_flights."""
+    flight_id = str(ObjectId())
+    try:
+        leader = claim_report_flight(key, flight_id, datetime.now())
+    except Exception as e:
+        print(f"Coalesce Backend Error: {e}")
+        return compute()
+
+    if leader:
+        try:
+            result = compute()
+        except Exception:
+            mongo.db.report_flights.delete_one({'_id': key, 'flight_id': flight_id})
+            raise
+        payload = json.dumps(result, default=str)
+        mongo.db.report_flights.update_one(
+            {'_id': key, 'flight_id': flight_id},
+            {'$set': {'status': 'done', 'payload': payload,
+                      'expires_at': datetime.now() + timedelta(seconds=COALESCE_WAIT_SECONDS)}}
+        )
+        return result
+
+    # Another worker is computing: wait for its result, or compute ourselves if it vanishes
+    deadline = time.time() + COALESCE_WAIT_SECONDS
+    watched = None
+    while time.time() < deadline:
+        doc = mongo.db.report_flights.find_one({'_id': key}, {'status': 1, 'flight_id': 1, 'payload': 1})
+        if doc is None:
+            break
+        if doc['status'] == 'running':
+            watched = doc['flight_id']
+        elif watched is not None and doc['flight_id'] == watched:
+            return json.loads(doc['payload'])
+        elif watched is None:
+            break  # Finished before we started waiting; its result may predate our request
+        time.sleep(COALESCE_POLL_SECONDS)
+    return compute()
+
+
+# --- REPORT CACHE ---
+#
+# Heavy admin reports are kept in report_cache as JSON, stamped with the data
+# version of the collections they read (plus a period such as today's date when
+# the output also depends on the clock). A request serves the stored report when
+# its stamp still matches and otherwise recomputes and replaces it. The nightly
+# jobs below fill the cache off-hours so the first request of the day is cheap.
+
+# report -> collections whose changes invalidate it
+REPORT_CACHE_SOURCES = {
+    'accounts_summary': ('patients', 'canteen_sales'),
+    'canteen_breakdown': ('patients', 'canteen_sales'),
+    'overheads_annual': ('overheads', 'canteen_sales'),
+}
+
+
+def report_cache_stamp(period, version):
+    return f"{period}|{version}"
+
+
+def cached_report(key, collections, period, compute):
+    """Return the cached report for key if its stamp is current, else compute and store it."""
+    stamp = report_cache_stamp(period, get_data_version(collections))
+    doc = mongo.db.report_cache.find_one({'_id': key, 'stamp': stamp}, {'payload': 1})
+    if doc is not None:
+        return json.loads(doc['payload'])
+
+    result = compute()
+    mongo.db.report_cache.replace_one({'_id': key}, {
+        'stamp': stamp,
+        'payload': app.json.dumps(result),
+        'computed_at': datetime.now()
+    }, upsert=True)
+    return result
+
+
 # --- DASHBOARD METRICS ---
-@app.route('/api/dashboard', methods=['GET'])
-@login_required
-def get_dashboard_metrics():
-    if not check_db(): return jsonify({"error": "Database error"}), 500
-    
-    today = datetime.now()
+
+def dashboard_queries(today):
+    """Read queries behind the dashboard KPI cards (all independent)."""
     start_of_month = today.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
     
     if today.month == 12:
         end_of_month = today.replace(year=today.year + 1, month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
     else:
         end_of_month = today.replace(month=today.month + 1, day=1, hour=0, minute=0, second=0, microsecond=0)
-    
-    try:
+
+    return {
         # 1. Basic Counts
-        total_patients = mongo.db.patients.count_documents({})
-        admissions_this_month = mongo.db.patients.count_documents({
+        'total_patients': ('patients', 'count', {'filter': {}}),
+        'admissions_this_month': ('patients', 'count', {'filter': {
             'admissionDate': {'$gte': start_of_month.isoformat(), '$lt': end_of_month.isoformat()}
-        })
-        discharges_this_month = mongo.db.patients.count_documents({
+        }}),
+        'discharges_this_month': ('patients', 'count', {'filter': {
             'isDischarged': True,
             'dischargeDate': {'$gte': start_of_month.isoformat(), '$lt': end_of_month.isoformat()}
-        })
-        
-        # 2. Total Expected Incoming (Remaining Balance Calculation)
-        # Fetch ALL canteen sales first to create a map
-        # Note: We group by patient_id. We convert ObjectId to string for easy matching.
-        all_canteen_sales = list(mongo.db.canteen_sales.find())
-        canteen_map = {}
-        
-        for sale in all_canteen_sales:
-            # Handle patient_id whether it's ObjectId or String
-            pid = str(sale.get('patient_id', ''))
-            amount = int(sale.get('amount', 0))
-            if pid:
-                canteen_map[pid] = canteen_map.get(pid, 0) + amount
-
-        # Fetch Active Patients
-        active_patients = list(mongo.db.patients.find({'isDischarged': {'$ne': True}}))
-        
-        total_expected_balance = 0
-        
-        # Calculate total expected balance from active patients (fee + canteen + laundry - received)
-        for patient in active_patients:
-            try:
-                pid = str(patient['_id'])
-                
-                # Calculate days elapsed for prorated fee
-                admission_date = patient.get('admissionDate')
-                days_elapsed = 0
-                if admission_date:
-                    try:
-                        if isinstance(admission_date, str):
-                            admission_dt = datetime.fromisoformat(admission_date.replace('Z', '+00:00'))
-                        else:
-                            admission_dt = admission_date
-                        days_diff = (datetime.now() - admission_dt).days
-                        days_elapsed = max(0, days_diff)
-                    except:
-                        pass
-                
-                # Get prorated fee
-                fee_str = patient.get('monthlyFee', '0') or '0'
-                fee = calculate_prorated_fee(fee_str, days_elapsed)
-                
-                # Get canteen total
-                canteen = canteen_map.get(pid, 0)
-                
-                # Get laundry (one-time charge for discharge)
-                laundry = patient.get('laundryAmount', 0) if patient.get('laundryStatus', False) else 0
-                
-                # Get received amount
-                received_str = str(patient.get('receivedAmount', '0')).replace(',', '')
-                received = int(received_str or '0')
-                
-                # Calculate remaining balance
-                balance = fee + canteen + laundry - received
-                total_expected_balance += max(0, balance)  # Only count positive balances
-            except (ValueError, TypeError) as e:
-                print(f"Dashboard calculation error for patient {patient.get('name')}: {e}")
-                pass
-
+        }}),
+        # 2. Inputs for Total Expected Incoming (Remaining Balance Calculation)
+        'all_canteen_sales': canteen_read_spec('find', {'filter': {}, 'projection': {'patient_id': 1, 'amount': 1}}),
+        'active_patients': ('patients', 'find', {'filter': {'isDischarged': {'$ne': True}}}),
         # 3. Canteen Sales This Month (KPI Card)
-        pipeline_month = [
+        'canteen_month': canteen_read_spec('aggregate', {'pipeline': [
             {'$match': {'date': {'$gte': start_of_month, '$lt': end_of_month}}},
             {'$group': {'_id': None, 'total_sales': {'$sum': '$amount'}}}
-        ]
-        canteen_month_res = list(mongo.db.canteen_sales.aggregate(pipeline_month))
-        total_canteen_sales_this_month = canteen_month_res[0]['total_sales'] if canteen_month_res else 0
-        
-        return jsonify({
-            'totalPatients': total_patients,
-            'admissionsThisMonth': admissions_this_month,
-            'dischargesThisMonth': discharges_this_month,
-            'totalExpectedBalance': total_expected_balance,  # Changed: now shows remaining balance
-            'totalCanteenSalesThisMonth': total_canteen_sales_this_month
-        })
+        ]}),
+    }
+
+
+def build_dashboard_metrics(results):
+    """Turn the results of dashboard_queries into the dashboard payload."""
+    # Map canteen sales by patient_id. We convert ObjectId to string for easy matching.
+    canteen_map = {}
+    
+    for sale in results['all_canteen_sales']:
+        # Handle patient_id whether it's ObjectId or String
+        pid = str(sale.get('patient_id', ''))
+        amount = int(sale.get('amount', 0))
+        if pid:
+            canteen_map[pid] = canteen_map.get(pid, 0) + amount
+
+    total_expected_balance = 0
+    
+    # Calculate total expected balance from active patients (fee + canteen + laundry - received)
+    for patient in results['active_patients']:
+        try:
+            pid = str(patient['_id'])
+            
+            # Calculate days elapsed for prorated fee
+            days_elapsed = days_since_admission(patient.get('admissionDate'))
+            
+            # Get prorated fee
+            fee_str = patient.get('monthlyFee', '0') or '0'
+            fee = calculate_prorated_fee(fee_str, days_elapsed)
+            
+            # Get canteen total
+            canteen = canteen_map.get(pid, 0)
+            
+            # Get laundry (one-time charge for discharge)
+            laundry = patient.get('laundryAmount', 0) if patient.get('laundryStatus', False) else 0
+            
+            # Get received amount
+            received_str = str(patient.get('receivedAmount', '0')).replace(',', '')
+            received = int(received_str or '0')
+            
+            # Calculate remaining balance
+            balance = fee + canteen + laundry - received
+            total_expected_balance += max(0, balance)  # Only count positive balances
+        except (ValueError, TypeError) as e:
+            print(f"Dashboard calculation error for patient {patient.get('name')}: {e}")
+            pass
+
+    canteen_month_res = results['canteen_month']
+    total_canteen_sales_this_month = canteen_month_res[0]['total_sales'] if canteen_month_res else 0
+    
+    return {
+        'totalPatients': results['total_patients'],
+        'admissionsThisMonth': results['admissions_this_month'],
+        'dischargesThisMonth': results['discharges_this_month'],
+        'totalExpectedBalance': total_expected_balance,  # Changed: now shows remaining balance
+        'totalCanteenSalesThisMonth': total_canteen_sales_this_month
+    }
+
+
+@app.route('/api/dashboard', methods=['GET'])
+@login_required
+def get_dashboard_metrics():
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    
+    try:
+        metrics = single_flight(
+            'dashboard',
+            lambda: build_dashboard_metrics(run_read_queries(dashboard_queries(datetime.now())))
+        )
+        return jsonify(metrics)
     except Exception as e:
         print(f"DB Metric Error: {e}")
         return jsonify({"error": str(e)}), 500
@@ -532,10 +1452,10 @@ def debug_dashboard():
             {'$match': {'date': {'$gte': start_of_month}}},
             {'$group': {'_id': None, 'total': {'$sum': '$amount'}, 'count': {'$sum': 1}}}
         ]
-        canteen_data = list(mongo.db.canteen_sales.aggregate(canteen_pipeline))
+        canteen_data = list(canteen_aggregate(canteen_pipeline))
         
         # Get all canteen sales for context
-        all_canteen = list(mongo.db.canteen_sales.find().sort('date', -1).limit(5))
+        all_canteen = list(canteen_find(sort=[('date', -1)], limit=5))
         canteen_sample = [{
             'date': str(c.get('date')),
             'amount': c.get('amount'),
@@ -580,59 +1500,536 @@ def get_month_admissions():
         print(f"Admissions list error: {e}")
         return jsonify({"error": str(e)}), 500
 
-# --- PATIENT API UPDATES ---
+# --- KPI HISTORY ---
+#
+# kpi_snapshots holds one document per day (_id 'YYYY-MM-DD') with the
+# dashboard KPIs as they stood at the end of that day, so trend charts read a
+# date range instead of re-running the dashboard for every day. Days are
+# reconstructed from admissionDate/dischargeDate, canteen sales and expenses:
+# fee and canteen balances are rolled back by the payments and sales dated after
+# each day. Laundry and monthly fee are taken as they are now. Like the
+# dashboard, only live patients and canteen rows count, so archived patients
+# drop out of past days once they are archived (the census covers both).
+# The nightly job adds the days since the last snapshot and refreshes the last
+# KPI_REFRESH_DAYS to pick up back-dated entries; POST /api/kpi/backfill
+# rebuilds up to KPI_BACKFILL_HTTP_MAX_DAYS and `flask --app app backfill-kpis`
+# any longer range.
+
+KPI_BACKFILL_DAYS = int(os.environ.get('KPI_BACKFILL_DAYS', '90'))
+KPI_REFRESH_DAYS = 7
+KPI_MAX_RANGE_DAYS = 3660
+KPI_BACKFILL_HTTP_MAX_DAYS = 366  # Longer rebuilds would hold a request worker for minutes
+
+KPI_FIELDS = (
+    'totalPatients', 'activePatients', 'admissions', 'discharges',
+    'admissionsThisMonth', 'dischargesThisMonth', 'totalExpectedBalance',
+    'canteenSales', 'totalCanteenSalesThisMonth', 'incoming', 'outgoing',
+)
+
+KPI_PATIENT_PROJECTION = {
+    'admissionDate': 1, 'dischargeDate': 1, 'isDischarged': 1, 'created_at': 1,
+    'monthlyFee': 1, 'laundryStatus': 1, 'laundryAmount': 1, 'receivedAmount': 1,
+}
+
+
+def iso_day(value):
+    """'YYYY-MM-DD' of an ISO date string or datetime; None if missing."""
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, str) and len(value) >= 10:
+        return value[:10]
+    return None
+
+
+def kpi_day_amounts(collection, pipeline_match, key):
+    """[(key, day, amount)] summed per key and day from canteen-shaped rows."""
+    pipeline = [
+        {'$match': pipeline_match},
+        {'$group': {
+            '_id': {'key': key, 'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$date'}}},
+            'amount': {'$sum': '$amount'}
+        }}
+    ]
+    rows = canteen_aggregate(pipeline) if collection == 'canteen_sales' else mongo.db[collection].aggregate(pipeline)
+    return [(r['_id']['key'], r['_id']['day'], r['amount']) for r in rows]
+
+
+def compute_kpi_snapshots(start, end):
+    """KPI documents for each day in [start, end) (midnight datetimes), oldest first."""
+    window_start = start.replace(day=1)  # Month-to-date totals need the whole first month
+    start_day = start.strftime('%Y-%m-%d')
+
+    patients = {str(doc['_id']): doc for doc in mongo.db.patients.find({}, KPI_PATIENT_PROJECTION)}
+
+    # Canteen: all-time total per patient, rolled back by the sales on or after start
+    canteen_total = {
+        str(row['_id']): row['total']
+        for row in canteen_aggregate([{'$group': {'_id': '$patient_id', 'total': {'$sum': '$amount'}}}])
+    }
+    canteen_rows = kpi_day_amounts('canteen_sales', {'date': {'$gte': window_start}}, '$patient_id')
+
+    # Fee payments on or after start, to roll receivedAmount back
+    payment_rows = kpi_day_amounts('expenses', {
+        'type': 'incoming', 'category': 'Patient Fee', 'date': {'$gte': start}
+    }, '$patient_id')
+    cash_rows = kpi_day_amounts('expenses', {'date': {'$gte': window_start, '$lt': end}}, '$type')
+
+    canteen_cum = dict(canteen_total)
+    canteen_by_day, canteen_day_total = {}, {}
+    for pid, day, amount in canteen_rows:
+        pid = str(pid)
+        canteen_day_total[day] = canteen_day_total.get(day, 0) + amount
+        if day >= start_day:
+            canteen_cum[pid] = canteen_cum.get(pid, 0) - amount
+            canteen_by_day.setdefault(day, []).append((pid, amount))
+
+    received_cum = {pid: _safe_int(p.get('receivedAmount', '0')) for pid, p in patients.items()}
+    payments_by_day = {}
+    for pid, day, amount in payment_rows:
+        pid = str(pid)
+        received_cum[pid] = received_cum.get(pid, 0) - amount
+        payments_by_day.setdefault(day, []).append((pid, amount))
+
+    cash_by_day = {}
+    for kind, day, amount in cash_rows:
+        totals = cash_by_day.setdefault(day, {})
+        totals[kind] = totals.get(kind, 0) + amount
+
+    # Admission / discharge day of each patient (no admission date: present from the start)
+    spans = {}
+    admissions, discharges = {}, {}
+    for pid, p in patients.items():
+        admitted = iso_day(p.get('admissionDate')) or iso_day(p.get('created_at'))
+        discharged = iso_day(p.get('dischargeDate')) if p.get('isDischarged') else None
+        spans[pid] = (admitted, discharged, bool(p.get('isDischarged')))
+        if admitted:
+            admissions[admitted] = admissions.get(admitted, 0) + 1
+        if discharged:
+            discharges[discharged] = discharges.get(discharged, 0) + 1
+    admitted_days = sorted(a for a, _, _ in spans.values() if a)
+    undated = len(spans) - len(admitted_days)
+
+    snapshots = []
+    now = datetime.now()
+    month_admissions = month_discharges = month_canteen = 0
+    day_dt = window_start
+    while day_dt < end:
+        day = day_dt.strftime('%Y-%m-%d')
+        if day_dt.day == 1:
+            month_admissions = month_discharges = month_canteen = 0
+        month_admissions += admissions.get(day, 0)
+        month_discharges += discharges.get(day, 0)
+        month_canteen += canteen_day_total.get(day, 0)
+
+        if day >= start_day:
+            for pid, amount in canteen_by_day.get(day, ()):
+                canteen_cum[pid] = canteen_cum.get(pid, 0) + amount
+            for pid, amount in payments_by_day.get(day, ()):
+                received_cum[pid] = received_cum.get(pid, 0) + amount
+
+            as_of = day_dt + timedelta(days=1) - timedelta(seconds=1)
+            active = 0
+            expected = 0
+            for pid, (admitted, discharged, is_discharged) in spans.items():
+                if admitted and admitted > day:
+                    continue
+                if is_discharged and (discharged is None or discharged <= day):
+                    continue
+                active += 1
+                p = patients[pid]
+                try:
+                    fee = calculate_prorated_fee(p.get('monthlyFee', '0') or '0', days_since_admission(p.get('admissionDate'), as_of))
+                    laundry = p.get('laundryAmount', 0) if p.get('laundryStatus', False) else 0
+                    balance = fee + canteen_cum.get(pid, 0) + laundry - received_cum.get(pid, 0)
+                    expected += max(0, balance)
+                except (ValueError, TypeError):
+                    pass
 
-@app.route('/api/patients', methods=['GET'])
+            cash = cash_by_day.get(day, {})
+            snapshots.append({
+                '_id': day,
+                'date': day_dt,
+                'totalPatients': undated + bisect.bisect_right(admitted_days, day),
+                'activePatients': active,
+                'admissions': admissions.get(day, 0),
+                'discharges': discharges.get(day, 0),
+                'admissionsThisMonth': month_admissions,
+                'dischargesThisMonth': month_discharges,
+                'totalExpectedBalance': expected,
+                'canteenSales': canteen_day_total.get(day, 0),
+                'totalCanteenSalesThisMonth': month_canteen,
+                'incoming': cash.get('incoming', 0),
+                'outgoing': cash.get('outgoing', 0),
+                'computed_at': now,
+            })
+        day_dt += timedelta(days=1)
+    return snapshots
+
+
+def run_kpi_backfill(start, end, overwrite=True, source='backfill'):
+    """Compute and store the KPI snapshots of [start, end). Existing days are kept unless overwrite."""
+    snapshots = compute_kpi_snapshots(start, end)
+    if not snapshots:
+        return {'start': start.strftime('%Y-%m-%d'), 'end': end.strftime('%Y-%m-%d'), 'days': 0, 'written': 0}
+    for doc in snapshots:
+        doc['source'] = source
+    if overwrite:
+        ops = [ReplaceOne({'_id': doc['_id']}, doc, upsert=True) for doc in snapshots]
+    else:
+        ops = [UpdateOne({'_id': doc['_id']}, {'$setOnInsert': doc}, upsert=True) for doc in snapshots]
+    result = mongo.db.kpi_snapshots.bulk_write(ops, ordered=False)
+    return {
+        'start': snapshots[0]['_id'],
+        'end': snapshots[-1]['_id'],
+        'days': len(snapshots),
+        'written': result.upserted_count + result.modified_count,
+    }
+
+
+def record_kpi_snapshots():
+    """Nightly: add the days since the last snapshot up to yesterday and refresh the last few."""
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = today - timedelta(days=KPI_REFRESH_DAYS)
+    last = mongo.db.kpi_snapshots.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+    if last is None:
+        start = today - timedelta(days=KPI_BACKFILL_DAYS)
+    elif datetime.strptime(last['_id'], '%Y-%m-%d') < start:
+        start = datetime.strptime(last['_id'], '%Y-%m-%d') + timedelta(days=1)
+    return run_kpi_backfill(start, today, overwrite=True, source='nightly')
+
+
+def kpi_range(args, default_days, max_days=KPI_MAX_RANGE_DAYS):
+    """(start, end) midnight datetimes from ?start=&end= (inclusive dates) or ?days=; raises ValueError."""
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    end = datetime.strptime(args['end'], '%Y-%m-%d') + timedelta(days=1) if args.get('end') else today
+    if args.get('start'):
+        start = datetime.strptime(args['start'], '%Y-%m-%d')
+    else:
+        start = end - timedelta(days=int(args.get('days') or default_days))
+    if start >= end:
+        raise ValueError("start must be before end")
+    if (end - start).days > max_days:
+        raise ValueError(f"Range is limited to {max_days} days")
+    return start, end
+
+
+@app.route('/api/kpi/trend', methods=['GET'])
 @login_required
-def get_patients():
-    if not check_db(): return jsonify([])
+def get_kpi_trend():
+    """Daily KPI snapshots for ?days=90 (default) or ?start=YYYY-MM-DD&end=YYYY-MM-DD; ?fields= narrows the KPIs."""
+    if not check_db(): return jsonify({"error": "Database error"}), 500
     try:
-        patients_cursor = mongo.db.patients.find()
-        
-        # Aggregate total canteen spending for all patients
-        canteen_totals_agg = list(mongo.db.canteen_sales.aggregate([
-            {'$match': {
-                '$or': [
-                    {'entry_type': {'$exists': False}},
-                    {'entry_type': {'$ne': 'other'}}
-                ]
-            }},
-            {'$group': {'_id': '$patient_id', 'total': {'$sum': '$amount'}}}
-        ]))
-        canteen_totals_map = {str(item['_id']): item['total'] for item in canteen_totals_agg}
-        
-        patients = []
-        for p in patients_cursor:
-            patient_id = str(p['_id'])
-            p['_id'] = patient_id
-            # Ensure monthlyFee is present for canteen view logic
-            p['monthlyFee'] = p.get('monthlyFee', '0')
-            p['photo1'] = p.get('photo1', '')
-            p['photo2'] = p.get('photo2', '')
-            p['photo3'] = p.get('photo3', '')
-            p['isDischarged'] = p.get('isDischarged', False)
-            p['dischargeDate'] = p.get('dischargeDate')
-            
-            # Include canteen spending as separate field
-            p['canteenSpent'] = canteen_totals_map.get(patient_id, 0)
-            
-            patients.append(p)
-        return jsonify(patients)
-    except Exception as e:
-        print(f"DB Fetch Error: {e}")
-        return jsonify([])
+        start, end = kpi_range(request.args, KPI_BACKFILL_DAYS)
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
 
-@app.route('/api/patients', methods=['POST'])
-@role_required(['Admin', 'Doctor']) # Only Admin/Doctor can admit
-def add_patient():
-    if not check_db(): return jsonify({"error": "Database error"}), 500
+    fields = [f for f in (request.args.get('fields') or '').split(',') if f in KPI_FIELDS] or list(KPI_FIELDS)
     try:
-        data = clean_input_data(request.json)
-        data['created_at'] = datetime.now()
-        data['notes'] = [] # General Notes (Legacy)
-        data['monthlyFee'] = data.get('monthlyFee', '0')
-        data['monthlyAllowance'] = data.get('monthlyAllowance', '3000') # Default allowance
-        data['receivedAmount'] = data.get('receivedAmount', '0')  # New field
+        last_day = (end - timedelta(days=1)).strftime('%Y-%m-%d')
+        cursor = mongo.db.kpi_snapshots.find(
+            {'_id': {'$gte': start.strftime('%Y-%m-%d'), '$lte': last_day}},
+            {field: 1 for field in fields}
+        ).sort('_id', 1)
+        days = [{'date': doc['_id'], **{field: doc.get(field, 0) for field in fields}} for doc in cursor]
+        return jsonify({
+            'start': start.strftime('%Y-%m-%d'),
+            'end': last_day,
+            'fields': fields,
+            'days': days
+        })
+    except Exception as e:
+        print(f"KPI Trend Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/kpi/backfill', methods=['POST'])
+@role_required(['Admin'])
+def backfill_kpis():
+    """
+    Rebuild KPI snapshots. Body: {"start": "YYYY-MM-DD", "end": "YYYY-MM-DD"} or {"days": 365}; "overwrite" defaults to true.
+    Limited to KPI_BACKFILL_HTTP_MAX_DAYS; use `flask --app app backfill-kpis DAYS` for longer ranges.
+    """
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    data = request.get_json(silent=True) or {}
+    try:
+        start, end = kpi_range(data, KPI_BACKFILL_DAYS, KPI_BACKFILL_HTTP_MAX_DAYS)
+    except ValueError as ve:
+        return jsonify({"error": f"Invalid data format: {str(ve)}"}), 400
+
+    try:
+        return jsonify(run_kpi_backfill(start, end, overwrite=data.get('overwrite', True) is not False))
+    except Exception as e:
+        print(f"KPI Backfill Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.cli.command('backfill-kpis')
+@click.argument('days', type=int, default=KPI_BACKFILL_DAYS)
+def backfill_kpis_command(days):
+    """Rebuild the KPI snapshots of the last DAYS days (flask --app app backfill-kpis 365)."""
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    result = run_kpi_backfill(today - timedelta(days=days), today)
+    print(f"Stored {result['days']} KPI snapshots ({result['start']} to {result['end']})")
+
+
+# --- BED-DAY CENSUS ---
+#
+# Occupancy, bed-days and length of stay for any date range, from the
+# admission and discharge dates of live and archived patients. Every stay
+# becomes a +1 event on its admission day and a -1 event on its discharge day;
+# the events are sorted once and a cumulative sum gives the census after each
+# event, so the occupancy of every day in the range is a binary search into
+# that array (O(n log n) in the number of stays, independent of range length).
+# A patient counts on the days from admission up to, not including, discharge.
+# Stays that cannot be placed (no admission date, discharged without a date)
+# are left out and counted in `skipped`.
+
+CENSUS_OPEN = 2 ** 62  # Discharge day of stays that are still open
+CENSUS_PERCENTILES = (25, 50, 75, 90, 95)
+
+
+def census_day(value):
+    """Day number (days since 1970-01-01) of an ISO date string or datetime; None if unusable."""
+    day = iso_day(value)
+    if day is None:
+        return None
+    try:
+        return (datetime.strptime(day, '%Y-%m-%d') - datetime(1970, 1, 1)).days
+    except ValueError:
+        return None
+
+
+def census_stays():
+    """(admitted, discharged, skipped): int64 day-number arrays of every placeable stay."""
+    import numpy as np
+
+    patients = {}
+    for doc in itertools.chain(
+        mongo.db.patients_archive.find({}, {'admissionDate': 1, 'dischargeDate': 1, 'isDischarged': 1, 'created_at': 1}),
+        mongo.db.patients.find({}, {'admissionDate': 1, 'dischargeDate': 1, 'isDischarged': 1, 'created_at': 1})
+    ):
+        patients[doc['_id']] = doc
+
+    admitted, discharged = [], []
+    skipped = {'noAdmissionDate': 0, 'noDischargeDate': 0, 'dischargedBeforeAdmission': 0}
+    for p in patients.values():
+        adm = census_day(p.get('admissionDate'))
+        if adm is None:
+            adm = census_day(p.get('created_at'))
+        if adm is None:
+            skipped['noAdmissionDate'] += 1
+            continue
+        dis = CENSUS_OPEN
+        if p.get('isDischarged'):
+            dis = census_day(p.get('dischargeDate'))
+            if dis is None:
+                skipped['noDischargeDate'] += 1
+                continue
+            if dis < adm:
+                skipped['dischargedBeforeAdmission'] += 1
+                continue
+        admitted.append(adm)
+        discharged.append(dis)
+    return np.array(admitted, dtype=np.int64), np.array(discharged, dtype=np.int64), skipped
+
+
+def census_occupancy(admitted, discharged, first_day, last_day):
+    """Midnight census of each day in [first_day, last_day) by an event sweep."""
+    import numpy as np
+
+    days = np.arange(first_day, last_day, dtype=np.int64)
+    touching = (admitted < last_day) & (discharged > first_day)
+    if not touching.any():
+        return np.zeros(len(days), dtype=np.int64)
+
+    # Stays admitted before the range are already in the census on its first day
+    positions = np.concatenate([np.maximum(admitted[touching], first_day), discharged[touching]])
+    deltas = np.concatenate([
+        np.ones(touching.sum(), dtype=np.int64), -np.ones(touching.sum(), dtype=np.int64)
+    ])
+    order = np.argsort(positions, kind='stable')
+    positions = positions[order]
+    running = np.cumsum(deltas[order])
+
+    # Census of a day = running total after the last event on or before it
+    last_event = np.searchsorted(positions, days, side='right') - 1
+    return np.where(last_event >= 0, running[np.maximum(last_event, 0)], 0)
+
+
+def los_summary(los):
+    """Count, mean and percentiles of an array of stay lengths in days."""
+    import numpy as np
+
+    if len(los) == 0:
+        return {'stays': 0, 'mean': None, 'max': None, **{f'p{q}': None for q in CENSUS_PERCENTILES}}
+    values = np.percentile(los, CENSUS_PERCENTILES)
+    return {
+        'stays': int(len(los)),
+        'mean': round(float(los.mean()), 1),
+        'max': int(los.max()),
+        **{f'p{q}': round(float(v), 1) for q, v in zip(CENSUS_PERCENTILES, values)},
+    }
+
+
+def compute_census(start, end):
+    """Daily occupancy, monthly bed-days and LOS for [start, end) (midnight datetimes)."""
+    import numpy as np
+
+    admitted, discharged, skipped = census_stays()
+    epoch = datetime(1970, 1, 1)
+    first_day, last_day = (start - epoch).days, (end - epoch).days
+    n_days = last_day - first_day
+
+    occupancy = census_occupancy(admitted, discharged, first_day, last_day)
+    in_range = (admitted >= first_day) & (admitted < last_day)
+    admissions = np.bincount(admitted[in_range] - first_day, minlength=n_days)
+    completed = (discharged >= first_day) & (discharged < last_day)
+    discharges = np.bincount(discharged[completed] - first_day, minlength=n_days)
+    los = discharged[completed] - admitted[completed]
+
+    dates = np.arange(first_day, last_day).astype('datetime64[D]')
+    months = dates.astype('datetime64[M]')
+    month_keys, month_starts = np.unique(months, return_index=True)
+    month_lengths = np.diff(np.append(month_starts, n_days))
+    bed_days = np.add.reduceat(occupancy, month_starts)
+    peaks = np.maximum.reduceat(occupancy, month_starts)
+    month_admissions = np.add.reduceat(admissions, month_starts)
+    month_discharges = np.add.reduceat(discharges, month_starts)
+    discharge_months = (discharged[completed].astype('datetime64[D]')).astype('datetime64[M]')
+
+    monthly = []
+    for i, month in enumerate(month_keys):
+        month_los = los_summary(los[discharge_months == month])
+        monthly.append({
+            'month': str(month),
+            'days': int(month_lengths[i]),
+            'bedDays': int(bed_days[i]),
+            'averageOccupancy': round(float(bed_days[i]) / int(month_lengths[i]), 1),
+            'peakOccupancy': int(peaks[i]),
+            'admissions': int(month_admissions[i]),
+            'discharges': int(month_discharges[i]),
+            'averageLos': month_los['mean'],
+            'medianLos': month_los['p50'],
+        })
+
+    return {
+        'start': start.strftime('%Y-%m-%d'),
+        'end': (end - timedelta(days=1)).strftime('%Y-%m-%d'),
+        'bedDays': int(occupancy.sum()),
+        'openStays': int(((admitted < last_day) & (discharged >= last_day)).sum()),
+        'los': los_summary(los),
+        'monthly': monthly,
+        'daily': [
+            {'date': str(day), 'occupancy': int(occ), 'admissions': int(adm), 'discharges': int(dis)}
+            for day, occ, adm, dis in zip(dates, occupancy, admissions, discharges)
+        ],
+        'skipped': skipped,
+    }
+
+
+@app.route('/api/census', methods=['GET'])
+@role_required(['Admin', 'Doctor'])
+def get_census():
+    """
+    Bed-day census for ?start=YYYY-MM-DD&end=YYYY-MM-DD (inclusive) or ?days=N
+    ending today; defaults to the last 12 months. ?daily=0 omits the per-day rows.
+    """
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    args = request.args.to_dict()
+    args.setdefault('end', datetime.now().strftime('%Y-%m-%d'))
+    if not args.get('start') and not args.get('days'):
+        args['start'] = _month_start_n_months_ago(11).strftime('%Y-%m-%d')
+    try:
+        start, end = kpi_range(args, 365)
+    except ValueError as ve:
+        return jsonify({"error": f"Invalid data format: {str(ve)}"}), 400
+
+    try:
+        census = compute_census(start, end)
+        if request.args.get('daily') == '0':
+            census.pop('daily')
+        return jsonify(census)
+    except ImportError as ie:
+        print(f"Census Error: {ie}")
+        return jsonify({"error": f"Missing '{ie.name}' library"}), 500
+    except Exception as e:
+        print(f"Census Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# --- PATIENT API UPDATES ---
+
+def canteen_spent_pipeline(patient_ids=None):
+    """Aggregation summing all-time canteen spending per patient (excluding 'other' adjustments)."""
+    match = {
+        '$or': [
+            {'entry_type': {'$exists': False}},
+            {'entry_type': {'$ne': 'other'}}
+        ]
+    }
+    if patient_ids is not None:
+        match['patient_id'] = {'$in': list(patient_ids)}
+    return [
+        {'$match': match},
+        {'$group': {'_id': '$patient_id', 'total': {'$sum': '$amount'}}}
+    ]
+
+def canteen_totals_map(canteen_totals_agg):
+    return {str(item['_id']): item['total'] for item in canteen_totals_agg}
+
+def canteen_spent_totals(patient_ids=None):
+    """Map patient id -> all-time canteen spending (excluding 'other' adjustments)."""
+    return canteen_totals_map(canteen_aggregate(canteen_spent_pipeline(patient_ids)))
+
+def serialize_patient(p, canteen_totals_map):
+    patient_id = str(p['_id'])
+    p['_id'] = patient_id
+    # Ensure monthlyFee is present for canteen view logic
+    p['monthlyFee'] = p.get('monthlyFee', '0')
+    p['photo1'] = p.get('photo1', '')
+    p['photo2'] = p.get('photo2', '')
+    p['photo3'] = p.get('photo3', '')
+    p['isDischarged'] = p.get('isDischarged', False)
+    p['dischargeDate'] = p.get('dischargeDate')
+
+    # Include canteen spending as separate field
+    p['canteenSpent'] = canteen_totals_map.get(patient_id, 0)
+    return p
+
+def patients_queries():
+    return {
+        'patients': ('patients', 'find', {'filter': {}}),
+        # Aggregate total canteen spending for all patients
+        'canteen_totals': canteen_read_spec('aggregate', {'pipeline': canteen_spent_pipeline()}),
+    }
+
+def build_patients_list(results):
+    totals = canteen_totals_map(results['canteen_totals'])
+    return [serialize_patient(p, totals) for p in results['patients']]
+
+@app.route('/api/patients', methods=['GET'])
+@login_required
+def get_patients():
+    if not check_db(): return jsonify([])
+    try:
+        results = run_read_queries(patients_queries())
+        return jsonify(build_patients_list(results))
+    except Exception as e:
+        print(f"DB Fetch Error: {e}")
+        return jsonify([])
+
+@app.route('/api/patients', methods=['POST'])
+@role_required(['Admin', 'Doctor']) # Only Admin/Doctor can admit
+def add_patient():
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    try:
+        data = clean_input_data(request.json)
+        data['created_at'] = datetime.now()
+        data['updated_at'] = data['created_at']
+        data['notes'] = [] # General Notes (Legacy)
+        data['monthlyFee'] = data.get('monthlyFee', '0')
+        data['monthlyAllowance'] = data.get('monthlyAllowance', '3000') # Default allowance
+        data['receivedAmount'] = data.get('receivedAmount', '0')  # New field
         data['drug'] = data.get('drug', '')  # New field
         data['photo1'] = data.get('photo1', '')
         data['photo2'] = data.get('photo2', '')
@@ -648,6 +2045,7 @@ def add_patient():
             data['laundryAmount'] = 0  # 0 if not enabled
         
         result = mongo.db.patients.insert_one(data)
+        bump_data_version('patients')
         return jsonify({"message": "Success", "id": str(result.inserted_id)}), 201
     except Exception as e:
         print(f"DB Insert Error: {e}")
@@ -672,7 +2070,9 @@ def update_patient(id):
                 if field in data:
                     del data[field]
         
+        data['updated_at'] = datetime.now()
         mongo.db.patients.update_one({'_id': ObjectId(id)}, {'$set': data})
+        bump_data_version('patients')
         return jsonify({"message": "Updated"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -687,6 +2087,8 @@ def delete_patient(id):
         if result.deleted_count > 0:
             # Also delete associated records (session notes and medical records)
             mongo.db.patient_records.delete_many({'patient_id': id})
+            record_tombstone('patients', id)
+            bump_data_version('patients')
             return jsonify({"message": "Patient deleted successfully"}), 200
         else:
             return jsonify({"error": "Patient not found"}), 404
@@ -749,6 +2151,413 @@ def get_patient_records(patient_id):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# --- LIVE EVENTS (SERVER-SENT EVENTS) ---
+#
+# A small in-process pub/sub: write routes publish deltas and every open
+# /api/events stream receives them. Subscribers only see events published
+# by the same process, so with several gunicorn workers a client only hears
+# about writes handled in its own worker. The SPA therefore keeps polling and
+# treats events as a hint to refresh sooner, never as the only update path.
+# Each open stream holds a worker thread, so streams are off unless LIVE_EVENTS=1
+# (gunicorn_conf.py sets it for its gthread workers; leave it off for sync
+# workers and serverless). Streams per process are capped at EVENT_MAX_STREAMS
+# and closed after EVENT_STREAM_MAX_SECONDS; the browser reconnects by itself.
+
+LIVE_EVENTS_ENABLED = os.environ.get('LIVE_EVENTS', '0') == '1'
+EVENT_MAX_STREAMS = int(os.environ.get('EVENT_MAX_STREAMS', '2'))
+EVENT_STREAM_MAX_SECONDS = int(os.environ.get('EVENT_STREAM_MAX_SECONDS', '300'))
+
+EVENT_CHANNEL_ROLES = {
+    'canteen': ['Admin', 'Canteen'],
+    'emergency': None,  # Any logged-in user
+}
+EVENT_QUEUE_SIZE = 100
+EVENT_HEARTBEAT_SECONDS = 15
+
+_event_subscribers = set()
+_event_lock = threading.Lock()
+
+
+def publish_event(channel, payload):
+    """Send an event to every subscriber of `channel` in this process. Never blocks."""
+    with _event_lock:
+        subscribers = list(_event_subscribers)
+    for channels, events in subscribers:
+        if channel not in channels:
+            continue
+        try:
+            events.put_nowait((channel, payload))
+        except queue.Full:
+            # A stalled client drops events rather than slowing writers down
+            pass
+
+
+def subscribe_events(channels):
+    """Register a subscriber, or return None when the process already holds EVENT_MAX_STREAMS."""
+    subscriber = (frozenset(channels), queue.Queue(maxsize=EVENT_QUEUE_SIZE))
+    with _event_lock:
+        if len(_event_subscribers) >= EVENT_MAX_STREAMS:
+            return None
+        _event_subscribers.add(subscriber)
+    return subscriber
+
+
+def unsubscribe_events(subscriber):
+    with _event_lock:
+        _event_subscribers.discard(subscriber)
+
+
+def publish_canteen_delta(patient_id, entry_date, delta, entry_type='daily'):
+    if delta:
+        publish_event('canteen', {
+            'patient_id': str(patient_id),
+            'date': entry_date.strftime('%Y-%m-%d'),
+            'delta': delta,
+            'entry_type': entry_type
+        })
+
+
+@app.route('/api/events', methods=['GET'])
+@login_required
+def stream_events():
+    """
+    Server-Sent Events stream of live deltas.
+    ?channels=canteen,emergency (default: every channel the role may see).
+    """
+    if not LIVE_EVENTS_ENABLED:
+        return jsonify({"error": "Live events are disabled"}), 404
+    role = session.get('role')
+    allowed = [
+        name for name, roles in EVENT_CHANNEL_ROLES.items()
+        if roles is None or role in roles
+    ]
+    requested = request.args.get('channels')
+    channels = [c for c in requested.split(',') if c in allowed] if requested else allowed
+    if not channels:
+        return jsonify({"error": "No permitted channels requested"}), 403
+
+    subscriber = subscribe_events(channels)
+    if subscriber is None:
+        response = jsonify({"error": "Too many live event streams"})
+        response.headers['Retry-After'] = str(EVENT_STREAM_MAX_SECONDS)
+        return response, 503
+
+    def generate():
+        deadline = time.time() + EVENT_STREAM_MAX_SECONDS
+        try:
+            yield f"retry: 5000\n: subscribed to {','.join(channels)}\n\n"
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return  # Free the thread; the browser reconnects after `retry`
+                try:
+                    channel, payload = subscriber[1].get(timeout=min(EVENT_HEARTBEAT_SECONDS, remaining))
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {channel}\ndata: {json.dumps(payload, default=str)}\n\n"
+        finally:
+            unsubscribe_events(subscriber)
+
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # The generator's finally never runs if the response is closed before the first chunk
+    response.call_on_close(lambda: unsubscribe_events(subscriber))
+    return response
+
+
+# --- CANTEEN STORAGE ---
+#
+# CANTEEN_STORAGE selects how canteen rows are stored:
+#   documents  - one document per sale/daily cell in `canteen_sales` (default)
+#   timeseries - `canteen_sales` is a MongoDB time-series collection with
+#                timeField `date` and metaField `patient_id` (MongoDB 7.0+,
+#                which allows the in-place edits of daily entries)
+#   buckets    - one document per patient per month in `canteen_sales_buckets`,
+#                holding a day-indexed `days` array of totals and the rows in
+#                `entries` (without their patient_id)
+# Every read goes through canteen_read_spec/canteen_find/canteen_aggregate, which
+# in bucket mode narrow the scan to the matching patient-months and unwind the
+# entries back into the row shape, so callers see identical rows in all modes.
+# `flask --app app migrate-canteen-storage` converts existing rows.
+
+CANTEEN_STORAGE = os.environ.get('CANTEEN_STORAGE', 'documents').lower()
+if CANTEEN_STORAGE not in ('documents', 'timeseries', 'buckets'):
+    raise ValueError("CANTEEN_STORAGE must be one of documents, timeseries, buckets")
+CANTEEN_BUCKETS = 'canteen_sales_buckets'
+CANTEEN_TIMESERIES_OPTIONS = {'timeField': 'date', 'metaField': 'patient_id', 'granularity': 'hours'}
+
+
+def canteen_bucket_month(date):
+    return datetime(date.year, date.month, 1)
+
+
+def canteen_bucket_prefilter(match):
+    """Bucket-level filter implied by a row filter (patient_id, date range and updated_at)."""
+    prefilter = {}
+    if 'patient_id' in match:
+        prefilter['patient_id'] = match['patient_id']
+    date = match.get('date')
+    if isinstance(date, datetime):
+        prefilter['month'] = canteen_bucket_month(date)
+    elif isinstance(date, dict):
+        month = {}
+        for op in ('$gte', '$gt'):
+            if isinstance(date.get(op), datetime):
+                month['$gte'] = canteen_bucket_month(date[op])
+        if isinstance(date.get('$lt'), datetime):
+            month['$lt'] = date['$lt']
+        if isinstance(date.get('$lte'), datetime):
+            month['$lte'] = date['$lte']
+        if month:
+            prefilter['month'] = month
+    updated = match.get('updated_at')
+    if isinstance(updated, dict) and '$gt' in updated:
+        # A bucket's updated_at is the latest of its entries'
+        prefilter['updated_at'] = {'$gt': updated['$gt']}
+    return prefilter
+
+
+def canteen_bucket_rows_pipeline(match):
+    return [
+        {'$match': canteen_bucket_prefilter(match)},
+        {'$unwind': '$entries'},
+        {'$addFields': {'entries.patient_id': '$patient_id'}},
+        {'$replaceRoot': {'newRoot': '$entries'}},
+    ]
+
+
+def canteen_rows_pipeline(pipeline):
+    """Prefix a row pipeline so it runs over the bucket collection."""
+    match = pipeline[0]['$match'] if pipeline and '$match' in pipeline[0] else {}
+    return canteen_bucket_rows_pipeline(match) + list(pipeline)
+
+
+def canteen_read_spec(kind, args):
+    """A (collection, kind, args) read-query spec over canteen rows, for the configured storage."""
+    if CANTEEN_STORAGE != 'buckets':
+        return ('canteen_sales', kind, args)
+    if kind == 'aggregate':
+        return (CANTEEN_BUCKETS, 'aggregate', {'pipeline': canteen_rows_pipeline(args['pipeline'])})
+    if kind != 'find':
+        raise ValueError(f"Unsupported canteen read: {kind}")
+    pipeline = [{'$match': args['filter']}]
+    if args.get('sort'):
+        pipeline.append({'$sort': dict(args['sort'])})
+    if args.get('limit'):
+        pipeline.append({'$limit': args['limit']})
+    if args.get('projection'):
+        pipeline.append({'$project': args['projection']})
+    return (CANTEEN_BUCKETS, 'aggregate', {'pipeline': canteen_rows_pipeline(pipeline)})
+
+
+def canteen_find(filter=None, projection=None, sort=None, limit=0):
+    """find() over canteen rows; `sort` is a list of (field, direction) pairs."""
+    if CANTEEN_STORAGE != 'buckets':
+        cursor = mongo.db.canteen_sales.find(filter or {}, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        return cursor.limit(limit) if limit else cursor
+    _, _, args = canteen_read_spec('find', {'filter': filter or {}, 'projection': projection, 'sort': sort, 'limit': limit})
+    return mongo.db[CANTEEN_BUCKETS].aggregate(args['pipeline'])
+
+
+def canteen_aggregate(pipeline):
+    collection, _, args = canteen_read_spec('aggregate', {'pipeline': pipeline})
+    return mongo.db[collection].aggregate(args['pipeline'])
+
+
+def canteen_union(pipeline):
+    """$unionWith stage adding canteen rows (after `pipeline`) to another collection's pipeline."""
+    collection, _, args = canteen_read_spec('aggregate', {'pipeline': pipeline})
+    return {'$unionWith': {'coll': collection, 'pipeline': args['pipeline']}}
+
+
+def canteen_patients_changed_since(since):
+    """Ids of patients with canteen rows written after `since`."""
+    if CANTEEN_STORAGE == 'buckets':
+        return mongo.db[CANTEEN_BUCKETS].distinct('patient_id', {'updated_at': {'$gt': since}})
+    return mongo.db.canteen_sales.distinct('patient_id', {'updated_at': {'$gt': since}})
+
+
+def canteen_daily_totals(start_date, end_date):
+    """{'YYYY-MM-DD': total} of canteen sales (archived days included) in [start_date, end_date)."""
+    if CANTEEN_STORAGE == 'buckets':
+        # Read the day-indexed totals instead of unwinding every entry
+        pipeline = [
+            {'$match': {'month': {'$gte': canteen_bucket_month(start_date), '$lt': end_date}}},
+            {'$unwind': {'path': '$days', 'includeArrayIndex': 'day'}},
+            {'$project': {'_id': 0, 'amount': '$days', 'date': {'$dateAdd': {
+                'startDate': '$month', 'unit': 'day', 'amount': '$day'
+            }}}},
+            {'$match': {'date': {'$gte': start_date, '$lt': end_date}, 'amount': {'$ne': 0}}},
+        ]
+        collection = CANTEEN_BUCKETS
+    else:
+        pipeline = [{'$match': {'date': {'$gte': start_date, '$lt': end_date}}}]
+        collection = 'canteen_sales'
+    pipeline += [
+        archived_canteen_daily_union(start_date, end_date),
+        {'$group': {
+            '_id': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$date'}},
+            'total': {'$sum': '$amount'}
+        }}
+    ]
+    return {item['_id']: item['total'] for item in mongo.db[collection].aggregate(pipeline)}
+
+
+def insert_canteen_entry(entry):
+    """Store one canteen row and return its id."""
+    if CANTEEN_STORAGE != 'buckets':
+        return mongo.db.canteen_sales.insert_one(entry).inserted_id
+
+    entry = dict(entry)
+    entry.setdefault('_id', ObjectId())
+    patient_id = entry.pop('patient_id')
+    key = {'patient_id': patient_id, 'month': canteen_bucket_month(entry['date'])}
+    try:
+        mongo.db[CANTEEN_BUCKETS].update_one(
+            key, {'$setOnInsert': {'days': [0] * 31, 'entries': [], 'total': 0}}, upsert=True
+        )
+    except DuplicateKeyError:
+        pass  # Created concurrently
+    mongo.db[CANTEEN_BUCKETS].update_one(key, {
+        '$push': {'entries': entry},
+        '$inc': {f"days.{entry['date'].day - 1}": entry['amount'], 'total': entry['amount']},
+        '$max': {'updated_at': entry.get('updated_at') or datetime.now()},
+    })
+    return entry['_id']
+
+
+def update_canteen_entry(existing, changes):
+    """Apply `changes` to an existing canteen row (as returned by canteen_find)."""
+    if CANTEEN_STORAGE != 'buckets':
+        mongo.db.canteen_sales.update_one({'_id': existing['_id']}, {'$set': changes})
+        return
+
+    update = {'$set': {f'entries.$.{k}': v for k, v in changes.items()}}
+    update['$max'] = {'updated_at': changes.get('updated_at') or datetime.now()}
+    if 'amount' in changes:
+        delta = changes['amount'] - existing.get('amount', 0)
+        update['$inc'] = {f"days.{existing['date'].day - 1}": delta, 'total': delta}
+    mongo.db[CANTEEN_BUCKETS].update_one(
+        {'patient_id': existing['patient_id'], 'month': canteen_bucket_month(existing['date']),
+         'entries._id': existing['_id']},
+        update
+    )
+
+
+def delete_canteen_entries(rows):
+    """Remove the given canteen rows (as returned by canteen_find)."""
+    if not rows:
+        return
+    if CANTEEN_STORAGE != 'buckets':
+        mongo.db.canteen_sales.delete_many({'_id': {'$in': [r['_id'] for r in rows]}})
+        return
+
+    by_bucket = {}
+    for r in rows:
+        by_bucket.setdefault((r['patient_id'], canteen_bucket_month(r['date'])), []).append(r)
+    for (patient_id, month), bucket_rows in by_bucket.items():
+        inc = {'total': -sum(r.get('amount', 0) for r in bucket_rows)}
+        for r in bucket_rows:
+            day_key = f"days.{r['date'].day - 1}"
+            inc[day_key] = inc.get(day_key, 0) - r.get('amount', 0)
+        mongo.db[CANTEEN_BUCKETS].update_one(
+            {'patient_id': patient_id, 'month': month},
+            {'$pull': {'entries': {'_id': {'$in': [r['_id'] for r in bucket_rows]}}}, '$inc': inc}
+        )
+    mongo.db[CANTEEN_BUCKETS].delete_many({'patient_id': {'$in': list({p for p, _ in by_bucket})}, 'entries': {'$size': 0}})
+
+
+def restore_canteen_entries(rows):
+    """Put previously removed canteen rows back, keeping their ids."""
+    if CANTEEN_STORAGE == 'timeseries':
+        # Time-series collections cannot upsert by _id: insert the rows not already back
+        existing = {r['_id'] for r in mongo.db.canteen_sales.find({'_id': {'$in': [r['_id'] for r in rows]}}, {'_id': 1})}
+        missing = [r for r in rows if r['_id'] not in existing]
+        if missing:
+            mongo.db.canteen_sales.insert_many(missing, ordered=False)
+        return
+    if CANTEEN_STORAGE != 'buckets':
+        if rows:
+            mongo.db.canteen_sales.bulk_write(
+                [ReplaceOne({'_id': r['_id']}, r, upsert=True) for r in rows], ordered=False
+            )
+        return
+    existing = {r['_id'] for r in canteen_find({'patient_id': {'$in': list({r['patient_id'] for r in rows})}}, {'_id': 1})}
+    for r in rows:
+        if r['_id'] not in existing:
+            insert_canteen_entry(r)
+
+
+def ensure_canteen_storage():
+    """Create the collection/indexes the configured canteen storage needs."""
+    if CANTEEN_STORAGE == 'buckets':
+        mongo.db[CANTEEN_BUCKETS].create_index([('patient_id', 1), ('month', 1)], unique=True)
+        mongo.db[CANTEEN_BUCKETS].create_index('month')
+        mongo.db[CANTEEN_BUCKETS].create_index('updated_at')
+        return
+    if CANTEEN_STORAGE == 'timeseries':
+        info = next(iter(mongo.db.list_collections(filter={'name': 'canteen_sales'})), None)
+        if info is None:
+            mongo.db.create_collection('canteen_sales', timeseries=CANTEEN_TIMESERIES_OPTIONS)
+        elif info.get('type') != 'timeseries':
+            print("canteen_sales is not a time-series collection; run `flask --app app migrate-canteen-storage`")
+        mongo.db.canteen_sales.create_index([('patient_id', 1), ('date', 1)])
+    mongo.db.canteen_sales.create_index('updated_at')
+
+
+@app.cli.command('migrate-canteen-storage')
+def migrate_canteen_storage_command():
+    """Convert canteen_sales rows to the storage selected by CANTEEN_STORAGE."""
+    if CANTEEN_STORAGE == 'documents':
+        print("CANTEEN_STORAGE is 'documents'; nothing to migrate.")
+        return
+
+    if CANTEEN_STORAGE == 'buckets':
+        ensure_canteen_storage()
+        buckets = {}
+        for row in mongo.db.canteen_sales.find({'date': {'$type': 'date'}}).sort([('patient_id', 1), ('date', 1)]):
+            key = (row['patient_id'], canteen_bucket_month(row['date']))
+            bucket = buckets.setdefault(key, {
+                'patient_id': key[0], 'month': key[1], 'days': [0] * 31, 'entries': [], 'total': 0,
+                'updated_at': row.get('updated_at') or row['date']
+            })
+            row.pop('patient_id')
+            bucket['entries'].append(row)
+            bucket['days'][row['date'].day - 1] += row.get('amount', 0)
+            bucket['total'] += row.get('amount', 0)
+            bucket['updated_at'] = max(bucket['updated_at'], row.get('updated_at') or row['date'])
+        if buckets:
+            mongo.db[CANTEEN_BUCKETS].bulk_write([
+                ReplaceOne({'patient_id': b['patient_id'], 'month': b['month']}, b, upsert=True)
+                for b in buckets.values()
+            ], ordered=False)
+        print(f"Wrote {len(buckets)} buckets. canteen_sales was left in place; drop it once verified.")
+        return
+
+    info = next(iter(mongo.db.list_collections(filter={'name': 'canteen_sales'})), None)
+    if info is not None and info.get('type') == 'timeseries':
+        print("canteen_sales is already a time-series collection.")
+        return
+    if info is not None:
+        mongo.db.canteen_sales.rename('canteen_sales_documents')
+    ensure_canteen_storage()
+    copied = 0
+    batch = []
+    for row in mongo.db.canteen_sales_documents.find({'date': {'$type': 'date'}}):
+        batch.append(row)
+        if len(batch) == 1000:
+            copied += len(mongo.db.canteen_sales.insert_many(batch).inserted_ids)
+            batch = []
+    if batch:
+        copied += len(mongo.db.canteen_sales.insert_many(batch).inserted_ids)
+    print(f"Copied {copied} rows into the time-series canteen_sales; the originals are in canteen_sales_documents.")
+
+
 # --- CANTEEN APIS ---
 
 @app.route('/api/canteen/sales', methods=['POST'])
@@ -769,27 +2578,29 @@ def record_canteen_sale():
             sale_date = datetime.fromisoformat(sale_date.replace('Z', '+00:00'))
         else:
             sale_date = datetime.now()
+
+        blocked = month_write_guard(sale_date.month, sale_date.year, CANTEEN_MONTH_REPORTS)
+        if blocked: return blocked
         
         sale = {
             'patient_id': ObjectId(data['patient_id']),
             'item': data['item'],
             'amount': data['amount'],
             'date': sale_date,
-            'recorded_by': session.get('username', 'Canteen Staff')
+            'recorded_by': session.get('username', 'Canteen Staff'),
+            'updated_at': datetime.now()
         }
-        result = mongo.db.canteen_sales.insert_one(sale)
-        return jsonify({"message": "Sale recorded", "id": str(result.inserted_id)}), 201
+        sale_id = insert_canteen_entry(sale)
+        bump_data_version('canteen_sales')
+        publish_canteen_delta(sale['patient_id'], sale_date, sale['amount'])
+        return jsonify({"message": "Sale recorded", "id": str(sale_id)}), 201
     except ValueError:
         return jsonify({"error": "Amount must be a number"}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/canteen/sales/breakdown', methods=['GET'])
-@role_required(['Admin', 'Canteen'])
-def get_canteen_breakdown():
-    if not check_db(): return jsonify({"error": "Database error"}), 500
-    
-    today = datetime.now()
+def compute_canteen_breakdown(today):
+    """Allowance, sales and remaining balance of every patient for the month of today."""
     start_of_month = today.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
     # Calculate days in current month
     if today.month == 12:
@@ -797,62 +2608,76 @@ def get_canteen_breakdown():
     else:
         next_month = today.replace(month=today.month + 1, day=1)
     days_in_month = (next_month - start_of_month).days
+
+    # 1. Fetch all patients with ID, Name, Allowance AND isDischarged
+    patients_cursor = mongo.db.patients.find({}, {
+        'name': 1, 'monthlyAllowance': 1, 'isDischarged': 1
+    })
     
-    try:
-        # 1. Fetch all patients with ID, Name, Allowance AND isDischarged
-        patients_cursor = mongo.db.patients.find({}, {
-            'name': 1, 'monthlyAllowance': 1, 'isDischarged': 1
-        })
-        
-        patients_map = {
-            str(p['_id']): {
-                'name': p['name'], 
-                'allowance': p.get('monthlyAllowance', '0'), 
-                'sales': 0,
-                'isDischarged': p.get('isDischarged', False)
-            } 
-            for p in patients_cursor
-        }
-        
-        # 2. Calculate monthly sales per patient
-        pipeline = [
-            {'$match': {'date': {'$gte': start_of_month}}},
-            {'$group': {'_id': '$patient_id', 'total_sales': {'$sum': '$amount'}}}
-        ]
-        sales_breakdown = list(mongo.db.canteen_sales.aggregate(pipeline))
-        
-        # 3. Merge data
-        for sale in sales_breakdown:
-            p_id = str(sale['_id'])
-            if p_id in patients_map:
-                patients_map[p_id]['sales'] = sale['total_sales']
-        
-        # Format output
-        breakdown_list = []
-        for p_id, data in patients_map.items():
-            try:
-                sales = data['sales']
-                monthly_allowance = int(data['allowance'].replace(',', ''))
-                # Calculate daily allowance
-                daily_allowance = monthly_allowance / days_in_month if days_in_month > 0 else 0
-                balance = monthly_allowance - sales
-            except ValueError:
-                sales = data['sales']
-                monthly_allowance = 0
-                daily_allowance = 0
-                balance = -sales
-                
-            breakdown_list.append({
-                'id': p_id,
-                'name': data['name'],
-                'monthlyAllowance': data['allowance'],
-                'dailyAllowance': round(daily_allowance, 2),
-                'monthlySales': sales,
-                'remainingBalance': balance,
-                'isDischarged': data['isDischarged']
-            })
+    patients_map = {
+        str(p['_id']): {
+            'name': p['name'], 
+            'allowance': p.get('monthlyAllowance', '0'), 
+            'sales': 0,
+            'isDischarged': p.get('isDischarged', False)
+        } 
+        for p in patients_cursor
+    }
+    
+    # 2. Calculate monthly sales per patient
+    pipeline = [
+        {'$match': {'date': {'$gte': start_of_month}}},
+        {'$group': {'_id': '$patient_id', 'total_sales': {'$sum': '$amount'}}}
+    ]
+    sales_breakdown = list(canteen_aggregate(pipeline))
+    
+    # 3. Merge data
+    for sale in sales_breakdown:
+        p_id = str(sale['_id'])
+        if p_id in patients_map:
+            patients_map[p_id]['sales'] = sale['total_sales']
+    
+    # Format output
+    breakdown_list = []
+    for p_id, data in patients_map.items():
+        try:
+            sales = data['sales']
+            monthly_allowance = int(data['allowance'].replace(',', ''))
+            # Calculate daily allowance
+            daily_allowance = monthly_allowance / days_in_month if days_in_month > 0 else 0
+            balance = monthly_allowance - sales
+        except ValueError:
+            sales = data['sales']
+            monthly_allowance = 0
+            daily_allowance = 0
+            balance = -sales
             
-        return jsonify(breakdown_list)
+        breakdown_list.append({
+            'id': p_id,
+            'name': data['name'],
+            'monthlyAllowance': data['allowance'],
+            'dailyAllowance': round(daily_allowance, 2),
+            'monthlySales': sales,
+            'remainingBalance': balance,
+            'isDischarged': data['isDischarged']
+        })
+    return breakdown_list
+
+
+def canteen_breakdown_report():
+    today = datetime.now()
+    return cached_report(
+        'canteen_breakdown', REPORT_CACHE_SOURCES['canteen_breakdown'], today.strftime('%Y-%m'),
+        lambda: compute_canteen_breakdown(today)
+    )
+
+
+@app.route('/api/canteen/sales/breakdown', methods=['GET'])
+@role_required(['Admin', 'Canteen'])
+def get_canteen_breakdown():
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    try:
+        return jsonify(canteen_breakdown_report())
     except Exception as e:
         print(f"Canteen Breakdown Error: {e}")
         return jsonify({"error": str(e)}), 500
@@ -890,7 +2715,7 @@ def get_daily_canteen_sheet():
                 'total': {'$sum': '$amount'}
             }}
         ]
-        daily_sales = {str(s['_id']): s for s in mongo.db.canteen_sales.aggregate(pipeline)}
+        daily_sales = {str(s['_id']): s for s in canteen_aggregate(pipeline)}
         
         # Build sheet
         sheet = []
@@ -928,7 +2753,7 @@ def get_canteen_sales_history():
             query['patient_id'] = ObjectId(patient_id)
         
         # Get sales with patient names
-        sales_cursor = mongo.db.canteen_sales.find(query).sort('date', -1).limit(100)
+        sales_cursor = canteen_find(query, sort=[('date', -1)], limit=100)
         
         sales_list = []
         for sale in sales_cursor:
@@ -950,173 +2775,217 @@ def get_canteen_sales_history():
         print(f"Sales History Error: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/canteen/monthly-table', methods=['GET'])
-@role_required(['Admin', 'Canteen'])
-def get_canteen_monthly_table():
-    """Get monthly canteen table data with daily columns"""
-    if not check_db(): return jsonify({"error": "Database error"}), 500
-    
-    try:
-        # Get month and year from query params, default to current month
-        month = int(request.args.get('month', datetime.now().month))
-        year = int(request.args.get('year', datetime.now().year))
-        
-        # Calculate start and end of requested month
-        start_of_month = datetime(year, month, 1, 0, 0, 0)
-        if month == 12:
-            end_of_month = datetime(year + 1, 1, 1, 0, 0, 0)
-        else:
-            end_of_month = datetime(year, month + 1, 1, 0, 0, 0)
-        
-        days_in_month = (end_of_month - start_of_month).days
-        
+def canteen_month_bounds(month, year):
+    # Calculate start and end of requested month
+    start_of_month = datetime(year, month, 1, 0, 0, 0)
+    if month == 12:
+        end_of_month = datetime(year + 1, 1, 1, 0, 0, 0)
+    else:
+        end_of_month = datetime(year, month + 1, 1, 0, 0, 0)
+    return start_of_month, end_of_month
+
+
+def canteen_table_base_queries(month, year):
+    """Patients and old-balance overrides; the sales queries depend on the patient ids."""
+    return {
         # Get all patients with their allowances
-        patients_list = list(mongo.db.patients.find({}, {
-            'name': 1,
-            'monthlyAllowance': 1,
-            'isDischarged': 1,
-            'admissionDate': 1
-        }).sort('name', 1))
-        
+        'patients': ('patients', 'find', {
+            'filter': {},
+            'projection': {'name': 1, 'monthlyAllowance': 1, 'isDischarged': 1, 'admissionDate': 1},
+            'sort': [('name', 1)],
+        }),
         # Get manual old balance overrides for this month/year
-        balance_overrides = {}
-        overrides_cursor = mongo.db.canteen_balance_overrides.find({
-            'month': month,
-            'year': year
-        })
-        for override in overrides_cursor:
-            balance_overrides[str(override['patient_id'])] = override['old_balance']
-        
-        if not patients_list:
-            return jsonify({'month': month, 'year': year, 'daysInMonth': days_in_month, 'patients': []})
-        
-        patient_ids = [p['_id'] for p in patients_list]
-        
-        def _safe_int(raw_val: object) -> int:
-            """Best-effort int conversion that strips non-digits."""
-            try:
-                cleaned = ''.join(ch for ch in str(raw_val or '0') if ch.isdigit() or ch == '-')
-                return int(cleaned) if cleaned not in ('', '-') else 0
-            except Exception:
-                return 0
-        
+        'overrides': ('canteen_balance_overrides', 'find', {'filter': {'month': month, 'year': year}}),
+    }
+
+
+def canteen_table_sales_queries(patient_ids, month, year):
+    """The five independent canteen_sales reads behind the monthly table."""
+    start_of_month, end_of_month = canteen_month_bounds(month, year)
+    not_other = {
+        '$or': [
+            {'entry_type': {'$exists': False}},
+            {'entry_type': {'$ne': 'other'}}
+        ]
+    }
+    return {
         # BATCH QUERY: Get all previous sales for all patients at once
-        previous_sales_agg = list(mongo.db.canteen_sales.aggregate([
-            {'$match': {
-                'patient_id': {'$in': patient_ids},
-                'date': {'$lt': start_of_month},
-                '$or': [
-                    {'entry_type': {'$exists': False}},
-                    {'entry_type': {'$ne': 'other'}}
-                ]
-            }},
+        'previous_sales': canteen_read_spec('aggregate', {'pipeline': [
+            {'$match': {'patient_id': {'$in': patient_ids}, 'date': {'$lt': start_of_month}, **not_other}},
             {'$group': {'_id': '$patient_id', 'total': {'$sum': '$amount'}}}
-        ]))
-        previous_sales_map = {str(item['_id']): item['total'] for item in previous_sales_agg}
-        
+        ]}),
         # BATCH QUERY: Get all previous adjustments
-        previous_adj_agg = list(mongo.db.canteen_sales.aggregate([
-            {'$match': {
-                'patient_id': {'$in': patient_ids},
-                'date': {'$lt': start_of_month},
-                'entry_type': 'other'
-            }},
+        'previous_adjustments': canteen_read_spec('aggregate', {'pipeline': [
+            {'$match': {'patient_id': {'$in': patient_ids}, 'date': {'$lt': start_of_month}, 'entry_type': 'other'}},
             {'$group': {'_id': '$patient_id', 'total': {'$sum': '$amount'}}}
-        ]))
-        previous_adj_map = {str(item['_id']): item['total'] for item in previous_adj_agg}
-        
+        ]}),
         # BATCH QUERY: Get all current month daily sales
-        current_month_sales = list(mongo.db.canteen_sales.find({
+        'current_month_sales': canteen_read_spec('find', {'filter': {
             'patient_id': {'$in': patient_ids},
             'date': {'$gte': start_of_month, '$lt': end_of_month},
-            '$or': [
-                {'entry_type': {'$exists': False}},
-                {'entry_type': {'$ne': 'other'}}
-            ]
-        }))
-        
+            **not_other
+        }}),
         # BATCH QUERY: Get all "other" entries for current month
-        other_entries = list(mongo.db.canteen_sales.find({
+        'other_entries': canteen_read_spec('find', {'filter': {
             'patient_id': {'$in': patient_ids},
             'date': {'$gte': start_of_month, '$lt': end_of_month},
             'entry_type': 'other'
-        }))
-        other_map = {str(item['patient_id']): item['amount'] for item in other_entries}
-        
+        }}),
         # BATCH QUERY: Get all-time totals for all patients
-        all_time_agg = list(mongo.db.canteen_sales.aggregate([
-            {'$match': {
-                'patient_id': {'$in': patient_ids},
-                '$or': [
-                    {'entry_type': {'$exists': False}},
-                    {'entry_type': {'$ne': 'other'}}
-                ]
-            }},
-            {'$group': {'_id': '$patient_id', 'total': {'$sum': '$amount'}}}
-        ]))
-        all_time_map = {str(item['_id']): item['total'] for item in all_time_agg}
+        'all_time': canteen_read_spec('aggregate', {'pipeline': canteen_spent_pipeline(patient_ids)}),
+    }
+
+
+def compute_canteen_monthly_table(month, year):
+    """Build the monthly canteen table (one row per patient, daily columns) for a month."""
+    with trace_span('canteen_table.base_queries'):
+        base = run_read_queries(canteen_table_base_queries(month, year))
+    sales = None
+    if base['patients']:
+        patient_ids = [p['_id'] for p in base['patients']]
+        with trace_span('canteen_table.sales_queries', {'canteen.patients': len(patient_ids)}):
+            sales = run_read_queries(canteen_table_sales_queries(patient_ids, month, year))
+    with trace_span('canteen_table.build'):
+        return build_canteen_monthly_table(month, year, base, sales)
+
+
+def build_canteen_monthly_table(month, year, base, sales):
+    """Assemble the monthly table from the base and sales query results."""
+    start_of_month, end_of_month = canteen_month_bounds(month, year)
+    days_in_month = (end_of_month - start_of_month).days
+    
+    patients_list = base['patients']
+    balance_overrides = {}
+    for override in base['overrides']:
+        balance_overrides[str(override['patient_id'])] = override['old_balance']
+    
+    if not patients_list:
+        return {'month': month, 'year': year, 'daysInMonth': days_in_month, 'patients': []}
+    
+    previous_sales_map = {str(item['_id']): item['total'] for item in sales['previous_sales']}
+    previous_adj_map = {str(item['_id']): item['total'] for item in sales['previous_adjustments']}
+    current_month_sales = sales['current_month_sales']
+    other_map = {str(item['patient_id']): item['amount'] for item in sales['other_entries']}
+    all_time_map = {str(item['_id']): item['total'] for item in sales['all_time']}
+    
+    patients_data = []
+
+    for patient in patients_list:
+        patient_id = patient['_id']
+        patient_id_str = str(patient_id)
+        patient_name = patient.get('name', 'Unknown')
+        monthly_allowance = _safe_int(patient.get('monthlyAllowance', 0))
+        is_discharged = patient.get('isDischarged', False)
         
-        patients_data = []
-
-        for patient in patients_list:
-            patient_id = patient['_id']
-            patient_id_str = str(patient_id)
-            patient_name = patient.get('name', 'Unknown')
-            monthly_allowance = _safe_int(patient.get('monthlyAllowance', 0))
-            is_discharged = patient.get('isDischarged', False)
-            
-            # Get data from batch queries
-            previous_sales_total = previous_sales_map.get(patient_id_str, 0)
-            previous_adjustments = previous_adj_map.get(patient_id_str, 0)
-            
-            # Old Balance = Sum of total canteen money used in all previous months since admission
-            # This is simply the total of all canteen sales before the current viewing month
-            calculated_balance = previous_sales_total
-            
-            # Check if there's a manual override for this patient's old balance
-            old_balance = balance_overrides.get(patient_id_str, calculated_balance)
-            has_override = patient_id_str in balance_overrides
-            
-            # Build daily entries from batch query results
-            daily_entries = {}
-            for sale in current_month_sales:
-                if str(sale['patient_id']) == patient_id_str:
-                    day = sale['date'].day
-                    amount = sale.get('amount', 0)
-                    if day in daily_entries:
-                        daily_entries[day] += amount
-                    else:
-                        daily_entries[day] = amount
-            
-            # Get "other" amount from batch query
-            other_amount = other_map.get(patient_id_str, 0)
-            
-            # Calculate Month Total (sum of daily entries + other)
-            month_total = sum(daily_entries.values()) + other_amount
-            
-            # Get all-time total from batch query
-            total_spent = all_time_map.get(patient_id_str, 0)
-            
-            patients_data.append({
-                'id': str(patient_id),
-                'name': patient_name,
-                'oldBalance': old_balance,
-                'calculatedBalance': calculated_balance,
-                'hasManualOverride': has_override,
-                'dailyEntries': daily_entries,
-                'other': other_amount,
-                'monthTotal': month_total,
-                'total': total_spent,
-                'isDischarged': is_discharged,
-                'exceedsBalance': month_total > old_balance
-            })
+        # Get data from batch queries
+        previous_sales_total = previous_sales_map.get(patient_id_str, 0)
+        previous_adjustments = previous_adj_map.get(patient_id_str, 0)
         
-        return jsonify({
-            'month': month,
-            'year': year,
-            'daysInMonth': days_in_month,
-            'patients': patients_data
+        # Old Balance = Sum of total canteen money used in all previous months since admission
+        # This is simply the total of all canteen sales before the current viewing month
+        calculated_balance = previous_sales_total
+        
+        # Check if there's a manual override for this patient's old balance
+        old_balance = balance_overrides.get(patient_id_str, calculated_balance)
+        has_override = patient_id_str in balance_overrides
+        
+        # Build daily entries from batch query results
+        daily_entries = {}
+        for sale in current_month_sales:
+            if str(sale['patient_id']) == patient_id_str:
+                day = sale['date'].day
+                amount = sale.get('amount', 0)
+                if day in daily_entries:
+                    daily_entries[day] += amount
+                else:
+                    daily_entries[day] = amount
+        
+        # Get "other" amount from batch query
+        other_amount = other_map.get(patient_id_str, 0)
+        
+        # Calculate Month Total (sum of daily entries + other)
+        month_total = sum(daily_entries.values()) + other_amount
+        
+        # Get all-time total from batch query
+        total_spent = all_time_map.get(patient_id_str, 0)
+        
+        patients_data.append({
+            'id': str(patient_id),
+            'name': patient_name,
+            'oldBalance': old_balance,
+            'calculatedBalance': calculated_balance,
+            'hasManualOverride': has_override,
+            'dailyEntries': daily_entries,
+            'other': other_amount,
+            'monthTotal': month_total,
+            'total': total_spent,
+            'isDischarged': is_discharged,
+            'exceedsBalance': month_total > old_balance
         })
+    
+    return {
+        'month': month,
+        'year': year,
+        'daysInMonth': days_in_month,
+        'patients': patients_data
+    }
+
+
+def canteen_monthly_table_rows(table):
+    """Flatten a monthly canteen table into (header, rows) for flat-file export."""
+    days = range(1, table['daysInMonth'] + 1)
+    header = ['Patient', 'Old Balance'] + [str(day) for day in days] + ['Other', 'Month Total', 'Total', 'Discharged']
+
+    def rows():
+        for p in table['patients']:
+            yield (
+                [p['name'], p['oldBalance']]
+                + [p['dailyEntries'].get(day, '') for day in days]
+                + [p['other'], p['monthTotal'], p['total'], 'Yes' if p['isDischarged'] else 'No']
+            )
+
+    return header, rows()
+
+
+@app.route('/api/canteen/monthly-table', methods=['GET'])
+@role_required(['Admin', 'Canteen'])
+def get_canteen_monthly_table():
+    """Get monthly canteen table data with daily columns"""
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    
+    try:
+        # Get month and year from query params, default to current month
+        month = int(request.args.get('month', datetime.now().month))
+        year = int(request.args.get('year', datetime.now().year))
+        
+        fmt = request.args.get('format', 'json').lower()
+        if fmt not in ('json', 'csv', 'parquet'):
+            return jsonify({"error": "Format must be one of json, csv, parquet"}), 400
+
+        table = closed_month_report('canteen_table', month, year)
+        if fmt == 'json':
+            if table is not None:
+                return jsonify(table)
+            return jsonify(single_flight(
+                f'canteen_monthly_table:{year}-{month:02d}',
+                lambda: compute_canteen_monthly_table(month, year)
+            ))
+
+        if table is None:
+            table = compute_canteen_monthly_table(month, year)
+        else:
+            # The snapshot is JSON, so its day keys are strings
+            for p in table['patients']:
+                p['dailyEntries'] = {int(day): amount for day, amount in p['dailyEntries'].items()}
+
+        header, rows = canteen_monthly_table_rows(table)
+        return flat_export_response(
+            fmt, header, rows, f"canteen_{year}_{month:02d}",
+            int_columns=tuple(c for c in header if c not in ('Patient', 'Discharged'))
+        )
+    except ImportError as ie:
+        print(f"Monthly Table Error: {ie}")
+        return jsonify({"error": f"Missing '{ie.name}' library"}), 500
     except Exception as e:
         print(f"Monthly Table Error: {e}")
         return jsonify({"error": str(e)}), 500
@@ -1143,6 +3012,9 @@ def save_canteen_old_balance():
         month = int(data.get('month'))
         year = int(data.get('year'))
         old_balance = int(data.get('old_balance', 0))
+
+        blocked = month_write_guard(month, year, ('canteen_table',))
+        if blocked: return blocked
         
         # Upsert the override
         mongo.db.canteen_balance_overrides.update_one(
@@ -1181,13 +3053,16 @@ def save_canteen_daily_entry():
         entry_date = datetime.fromisoformat(data['date'].replace('Z', '+00:00'))
         amount = int(data['amount'])
         entry_type = data['entry_type']  # 'daily' or 'other'
+
+        blocked = month_write_guard(entry_date.month, entry_date.year, CANTEEN_MONTH_REPORTS)
+        if blocked: return blocked
         
         # Check if entry already exists
-        existing_entry = mongo.db.canteen_sales.find_one({
+        existing_entry = next(iter(canteen_find({
             'patient_id': patient_id,
             'date': entry_date,
             'entry_type': entry_type
-        })
+        }, limit=1)), None)
         
         # Role-based permission check
         user_role = session.get('role')
@@ -1200,14 +3075,14 @@ def save_canteen_daily_entry():
                 return jsonify({"error": "Canteen staff cannot edit existing entries"}), 403
             elif user_role == 'Admin':
                 # Admin can edit
-                mongo.db.canteen_sales.update_one(
-                    {'_id': existing_entry['_id']},
-                    {'$set': {
-                        'amount': amount,
-                        'edited_by': username,
-                        'edited_at': datetime.now()
-                    }}
-                )
+                update_canteen_entry(existing_entry, {
+                    'amount': amount,
+                    'edited_by': username,
+                    'edited_at': datetime.now(),
+                    'updated_at': datetime.now()
+                })
+                bump_data_version('canteen_sales')
+                publish_canteen_delta(patient_id, entry_date, amount - existing_entry.get('amount', 0), entry_type)
                 return jsonify({"message": "Entry updated", "id": str(existing_entry['_id'])}), 200
         else:
             # New entry - both Admin and Canteen can add
@@ -1218,10 +3093,13 @@ def save_canteen_daily_entry():
                 'entry_type': entry_type,
                 'item': data.get('item', ''),  # Optional item description
                 'recorded_by': username,
-                'created_at': datetime.now()
+                'created_at': datetime.now(),
+                'updated_at': datetime.now()
             }
-            result = mongo.db.canteen_sales.insert_one(new_entry)
-            return jsonify({"message": "Entry recorded", "id": str(result.inserted_id)}), 201
+            entry_id = insert_canteen_entry(new_entry)
+            bump_data_version('canteen_sales')
+            publish_canteen_delta(patient_id, entry_date, amount, entry_type)
+            return jsonify({"message": "Entry recorded", "id": str(entry_id)}), 201
             
     except ValueError as ve:
         return jsonify({"error": f"Invalid data format: {str(ve)}"}), 400
@@ -1231,25 +3109,26 @@ def save_canteen_daily_entry():
 
 # --- EXPENSES APIs ---
 
-@app.route('/api/expenses', methods=['GET'])
+def serialize_expense(e):
+    return {
+        'id': str(e.get('_id')),
+        'type': e.get('type', 'outgoing'),
+        'amount': e.get('amount', 0),
+        'category': e.get('category', ''),
+        'note': e.get('note', ''),
+        'date': e.get('date').isoformat() if e.get('date') else '',
+        'recorded_by': e.get('recorded_by', ''),
+        'auto': False
+    }
+
+@app.route('/api/expenses', methods=['GET'])
 @login_required
 def list_expenses():
     if not check_db():
         return jsonify({"error": "Database error"}), 500
     try:
-        cursor = mongo.db.expenses.find().sort('date', -1)
-        expenses = []
-        for e in cursor:
-            expenses.append({
-                'id': str(e.get('_id')),
-                'type': e.get('type', 'outgoing'),
-                'amount': e.get('amount', 0),
-                'category': e.get('category', ''),
-                'note': e.get('note', ''),
-                'date': e.get('date').isoformat() if e.get('date') else '',
-                'recorded_by': e.get('recorded_by', ''),
-                'auto': False
-            })
+        cursor = mongo.db.expenses.find({}, {'screenshot': 0}).sort('date', -1)
+        expenses = [serialize_expense(e) for e in cursor]
 
         # Automated income entries (not stored, just surfaced)
         try:
@@ -1269,7 +3148,7 @@ def list_expenses():
                 {'$match': {'date': {'$gte': start_of_month}}},
                 {'$group': {'_id': None, 'total_sales': {'$sum': '$amount'}}}
             ]
-            sales_result = list(mongo.db.canteen_sales.aggregate(pipeline))
+            sales_result = list(canteen_aggregate(pipeline))
             total_canteen = sales_result[0]['total_sales'] if sales_result else 0
 
             today_iso = datetime.now().date().isoformat()
@@ -1323,10 +3202,15 @@ def add_expense():
         'note': data.get('note', ''),
         'date': datetime.fromisoformat(data.get('date')) if data.get('date') else datetime.now(),
         'recorded_by': session.get('username', 'System'),
-        'created_at': datetime.now()
+        'created_at': datetime.now(),
+        'updated_at': datetime.now()
     }
+    if is_payment_record(expense):
+        blocked = month_write_guard(expense['date'].month, expense['date'].year, ('payment_records',))
+        if blocked: return blocked
     try:
         result = mongo.db.expenses.insert_one(expense)
+        bump_data_version('expenses')
         return jsonify({"message": "Expense saved", "id": str(result.inserted_id)}), 201
     except Exception as e:
         print(f"Add expense error: {e}")
@@ -1339,8 +3223,15 @@ def delete_expense(id):
     if not check_db():
         return jsonify({"error": "Database error"}), 500
     try:
+        expense = mongo.db.expenses.find_one({'_id': ObjectId(id)}, {'type': 1, 'category': 1, 'date': 1})
+        if expense and is_payment_record(expense) and isinstance(expense.get('date'), datetime):
+            blocked = month_write_guard(expense['date'].month, expense['date'].year, ('payment_records',))
+            if blocked: return blocked
+
         result = mongo.db.expenses.delete_one({'_id': ObjectId(id)})
         if result.deleted_count:
+            record_tombstone('expenses', id)
+            bump_data_version('expenses')
             return jsonify({"message": "Expense deleted"})
         return jsonify({"error": "Expense not found"}), 404
     except Exception as e:
@@ -1383,7 +3274,205 @@ def expenses_summary():
         print(f"Expenses summary error: {e}")
         return jsonify({"error": str(e)}), 500
 
-# --- EXPORT ROUTE (No change, retained for functionality) ---
+# --- EXPORT ENGINE ---
+#
+# Exports stream rows straight from a projected Mongo cursor into an openpyxl
+# write-only workbook backed by a spooled temp file. Only one batch of
+# documents and one row are held in memory at a time, so memory stays flat
+# regardless of how many patients are exported.
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+EXPORT_BATCH_SIZE = 500
+EXPORT_SPOOL_MAX_BYTES = 8 * 1024 * 1024  # Spill to disk beyond 8 MB
+
+# Column order of the patient export
+PATIENT_EXPORT_FIELDS = [
+    'name', 'fatherName', 'admissionDate', 'idNo', 'age', 'cnic', 'contactNo',
+    'address', 'complaint', 'guardianName', 'relation', 'drugProblem',
+    'maritalStatus', 'prevAdmissions', 'monthlyFee', 'monthlyAllowance', 'created_at'
+]
+
+# Fields blanked out for non-admin users
+PATIENT_EXPORT_ADMIN_FIELDS = {
+    'idNo', 'cnic', 'contactNo', 'address', 'guardianName', 'relation',
+    'monthlyFee', 'monthlyAllowance'
+}
+
+
+def resolve_patient_export_fields(selected_fields):
+    """Return the export columns in order, honouring an optional field selection."""
+    if isinstance(selected_fields, list) and len(selected_fields) > 0:
+        valid_fields = [f for f in selected_fields if f in PATIENT_EXPORT_FIELDS]
+        if valid_fields:
+            return valid_fields
+    return list(PATIENT_EXPORT_FIELDS)
+
+
+def iter_patient_export_rows(fields, is_admin):
+    """Yield one list of cell values per patient, read from a projected cursor."""
+    projection = {f: 1 for f in fields}
+    cursor = mongo.db.patients.find({}, projection, batch_size=EXPORT_BATCH_SIZE)
+    for p in cursor:
+        yield [
+            '' if (f in PATIENT_EXPORT_ADMIN_FIELDS and not is_admin) else p.get(f, '')
+            for f in fields
+        ]
+
+
+def apply_a4_page_setup(worksheet, orientation='portrait', side_margin=0.75):
+    """Configure A4 printing: fit to width, centered, with the given side margins."""
+    worksheet.page_setup.paperSize = 9  # A4
+    worksheet.page_setup.orientation = orientation
+    worksheet.page_setup.fitToWidth = 1
+    worksheet.page_setup.fitToHeight = 0
+    worksheet.print_options.horizontalCentered = True
+    worksheet.page_margins.left = side_margin
+    worksheet.page_margins.right = side_margin
+    worksheet.page_margins.top = 0.75
+    worksheet.page_margins.bottom = 0.75
+
+
+def write_xlsx_stream(header, rows, sheet_name, orientation='portrait', side_margin=0.75,
+                      total_rows=None, progress=None):
+    """
+    Stream rows into a write-only workbook and return a spooled file positioned at 0.
+
+    Returns None when `rows` yields nothing, so callers can decide how to
+    report an empty export. If `progress` and `total_rows` are given,
+    `progress(fraction)` is called once per batch of rows.
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(title=sheet_name)
+    # Page setup must be in place before the first row is flushed
+    apply_a4_page_setup(worksheet, orientation, side_margin)
+
+    row_count = 0
+    with trace_span('xlsx.write_rows', {'export.sheet': sheet_name}) as span:
+        for row in rows:
+            if row_count == 0:
+                worksheet.append(header)
+            worksheet.append(row)
+            row_count += 1
+            if progress and total_rows and row_count % EXPORT_BATCH_SIZE == 0:
+                progress(min(row_count / total_rows, 1.0))
+        if span is not None:
+            span.attributes['export.rows'] = row_count
+
+    if row_count == 0:
+        workbook.close()
+        return None
+
+    output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+    with trace_span('xlsx.save', {'export.sheet': sheet_name}):
+        workbook.save(output)
+    output.seek(0)
+    return output
+
+
+EXPORT_FORMATS = ('xlsx', 'csv', 'parquet')
+PARQUET_MIMETYPE = 'application/vnd.apache.parquet'
+
+
+def iter_csv_chunks(header, rows, chunk_rows=EXPORT_BATCH_SIZE):
+    """Yield CSV text in chunks of `chunk_rows` rows, header first."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for row_count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if row_count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _parquet_int(value):
+    try:
+        return int(str(value).replace(',', ''))
+    except (ValueError, TypeError):
+        return None
+
+
+def _parquet_str(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def write_parquet_stream(header, rows, int_columns=(), row_group_size=EXPORT_BATCH_SIZE):
+    """
+    Write rows to a Parquet file one row group at a time and return a spooled
+    file positioned at 0. Columns in `int_columns` are int64, the rest strings.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(col, pa.int64() if col in int_columns else pa.string()) for col in header])
+    converters = [_parquet_int if col in int_columns else _parquet_str for col in header]
+
+    def to_table(batch):
+        columns = [[convert(row[i]) for row in batch] for i, convert in enumerate(converters)]
+        return pa.Table.from_arrays([pa.array(c, type=f.type) for c, f in zip(columns, schema)], schema=schema)
+
+    output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+    writer = pq.ParquetWriter(output, schema)
+    try:
+        with trace_span('parquet.write_row_groups'):
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == row_group_size:
+                    writer.write_table(to_table(batch))
+                    batch = []
+            if batch:
+                writer.write_table(to_table(batch))
+    finally:
+        writer.close()
+    output.seek(0)
+    return output
+
+
+def flat_export_response(fmt, header, rows, basename, int_columns=()):
+    """Serve rows as a CSV streamed in chunks, or as a Parquet file written in row groups."""
+    if fmt == 'csv':
+        return Response(
+            stream_with_context(iter_csv_chunks(header, rows)),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename="{basename}.csv"'}
+        )
+    output = write_parquet_stream(header, rows, int_columns=int_columns)
+    return send_file(
+        output,
+        mimetype=PARQUET_MIMETYPE,
+        as_attachment=True,
+        download_name=f"{basename}.parquet"
+    )
+
+
+def build_patients_export(fields, is_admin, progress=None):
+    """Build the patients workbook. Returns (file, download_name) or None if there are no patients."""
+    total_rows = mongo.db.patients.estimated_document_count() if progress else None
+    output = write_xlsx_stream(
+        fields,
+        iter_patient_export_rows(fields, is_admin),
+        'Patients',
+        orientation='landscape',
+        side_margin=0.5,
+        total_rows=total_rows,
+        progress=progress
+    )
+    if output is None:
+        return None
+    return output, 'patients_export.xlsx'
+
+
+# --- EXPORT ROUTE ---
 
 @app.route('/api/export', methods=['POST'])
 @role_required(['Admin', 'Doctor', 'Psychologist'])
@@ -1391,82 +3480,34 @@ def export_patients():
     if not check_db(): return jsonify({"error": "Database error"}), 500
     try:
         req_data = request.get_json() or {}
-        selected_fields = req_data.get('fields', 'all')
-        current_user = session.get('user') or {}
-        is_admin = current_user.get('role') == 'Admin'
-        print(f"Export request from user: {current_user.get('username')}, is_admin: {is_admin}")
-        
-        cursor = mongo.db.patients.find()
-        patients_list = list(cursor)
-        print(f"Found {len(patients_list)} patients")
-        
-        if not patients_list:
+        fields = resolve_patient_export_fields(req_data.get('fields', 'all'))
+        fmt = str(req_data.get('format') or 'xlsx').lower()
+        if fmt not in EXPORT_FORMATS:
+            return jsonify({"error": f"Format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+        is_admin = session.get('role') == 'Admin'
+        print(f"Export request from user: {session.get('username')}, is_admin: {is_admin}")
+
+        if fmt != 'xlsx':
+            rows = iter_patient_export_rows(fields, is_admin)
+            first_row = next(rows, None)
+            if first_row is None:
+                return jsonify({"error": "No patients found"}), 404
+            return flat_export_response(fmt, fields, itertools.chain([first_row], rows), 'patients_export')
+
+        built = build_patients_export(fields, is_admin)
+        if built is None:
             return jsonify({"error": "No patients found"}), 404
 
-        # Prepare Data (Ensure new fields are included)
-        export_data = []
-        for p in patients_list:
-            # Convert ObjectId to string
-            patient_id = str(p.get('_id', '')) if '_id' in p else ''
-            
-            row = {
-                'name': p.get('name', ''),
-                'fatherName': p.get('fatherName', ''),
-                'admissionDate': p.get('admissionDate', ''),
-                'idNo': p.get('idNo', '') if is_admin else '',
-                'age': p.get('age', ''),
-                'cnic': p.get('cnic', '') if is_admin else '',
-                'contactNo': p.get('contactNo', '') if is_admin else '',
-                'address': p.get('address', '') if is_admin else '',
-                'complaint': p.get('complaint', ''),
-                'guardianName': p.get('guardianName', '') if is_admin else '',
-                'relation': p.get('relation', '') if is_admin else '',
-                'drugProblem': p.get('drugProblem', ''),
-                'maritalStatus': p.get('maritalStatus', ''),
-                'prevAdmissions': p.get('prevAdmissions', ''),
-                'monthlyFee': p.get('monthlyFee', '') if is_admin else '',
-                'monthlyAllowance': p.get('monthlyAllowance', '') if is_admin else '',
-                'created_at': p.get('created_at', '')
-            }
-            export_data.append(row)
-
-        print(f"Prepared {len(export_data)} rows for export")
-        df = pd.DataFrame(export_data)
-        print(f"Created DataFrame with columns: {list(df.columns)}")
-
-        if isinstance(selected_fields, list) and len(selected_fields) > 0:
-            valid_fields = [f for f in selected_fields if f in df.columns]
-            if valid_fields:
-                df = df[valid_fields]
-
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Patients')
-            
-            # Configure A4 page setup
-            worksheet = writer.sheets['Patients']
-            worksheet.page_setup.paperSize = 9  # A4
-            worksheet.page_setup.orientation = 'landscape'
-            worksheet.page_setup.fitToWidth = 1
-            worksheet.page_setup.fitToHeight = 0
-            worksheet.print_options.horizontalCentered = True
-            worksheet.page_margins.left = 0.5
-            worksheet.page_margins.right = 0.5
-            worksheet.page_margins.top = 0.75
-            worksheet.page_margins.bottom = 0.75
-        
-        output.seek(0)
-        print("Excel file created successfully")
-        
+        output, filename = built
         return send_file(
-            output, 
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            output,
+            mimetype=XLSX_MIMETYPE,
             as_attachment=True,
-            download_name='patients_export.xlsx'
+            download_name=filename
         )
     except ImportError as ie:
         print(f"ImportError in export: {ie}")
-        return jsonify({"error": "Missing 'openpyxl' library"}), 500
+        return jsonify({"error": f"Missing '{ie.name or 'openpyxl'}' library"}), 500
     except Exception as e:
         print(f"Error in export: {type(e).__name__}: {str(e)}")
         import traceback
@@ -1476,68 +3517,69 @@ def export_patients():
 
 # --- NEW ACCOUNTS ROUTE (ADMIN ONLY) ---
 
-@app.route('/api/accounts/summary', methods=['GET'])
-@role_required(['Admin'])
-def get_accounts_summary():
-    if not check_db(): return jsonify({"error": "Database error"}), 500
-    try:
-        from datetime import datetime
-        
+def accounts_summary_queries():
+    return {
         # Get all patients - Added 'isDischarged' to projection
-        patients = list(mongo.db.patients.find({}, {
+        'patients': ('patients', 'find', {'filter': {}, 'projection': {
             'name': 1, 'fatherName': 1, 'admissionDate': 1, 
             'monthlyFee': 1, 'address': 1, 'age': 1,
             'laundryStatus': 1, 'laundryAmount': 1, 'receivedAmount': 1,
             'isDischarged': 1
-        }))
-        
+        }}),
         # Get total canteen sales per patient
-        pipeline = [
+        'sales': canteen_read_spec('aggregate', {'pipeline': [
             {'$group': {'_id': '$patient_id', 'total_sales': {'$sum': '$amount'}}}
-        ]
-        sales_data = list(mongo.db.canteen_sales.aggregate(pipeline))
-        sales_map = {str(s['_id']): s['total_sales'] for s in sales_data}
+        ]}),
+    }
 
-        summary = []
-        for p in patients:
-            pid = str(p['_id'])
-            
-            # Calculate days elapsed from admission date
-            admission_date = p.get('admissionDate')
-            days_elapsed = 0
-            if admission_date:
-                try:
-                    if isinstance(admission_date, str):
-                        admission_dt = datetime.fromisoformat(admission_date.replace('Z', '+00:00'))
-                    else:
-                        admission_dt = admission_date
-                    days_diff = (datetime.now() - admission_dt).days
-                    days_elapsed = max(0, days_diff)
-                except:
-                    days_elapsed = 0
-            
-            # Get monthly fee and calculate prorated fee
-            monthly_fee = p.get('monthlyFee', '0')
-            calculated_fee = calculate_prorated_fee(monthly_fee, days_elapsed)
-            
-            summary.append({
-                'id': pid,
-                'name': p.get('name', ''),
-                'fatherName': p.get('fatherName', ''),
-                'age': p.get('age', ''),
-                'area': p.get('address', ''), 
-                'admissionDate': p.get('admissionDate', ''),
-                'monthlyFee': monthly_fee,
-                'calculatedFee': calculated_fee,  # NEW: Prorated fee
-                'daysElapsed': days_elapsed,  # NEW: Days elapsed for reference
-                'canteenTotal': sales_map.get(pid, 0),
-                'laundryStatus': p.get('laundryStatus', False),
-                'laundryAmount': p.get('laundryAmount', 0),
-                'receivedAmount': p.get('receivedAmount', '0'),
-                'isDischarged': p.get('isDischarged', False) # <--- NEW: Return discharge status
-            })
+
+def build_accounts_summary(results):
+    sales_map = {str(s['_id']): s['total_sales'] for s in results['sales']}
+
+    summary = []
+    for p in results['patients']:
+        pid = str(p['_id'])
+        
+        # Calculate days elapsed from admission date
+        days_elapsed = days_since_admission(p.get('admissionDate'))
+        
+        # Get monthly fee and calculate prorated fee
+        monthly_fee = p.get('monthlyFee', '0')
+        calculated_fee = calculate_prorated_fee(monthly_fee, days_elapsed)
         
-        return jsonify(summary)
+        summary.append({
+            'id': pid,
+            'name': p.get('name', ''),
+            'fatherName': p.get('fatherName', ''),
+            'age': p.get('age', ''),
+            'area': p.get('address', ''), 
+            'admissionDate': p.get('admissionDate', ''),
+            'monthlyFee': monthly_fee,
+            'calculatedFee': calculated_fee,  # NEW: Prorated fee
+            'daysElapsed': days_elapsed,  # NEW: Days elapsed for reference
+            'canteenTotal': sales_map.get(pid, 0),
+            'laundryStatus': p.get('laundryStatus', False),
+            'laundryAmount': p.get('laundryAmount', 0),
+            'receivedAmount': p.get('receivedAmount', '0'),
+            'isDischarged': p.get('isDischarged', False) # <--- NEW: Return discharge status
+        })
+    return summary
+
+
+def accounts_summary_report():
+    # Days elapsed (and so the prorated fee) changes daily
+    return cached_report(
+        'accounts_summary', REPORT_CACHE_SOURCES['accounts_summary'], datetime.now().strftime('%Y-%m-%d'),
+        lambda: build_accounts_summary(run_read_queries(accounts_summary_queries()))
+    )
+
+
+@app.route('/api/accounts/summary', methods=['GET'])
+@role_required(['Admin'])
+def get_accounts_summary():
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    try:
+        return jsonify(single_flight('accounts_summary', accounts_summary_report))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -1587,6 +3629,9 @@ def add_call_meeting_entry():
         return jsonify({"error": "Type must be Meeting or Call"}), 400
     
     try:
+        blocked = month_write_guard(int(data['month']), int(data['year']), ('call_meeting_summary',))
+        if blocked: return blocked
+
         entry = {
             'name': data['name'],
             'day': int(data['day']),
@@ -1626,6 +3671,11 @@ def delete_call_meeting_entry(id):
     if not check_db(): return jsonify({"error": "Database error"}), 500
     
     try:
+        entry = mongo.db.call_meeting_tracker.find_one({'_id': ObjectId(id)}, {'month': 1, 'year': 1})
+        if entry and entry.get('month') and entry.get('year'):
+            blocked = month_write_guard(int(entry['month']), int(entry['year']), ('call_meeting_summary',))
+            if blocked: return blocked
+
         result = mongo.db.call_meeting_tracker.delete_one({'_id': ObjectId(id)})
         if result.deleted_count > 0:
             return jsonify({"message": "Entry deleted"}), 200
@@ -1635,6 +3685,38 @@ def delete_call_meeting_entry(id):
         print(f"Call/Meeting Delete Error: {e}")
         return jsonify({"error": str(e)}), 500
 
+def compute_call_meeting_summary(month, year):
+    """Meeting/call totals for a month, overall and per person."""
+    # Get all records for the month
+    records_cursor = mongo.db.call_meeting_tracker.find({
+        'year': year,
+        'month': month
+    })
+
+    # Count tick / cross
+    tick_count = 0
+    cross_count = 0
+    by_person = {}
+
+    for r in records_cursor:
+        record_status = (r.get('status') or r.get('type') or 'Meeting')
+        record_status = record_status.capitalize()
+        is_meeting = record_status == 'Meeting'
+        tick_count += 1 if is_meeting else 0
+        cross_count += 0 if is_meeting else 1
+
+        person = r.get('name', 'Unknown')
+        if person not in by_person:
+            by_person[person] = {'Meeting': 0, 'Call': 0}
+        by_person[person]['Meeting'] = by_person[person].get('Meeting', 0) + (1 if is_meeting else 0)
+        by_person[person]['Call'] = by_person[person].get('Call', 0) + (0 if is_meeting else 1)
+
+    return {
+        'totalMeetings': tick_count,
+        'totalCalls': cross_count,
+        'byPerson': by_person
+    }
+
 @app.route('/api/call_meeting_tracker/summary/<int:month>/<int:year>', methods=['GET'])
 @login_required
 def get_call_meeting_summary(month, year):
@@ -1642,35 +3724,8 @@ def get_call_meeting_summary(month, year):
     if not check_db(): return jsonify({"error": "Database error"}), 500
     
     try:
-        # Get all records for the month
-        records_cursor = mongo.db.call_meeting_tracker.find({
-            'year': year,
-            'month': month
-        })
-        
-        # Count tick / cross
-        tick_count = 0
-        cross_count = 0
-        by_person = {}
-        
-        for r in records_cursor:
-            record_status = (r.get('status') or r.get('type') or 'Meeting')
-            record_status = record_status.capitalize()
-            is_meeting = record_status == 'Meeting'
-            tick_count += 1 if is_meeting else 0
-            cross_count += 0 if is_meeting else 1
-            
-            person = r.get('name', 'Unknown')
-            if person not in by_person:
-                by_person[person] = {'Meeting': 0, 'Call': 0}
-            by_person[person]['Meeting'] = by_person[person].get('Meeting', 0) + (1 if is_meeting else 0)
-            by_person[person]['Call'] = by_person[person].get('Call', 0) + (0 if is_meeting else 1)
-        
-        return jsonify({
-            'totalMeetings': tick_count,
-            'totalCalls': cross_count,
-            'byPerson': by_person
-        })
+        snapshot = closed_month_report('call_meeting_summary', month, year)
+        return jsonify(snapshot if snapshot is not None else compute_call_meeting_summary(month, year))
     except Exception as e:
         print(f"Call/Meeting Summary Error: {e}")
         return jsonify({"error": str(e)}), 500
@@ -1678,6 +3733,17 @@ def get_call_meeting_summary(month, year):
 
 # --- UTILITY BILLS ROUTES ---
 
+def serialize_utility_bill(b):
+    return {
+        'id': str(b['_id']),
+        'type': b.get('type', 'Other'),
+        'provider': b.get('provider', ''),
+        'amount': b.get('amount', 0),
+        'due_date': b.get('due_date'),
+        'ref_no': b.get('ref_no', ''),
+        'status': 'Unpaid'
+    }
+
 @app.route('/api/utility_bills', methods=['GET'])
 @role_required(['Admin'])
 def get_utility_bills():
@@ -1685,17 +3751,7 @@ def get_utility_bills():
     try:
         # Fetch all bills sorted by due date (soonest first)
         cursor = mongo.db.utility_bills.find().sort('due_date', 1)
-        bills = []
-        for b in cursor:
-            bills.append({
-                'id': str(b['_id']),
-                'type': b.get('type', 'Other'),
-                'provider': b.get('provider', ''),
-                'amount': b.get('amount', 0),
-                'due_date': b.get('due_date'),
-                'ref_no': b.get('ref_no', ''),
-                'status': 'Unpaid'
-            })
+        bills = [serialize_utility_bill(b) for b in cursor]
         return jsonify(bills)
     except Exception as e:
         print(f"Bills Fetch Error: {e}")
@@ -1713,7 +3769,8 @@ def add_utility_bill():
             'amount': int(data.get('amount', 0)),
             'due_date': data.get('due_date'),
             'ref_no': data.get('ref_no', ''),
-            'created_at': datetime.now()
+            'created_at': datetime.now(),
+            'updated_at': datetime.now()
         }
         result = mongo.db.utility_bills.insert_one(bill)
         return jsonify({"message": "Bill added", "id": str(result.inserted_id)}), 201
@@ -1736,17 +3793,34 @@ def pay_utility_bill(id):
                 'note': f"Paid bill for {bill.get('type')} (Ref: {bill.get('ref_no')})",
                 'date': datetime.now(),
                 'recorded_by': session.get('username', 'Admin'),
-                'created_at': datetime.now()
+                'created_at': datetime.now(),
+                'updated_at': datetime.now()
             })
+            bump_data_version('expenses')
             
         # Remove from bills collection
-        mongo.db.utility_bills.delete_one({'_id': ObjectId(id)})
+        result = mongo.db.utility_bills.delete_one({'_id': ObjectId(id)})
+        if result.deleted_count:
+            record_tombstone('utility_bills', id)
         return jsonify({"message": "Bill paid and removed"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 # --- TEAM / EMPLOYEE MANAGEMENT ROUTES ---
+def serialize_employee(e):
+    return {
+        'id': str(e['_id']),
+        'name': e.get('name', ''),
+        'designation': e.get('designation', ''),
+        'pay': e.get('pay', ''),
+        'advance': e.get('advance', ''),
+        'duty_timings': e.get('duty_timings', ''),
+        'date_of_joining': e.get('date_of_joining', ''),
+        'cnic': e.get('cnic', ''),
+        'phone': e.get('phone', '')
+    }
+
 @app.route('/api/employees', methods=['GET'])
 @role_required(['Admin'])
 def get_employees():
@@ -1754,19 +3828,7 @@ def get_employees():
     try:
         # Sort by name alphabetically
         cursor = mongo.db.employees.find().sort('name', 1)
-        employees = []
-        for e in cursor:
-            employees.append({
-                'id': str(e['_id']),
-                'name': e.get('name', ''),
-                'designation': e.get('designation', ''),
-                'pay': e.get('pay', ''),
-                'advance': e.get('advance', ''),
-                'duty_timings': e.get('duty_timings', ''),
-                'date_of_joining': e.get('date_of_joining', ''),
-                'cnic': e.get('cnic', ''),
-                'phone': e.get('phone', '')
-            })
+        employees = [serialize_employee(e) for e in cursor]
         return jsonify(employees)
     except Exception as e:
         print(f"Employee Fetch Error: {e}")
@@ -1787,7 +3849,8 @@ def add_employee():
             'date_of_joining': data.get('date_of_joining', ''),
             'cnic': data.get('cnic', ''),
             'phone': data.get('phone', ''),
-            'created_at': datetime.now()
+            'created_at': datetime.now(),
+            'updated_at': datetime.now()
         }
         result = mongo.db.employees.insert_one(employee)
         return jsonify({"message": "Employee added", "id": str(result.inserted_id)}), 201
@@ -1802,6 +3865,7 @@ def update_employee(id):
     # Remove _id from data if present to avoid immutable field error
     if '_id' in data: del data['_id']
     try:
+        data['updated_at'] = datetime.now()
         mongo.db.employees.update_one({'_id': ObjectId(id)}, {'$set': data})
         return jsonify({"message": "Employee updated"})
     except Exception as e:
@@ -1812,7 +3876,9 @@ def update_employee(id):
 def delete_employee(id):
     if not check_db(): return jsonify({"error": "Database error"}), 500
     try:
-        mongo.db.employees.delete_one({'_id': ObjectId(id)})
+        result = mongo.db.employees.delete_one({'_id': ObjectId(id)})
+        if result.deleted_count:
+            record_tombstone('employees', id)
         return jsonify({"message": "Employee deleted"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -1859,6 +3925,54 @@ def get_payment_records():
 #  OVERHEADS MANAGEMENT (Admin Only)
 # ============================================================
 
+def compute_overheads_month(month, year):
+    """Overhead entries keyed by date plus daily canteen totals for a month."""
+    # Fetch stored overhead entries for this month
+    overheads = list(mongo.db.overheads.find({
+        'month': month,
+        'year': year
+    }))
+    
+    # Convert to dict keyed by date
+    overhead_map = {}
+    for entry in overheads:
+        date_key = entry.get('date')
+        if date_key:
+            overhead_map[date_key] = {
+                '_id': str(entry['_id']),
+                'date': date_key,
+                'kitchen': entry.get('kitchen', 0),
+                'canteen_auto': entry.get('canteen_auto', 0),
+                'others': entry.get('others', 0),
+                'pay_advance': entry.get('pay_advance', 0),
+                'employee_names': entry.get('employee_names', ''),
+                'income': entry.get('income', 0),
+                'total_expense': entry.get('total_expense', 0)
+            }
+    
+    # Aggregate daily canteen sales totals
+    start_date = datetime(year, month, 1)
+    if month == 12:
+        end_date = datetime(year + 1, 1, 1)
+    else:
+        end_date = datetime(year, month + 1, 1)
+    
+    canteen_daily = canteen_daily_totals(start_date, end_date)
+    
+    # Calculate days in month
+    if month == 12:
+        next_month = datetime(year + 1, 1, 1)
+    else:
+        next_month = datetime(year, month + 1, 1)
+    days_in_month = (next_month - datetime(year, month, 1)).days
+    
+    return {
+        'overheads': overhead_map,
+        'canteen_daily': canteen_daily,
+        'days_in_month': days_in_month
+    }
+
+
 @app.route('/api/overheads/<int:month>/<int:year>', methods=['GET'])
 @role_required(['Admin'])
 def get_overheads(month, year):
@@ -1868,142 +3982,154 @@ def get_overheads(month, year):
     """
     if not check_db(): return jsonify({"error": "Database error"}), 500
     try:
-        # Fetch stored overhead entries for this month
-        overheads = list(mongo.db.overheads.find({
-            'month': month,
-            'year': year
-        }))
-        
-        # Convert to dict keyed by date
-        overhead_map = {}
-        for entry in overheads:
-            date_key = entry.get('date')
-            if date_key:
-                overhead_map[date_key] = {
-                    '_id': str(entry['_id']),
-                    'date': date_key,
-                    'kitchen': entry.get('kitchen', 0),
-                    'canteen_auto': entry.get('canteen_auto', 0),
-                    'others': entry.get('others', 0),
-                    'pay_advance': entry.get('pay_advance', 0),
-                    'employee_names': entry.get('employee_names', ''),
-                    'income': entry.get('income', 0),
-                    'total_expense': entry.get('total_expense', 0)
-                }
-        
-        # Aggregate daily canteen sales totals
-        start_date = datetime(year, month, 1)
-        if month == 12:
-            end_date = datetime(year + 1, 1, 1)
-        else:
-            end_date = datetime(year, month + 1, 1)
-        
-        canteen_aggregation = mongo.db.canteen_sales.aggregate([
-            {
-                '$match': {
-                    'date': {
-                        '$gte': start_date,
-                        '$lt': end_date
-                    }
-                }
-            },
-            {
-                '$group': {
-                    '_id': {
-                        '$dateToString': {
-                            'format': '%Y-%m-%d',
-                            'date': '$date'
-                        }
-                    },
-                    'total': {'$sum': '$amount'}
-                }
-            }
-        ])
-        
-        canteen_daily = {item['_id']: item['total'] for item in canteen_aggregation}
-        
-        # Calculate days in month
-        if month == 12:
-            next_month = datetime(year + 1, 1, 1)
-        else:
-            next_month = datetime(year, month + 1, 1)
-        days_in_month = (next_month - datetime(year, month, 1)).days
-        
-        return jsonify({
-            'overheads': overhead_map,
-            'canteen_daily': canteen_daily,
-            'days_in_month': days_in_month
-        })
+        snapshot = closed_month_report('overheads', month, year)
+        return jsonify(snapshot if snapshot is not None else compute_overheads_month(month, year))
     except Exception as e:
         print(f"Get Overheads Error: {e}")
         return jsonify({"error": str(e)}), 500
 
 
-@app.route('/api/overheads/annual/<int:year>', methods=['GET'])
-@role_required(['Admin'])
-def get_overheads_annual(year):
+def _to_double(field):
+    """Aggregation expression: numeric value of a field, 0 when missing or unparseable."""
+    return {'$convert': {'input': field, 'to': 'double', 'onError': 0, 'onNull': 0}}
+
+
+def compute_overheads_annual(year):
     """
     Aggregate total income, expense, and profit for a full year,
     including canteen sales from canteen_sales collection.
+    Also returns a per-month breakdown, all from a single aggregation.
     """
-    if not check_db(): return jsonify({"error": "Database error"}), 500
-    try:
-        # Aggregate canteen sales for the entire year
-        start_date = datetime(year, 1, 1)
-        end_date = datetime(year + 1, 1, 1)
-        
-        canteen_aggregation = mongo.db.canteen_sales.aggregate([
-            {
-                '$match': {
-                    'date': {
-                        '$gte': start_date,
-                        '$lt': end_date
-                    }
-                }
-            },
-            {
-                '$group': {
+    start_date = datetime(year, 1, 1)
+    end_date = datetime(year + 1, 1, 1)
+
+    # Overhead entries and canteen sales are projected onto one shape
+    # (month, income, other_expense, canteen) and summed server-side.
+    # canteen_auto is excluded from other_expense to avoid double-counting.
+    # Archived patients' canteen sales come from the pre-summed days.
+    canteen_projection = {
+        '_id': 0,
+        'month': {'$month': '$date'},
+        'income': {'$literal': 0},
+        'other_expense': {'$literal': 0},
+        'canteen': '$amount'
+    }
+    pipeline = [
+        {'$match': {'year': year}},
+        {'$project': {
+            '_id': 0,
+            'month': {'$convert': {'input': '$month', 'to': 'int', 'onError': None, 'onNull': None}},
+            'income': _to_double('$income'),
+            'other_expense': {'$add': [
+                _to_double('$kitchen'), _to_double('$others'), _to_double('$pay_advance')
+            ]},
+            'canteen': {'$literal': 0}
+        }},
+        canteen_union([
+            {'$match': {'date': {'$gte': start_date, '$lt': end_date}}},
+            {'$project': canteen_projection}
+        ]),
+        archived_canteen_daily_union(start_date, end_date, canteen_projection),
+        {'$facet': {
+            'totals': [
+                {'$group': {
                     '_id': None,
-                    'total_canteen': {'$sum': '$amount'}
-                }
-            }
-        ])
-        
-        canteen_result = list(canteen_aggregation)
-        total_canteen = canteen_result[0]['total_canteen'] if canteen_result else 0
-        
-        # Aggregate overhead entries
-        entries = list(mongo.db.overheads.find({'year': year}))
-
-        total_income = 0.0
-        total_other_expense = 0.0
-
-        for entry in entries:
-            income = float(entry.get('income', 0))
-            # Sum kitchen, others, pay_advance (excluding canteen_auto to avoid double-counting)
-            kitchen = float(entry.get('kitchen', 0))
-            others = float(entry.get('others', 0))
-            pay_advance = float(entry.get('pay_advance', 0))
-            
-            total_income += income
-            total_other_expense += (kitchen + others + pay_advance)
+                    'income': {'$sum': '$income'},
+                    'other_expense': {'$sum': '$other_expense'},
+                    'canteen': {'$sum': '$canteen'}
+                }}
+            ],
+            'monthly': [
+                {'$group': {
+                    '_id': '$month',
+                    'income': {'$sum': '$income'},
+                    'other_expense': {'$sum': '$other_expense'},
+                    'canteen': {'$sum': '$canteen'}
+                }}
+            ]
+        }}
+    ]
+    result = list(mongo.db.overheads.aggregate(pipeline))
+    facets = result[0] if result else {'totals': [], 'monthly': []}
+
+    totals = facets['totals'][0] if facets['totals'] else {}
+    total_income = float(totals.get('income', 0))
+    total_canteen = totals.get('canteen', 0)
+    # Total expense = other expenses + canteen sales
+    total_expense = float(totals.get('other_expense', 0)) + total_canteen
+    profit = total_income - total_expense
+
+    by_month = {item['_id']: item for item in facets['monthly']}
+    monthly = []
+    for month in range(1, 13):
+        item = by_month.get(month, {})
+        income = float(item.get('income', 0))
+        canteen = item.get('canteen', 0)
+        expense = float(item.get('other_expense', 0)) + canteen
+        monthly.append({
+            'month': month,
+            'income': income,
+            'expense': expense,
+            'canteen': canteen,
+            'profit': income - expense
+        })
 
-        # Total expense = other expenses + canteen sales
-        total_expense = total_other_expense + total_canteen
-        profit = total_income - total_expense
+    return {
+        'year': year,
+        'total_income': total_income,
+        'total_expense': total_expense,
+        'total_canteen': total_canteen,
+        'profit': profit,
+        'monthly': monthly
+    }
 
-        return jsonify({
-            'year': year,
-            'total_income': total_income,
-            'total_expense': total_expense,
-            'total_canteen': total_canteen,
-            'profit': profit
-        })
+
+def overheads_annual_report(year):
+    return cached_report(
+        f'overheads_annual:{year}', REPORT_CACHE_SOURCES['overheads_annual'], str(year),
+        lambda: compute_overheads_annual(year)
+    )
+
+
+@app.route('/api/overheads/annual/<int:year>', methods=['GET'])
+@role_required(['Admin'])
+def get_overheads_annual(year):
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    try:
+        return jsonify(overheads_annual_report(year))
     except Exception as e:
         print(f"Get Annual Overheads Error: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+def build_overhead_entry(data, date, month, year):
+    """Parse one day's overhead values into the stored document (raises ValueError on bad numbers)."""
+    # Parse values
+    kitchen = float(data.get('kitchen', 0))
+    others = float(data.get('others', 0))
+    pay_advance = float(data.get('pay_advance', 0))
+    income = float(data.get('income', 0))
+    employee_names = data.get('employee_names', '')
+    canteen_auto = float(data.get('canteen_auto', 0))
+
+    # Calculate total expense
+    total_expense = kitchen + canteen_auto + others + pay_advance
+
+    return {
+        'date': date,
+        'month': month,
+        'year': year,
+        'kitchen': kitchen,
+        'canteen_auto': canteen_auto,
+        'others': others,
+        'pay_advance': pay_advance,
+        'employee_names': employee_names,
+        'income': income,
+        'total_expense': total_expense,
+        'last_updated': datetime.now()
+    }
+
+
 @app.route('/api/overheads/entry', methods=['POST'])
 @role_required(['Admin'])
 def save_overhead_entry():
@@ -2016,31 +4142,11 @@ def save_overhead_entry():
         date = data.get('date')  # Format: YYYY-MM-DD
         month = data.get('month')
         year = data.get('year')
+
+        blocked = month_write_guard(int(month), int(year), ('overheads',))
+        if blocked: return blocked
         
-        # Parse values
-        kitchen = float(data.get('kitchen', 0))
-        others = float(data.get('others', 0))
-        pay_advance = float(data.get('pay_advance', 0))
-        income = float(data.get('income', 0))
-        employee_names = data.get('employee_names', '')
-        canteen_auto = float(data.get('canteen_auto', 0))
-        
-        # Calculate total expense
-        total_expense = kitchen + canteen_auto + others + pay_advance
-        
-        entry = {
-            'date': date,
-            'month': month,
-            'year': year,
-            'kitchen': kitchen,
-            'canteen_auto': canteen_auto,
-            'others': others,
-            'pay_advance': pay_advance,
-            'employee_names': employee_names,
-            'income': income,
-            'total_expense': total_expense,
-            'last_updated': datetime.now()
-        }
+        entry = build_overhead_entry(data, date, month, year)
         
         # Upsert: update if exists, insert if not
         mongo.db.overheads.update_one(
@@ -2048,6 +4154,7 @@ def save_overhead_entry():
             {'$set': entry},
             upsert=True
         )
+        bump_data_version('overheads')
         
         return jsonify({"message": "Entry saved", "entry": entry})
     except Exception as e:
@@ -2055,6 +4162,60 @@ def save_overhead_entry():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/api/overheads/month/<int:month>/<int:year>', methods=['POST'])
+@role_required(['Admin'])
+def save_overhead_month(month, year):
+    """
+    Save many day rows of the monthly overheads sheet in one request.
+
+    Body: {"entries": [{date, kitchen, others, pay_advance, income,
+    employee_names, canteen_auto}, ...]}. Every row is validated first;
+    if any is invalid nothing is written. Valid rows are applied with a
+    single bulk_write of upserts keyed on (year, month, date).
+    """
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    data = request.get_json() or {}
+    rows = data.get('entries')
+    if not isinstance(rows, list) or not rows:
+        return jsonify({"error": "entries must be a non-empty list"}), 400
+
+    month_prefix = f"{year}-{month:02d}-"
+    entries = {}
+    errors = []
+    for index, row in enumerate(rows):
+        date = row.get('date') if isinstance(row, dict) else None
+        if not isinstance(date, str) or not date.startswith(month_prefix) or _parse_iso_date(date) is None:
+            errors.append({'index': index, 'date': date, 'error': f"date must be a YYYY-MM-DD day in {year}-{month:02d}"})
+            continue
+        try:
+            # A repeated date keeps the last row, matching sequential single saves
+            entries[date] = build_overhead_entry(row, date, month, year)
+        except (ValueError, TypeError) as ve:
+            errors.append({'index': index, 'date': date, 'error': f"Invalid number: {ve}"})
+
+    if errors:
+        return jsonify({"error": "Invalid entries", "details": errors}), 400
+
+    blocked = month_write_guard(month, year, ('overheads',))
+    if blocked: return blocked
+
+    try:
+        result = mongo.db.overheads.bulk_write([
+            UpdateOne({'year': year, 'month': month, 'date': date}, {'$set': entry}, upsert=True)
+            for date, entry in entries.items()
+        ], ordered=False)
+        bump_data_version('overheads')
+        return jsonify({
+            "message": "Entries saved",
+            "saved": len(entries),
+            "inserted": result.upserted_count,
+            "updated": result.modified_count
+        })
+    except Exception as e:
+        print(f"Save Overhead Month Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route('/api/overheads/canteen-sync/<int:month>/<int:year>', methods=['GET'])
 @role_required(['Admin'])
 def sync_overheads_canteen(month, year):
@@ -2064,35 +4225,18 @@ def sync_overheads_canteen(month, year):
     """
     if not check_db(): return jsonify({"error": "Database error"}), 500
     try:
+        # A closed month shows its frozen overheads, so its canteen column must match that snapshot
+        snapshot = closed_month_report('overheads', month, year)
+        if snapshot is not None:
+            return jsonify({'canteen_daily': snapshot.get('canteen_daily', {})})
+
         start_date = datetime(year, month, 1)
         if month == 12:
             end_date = datetime(year + 1, 1, 1)
         else:
             end_date = datetime(year, month + 1, 1)
         
-        canteen_aggregation = mongo.db.canteen_sales.aggregate([
-            {
-                '$match': {
-                    'date': {
-                        '$gte': start_date,
-                        '$lt': end_date
-                    }
-                }
-            },
-            {
-                '$group': {
-                    '_id': {
-                        '$dateToString': {
-                            'format': '%Y-%m-%d',
-                            'date': '$date'
-                        }
-                    },
-                    'total': {'$sum': '$amount'}
-                }
-            }
-        ])
-        
-        canteen_daily = {item['_id']: item['total'] for item in canteen_aggregation}
+        canteen_daily = canteen_daily_totals(start_date, end_date)
         
         return jsonify({'canteen_daily': canteen_daily})
     except Exception as e:
@@ -2111,16 +4255,11 @@ def _month_start_n_months_ago(months_ago: int) -> datetime:
     return datetime(target_year, target_month, 1)
 
 
-@app.route('/api/payment-records/export', methods=['GET'])
-@role_required(['Admin'])
-def export_payment_records():
-    """Export payment records to Excel for a given range.
-    range=current (default) or six_months.
-    """
-    if not check_db(): return jsonify({"error": "Database error"}), 500
+PAYMENT_RECORD_EXPORT_HEADER = ['Patient Name', 'Amount (PKR)', 'Date', 'Payment Mode', 'Recorded By', 'Note']
 
-    range_key = request.args.get('range', 'current')
 
+def payment_records_export_range(range_key):
+    """Return (start_date, end_date) for range=current or six_months."""
     today = datetime.now()
     if range_key == 'six_months':
         start_date = _month_start_n_months_ago(5)  # includes current month (6 total)
@@ -2132,67 +4271,124 @@ def export_payment_records():
         end_date = datetime(today.year + 1, 1, 1)
     else:
         end_date = datetime(today.year, today.month + 1, 1)
+    return start_date, end_date
 
-    try:
-        payments = list(mongo.db.expenses.find({
+
+def iter_payment_record_rows(start_date, end_date):
+    """
+    Yield one export row per patient fee payment in [start_date, end_date),
+    month by month, reading closed months from their snapshot.
+    """
+    month_start = datetime(start_date.year, start_date.month, 1)
+    while month_start < end_date:
+        month_end = datetime(month_start.year + 1, 1, 1) if month_start.month == 12 else datetime(month_start.year, month_start.month + 1, 1)
+        snapshot = closed_month_report('payment_records', month_start.month, month_start.year)
+        if snapshot is not None and month_start >= start_date and month_end <= end_date:
+            yield from snapshot
+        else:
+            yield from iter_live_payment_record_rows(max(start_date, month_start), min(end_date, month_end))
+        month_start = month_end
+
+
+def iter_live_payment_record_rows(start_date, end_date):
+    """Rows of iter_payment_record_rows read from the expenses collection."""
+    cursor = mongo.db.expenses.find({
+        'type': 'incoming',
+        'category': 'Patient Fee',
+        'date': {'$gte': start_date, '$lt': end_date}
+    }, {'screenshot': 0}, batch_size=EXPORT_BATCH_SIZE).sort('date', 1)
+
+    def to_date(dt_val):
+        if not dt_val:
+            return ''
+        if isinstance(dt_val, datetime):
+            return dt_val
+        try:
+            return datetime.fromisoformat(str(dt_val))
+        except Exception:
+            return None
+
+    for p in cursor:
+        note = p.get('note', '')
+        patient_name = 'Unknown'
+        if 'Partial payment from ' in note:
+            patient_name = note.split('Partial payment from ')[1].split(' via ')[0]
+
+        dt = to_date(p.get('date'))
+        yield [
+            patient_name,
+            p.get('amount', 0),
+            dt.strftime('%Y-%m-%d') if dt else '',
+            p.get('payment_method', 'Cash'),
+            p.get('recorded_by', 'Admin'),
+            note
+        ]
+
+
+def build_payment_records_export(range_key, progress=None):
+    """Build the payment records workbook. Returns (file, download_name)."""
+    start_date, end_date = payment_records_export_range(range_key)
+    total_rows = None
+    if progress:
+        total_rows = mongo.db.expenses.count_documents({
             'type': 'incoming',
             'category': 'Patient Fee',
             'date': {'$gte': start_date, '$lt': end_date}
-        }).sort('date', 1))
+        })
+    output = write_xlsx_stream(
+        PAYMENT_RECORD_EXPORT_HEADER,
+        iter_payment_record_rows(start_date, end_date),
+        'Payment Records',
+        total_rows=total_rows,
+        progress=progress
+    )
+    if output is None:
+        output = write_xlsx_stream(
+            ['Message'], [['No payment records for selected range']], 'Payment Records'
+        )
 
-        rows = []
+    filename = f"payment_records_{'six_months' if range_key == 'six_months' else 'current_month'}.xlsx"
+    return output, filename
 
-        def to_date(dt_val):
-            if not dt_val:
-                return ''
-            if isinstance(dt_val, datetime):
-                return dt_val
-            try:
-                return datetime.fromisoformat(str(dt_val))
-            except Exception:
-                return None
 
-        for p in payments:
-            note = p.get('note', '')
-            patient_name = 'Unknown'
-            if 'Partial payment from ' in note:
-                patient_name = note.split('Partial payment from ')[1].split(' via ')[0]
+@app.route('/api/payment-records/export', methods=['GET'])
+@role_required(['Admin'])
+def export_payment_records():
+    """Export payment records for a given range.
+    range=current (default) or six_months; format=xlsx (default), csv or parquet.
+    """
+    if not check_db(): return jsonify({"error": "Database error"}), 500
 
-            dt = to_date(p.get('date'))
-            rows.append({
-                'Patient Name': patient_name,
-                'Amount (PKR)': p.get('amount', 0),
-                'Date': dt.strftime('%Y-%m-%d') if dt else '',
-                'Payment Mode': p.get('payment_method', 'Cash'),
-                'Recorded By': p.get('recorded_by', 'Admin'),
-                'Note': note
-            })
+    range_key = request.args.get('range', 'current')
+    fmt = request.args.get('format', 'xlsx').lower()
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"Format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
 
-        df = pd.DataFrame(rows)
-        if df.empty:
-            df = pd.DataFrame([{'Message': 'No payment records for selected range'}])
+    try:
+        if fmt != 'xlsx':
+            start_date, end_date = payment_records_export_range(range_key)
+            return flat_export_response(
+                fmt,
+                PAYMENT_RECORD_EXPORT_HEADER,
+                iter_payment_record_rows(start_date, end_date),
+                f"payment_records_{'six_months' if range_key == 'six_months' else 'current_month'}",
+                int_columns=('Amount (PKR)',)
+            )
 
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Payment Records')
-            
-            # Configure A4 page setup
-            worksheet = writer.sheets['Payment Records']
-            worksheet.page_setup.paperSize = 9  # A4
-            worksheet.page_setup.orientation = 'portrait'
-            worksheet.page_setup.fitToWidth = 1
-            worksheet.page_setup.fitToHeight = 0
-            worksheet.print_options.horizontalCentered = True
-            worksheet.page_margins.left = 0.75
-            worksheet.page_margins.right = 0.75
-            worksheet.page_margins.top = 0.75
-            worksheet.page_margins.bottom = 0.75
-        
-        output.seek(0)
+        # Serve the workbook an export job or the nightly run already built from the same data
+        params = normalize_export_params('payment_records', {'range': range_key}, 'Admin')
+        cached_path = export_artifact_path(export_cache_key('payment_records', params))
+        if os.path.exists(cached_path):
+            filename = f"payment_records_{'six_months' if range_key == 'six_months' else 'current_month'}.xlsx"
+            return send_file(cached_path, as_attachment=True, download_name=filename,
+                             mimetype=XLSX_MIMETYPE)
 
-        filename = f"payment_records_{'six_months' if range_key == 'six_months' else 'current_month'}.xlsx"
+        output, filename = build_payment_records_export(range_key)
         return send_file(output, as_attachment=True, download_name=filename,
-                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+                         mimetype=XLSX_MIMETYPE)
+    except ImportError as ie:
+        print(f"Payment Records Export Error: {ie}")
+        return jsonify({"error": f"Missing '{ie.name}' library"}), 500
     except Exception as e:
         print(f"Payment Records Export Error: {e}")
         return jsonify({"error": str(e)}), 500
@@ -2225,7 +4421,7 @@ def add_patient_payment(id):
         # 3. Update Patient Record
         mongo.db.patients.update_one(
             {'_id': ObjectId(id)}, 
-            {'$set': {'receivedAmount': str(new_total)}}
+            {'$set': {'receivedAmount': str(new_total), 'updated_at': datetime.now()}}
         )
 
         # 4. Log as an Incoming Expense automatically
@@ -2240,8 +4436,10 @@ def add_patient_payment(id):
             'screenshot': screenshot,
             'date': datetime.now(),
             'recorded_by': session.get('username', 'Admin'),
-            'auto': True
+            'auto': True,
+            'updated_at': datetime.now()
         })
+        bump_data_version('patients', 'expenses')
 
         return jsonify({"message": "Payment recorded successfully", "new_total": new_total})
     except Exception as e:
@@ -2249,6 +4447,192 @@ def add_patient_payment(id):
         return jsonify({"error": str(e)}), 500
 
 
+def compute_discharge_bill_data(patient, canteen_total, as_of=None):
+    """Build the ordered discharge bill fields for a patient document (days counted up to `as_of`, default now)."""
+    # Calculate days elapsed from admission date
+    days_elapsed = days_since_admission(patient.get('admissionDate'), as_of)
+
+    # Parse financial data and calculate prorated fee
+    monthly_fee_raw = patient.get('monthlyFee', '0')
+    monthly_fee = calculate_prorated_fee(monthly_fee_raw, days_elapsed)
+    laundry_amount = patient.get('laundryAmount', 0) if patient.get('laundryStatus', False) else 0
+    received_amount = int(str(patient.get('receivedAmount', '0')).replace(',', '') or '0')
+
+    # Calculate totals
+    total_charges = monthly_fee + canteen_total + laundry_amount
+    balance_due = total_charges - received_amount
+
+    return {
+        'Patient Name': patient.get('name', ''),
+        'Father Name': patient.get('fatherName', ''),
+        'CNIC': patient.get('cnic', ''),
+        'Admission Date': patient.get('admissionDate', ''),
+        'Discharge Date': patient.get('dischargeDate', '') or datetime.now().strftime('%Y-%m-%d'),
+        'Days Stayed': days_elapsed,
+        'Monthly Fee': monthly_fee,
+        'Canteen Charges': canteen_total,
+        'Laundry Charges': laundry_amount,
+        'Total Charges': total_charges,
+        'Amount Paid': received_amount,
+        'Balance Due': balance_due
+    }
+
+
+def discharge_bill_filename(patient_name):
+    return f"discharge_bill_{(patient_name or 'patient').replace(' ', '_')}.xlsx"
+
+
+DISCHARGE_BILL_COLUMNS = [
+    'Patient Name', 'Father Name', 'CNIC', 'Admission Date', 'Discharge Date', 'Days Stayed',
+    'Monthly Fee', 'Canteen Charges', 'Laundry Charges', 'Total Charges', 'Amount Paid', 'Balance Due'
+]
+DISCHARGE_BILL_WIDE_COLUMNS = {'Patient Name', 'Father Name', 'CNIC'}
+DISCHARGE_BILL_SHEET_PART = 'xl/worksheets/sheet1.xml'
+_XML_ILLEGAL_CHARS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+@lru_cache(maxsize=1)
+def get_discharge_bill_template():
+    """
+    Build the pre-styled discharge bill workbook once per process.
+
+    The workbook is rendered with openpyxl a single time, with every style,
+    width and page setting applied and zeros in the value row. It is kept as
+    its raw zip parts, with the worksheet XML split around the value row, so
+    each bill only has to format twelve cells.
+    """
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
+
+    workbook = Workbook()
+    worksheet = workbook.active
+    worksheet.title = 'Discharge Bill'
+
+    # Configure A4 page setup - Portrait, fit to one page
+    worksheet.page_setup.paperSize = 9  # A4
+    worksheet.page_setup.orientation = 'portrait'
+    worksheet.page_setup.fitToPage = True
+    worksheet.page_setup.fitToWidth = 1
+    worksheet.page_setup.fitToHeight = 1  # Force to fit on 1 page height
+    worksheet.page_setup.scale = None  # Allow auto-scaling
+
+    # Set margins to maximize space
+    worksheet.page_margins.left = 0.5
+    worksheet.page_margins.right = 0.5
+    worksheet.page_margins.top = 0.5
+    worksheet.page_margins.bottom = 0.5
+    worksheet.page_margins.header = 0.3
+    worksheet.page_margins.footer = 0.3
+
+    # Center horizontally on page
+    worksheet.print_options.horizontalCentered = True
+
+    # Styling
+    thin_border = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'),
+        bottom=Side(style='thin')
+    )
+    header_font = Font(bold=True, size=10, color='FFFFFF')
+    header_fill = PatternFill(start_color='366092', end_color='366092', fill_type='solid')
+    header_alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+    value_font = Font(size=10)
+    total_font = Font(size=10, bold=True)
+    total_fill = PatternFill(start_color='D9E1F2', end_color='D9E1F2', fill_type='solid')
+    value_alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
+
+    for col_idx, column in enumerate(DISCHARGE_BILL_COLUMNS, start=1):
+        header = worksheet.cell(row=1, column=col_idx, value=column)
+        header.font = header_font
+        header.fill = header_fill
+        header.alignment = header_alignment
+        header.border = thin_border
+
+        value = worksheet.cell(row=2, column=col_idx, value=0)
+        value.alignment = value_alignment
+        value.border = thin_border
+        # Highlight financial totals
+        if 'Total' in column or 'Balance' in column:
+            value.fill = total_fill
+            value.font = total_font
+        else:
+            value.font = value_font
+
+        # Fixed widths, capped at 25 to fit on A4; long values wrap
+        width = 25 if column in DISCHARGE_BILL_WIDE_COLUMNS else min(max(len(column), 10) + 2, 25)
+        worksheet.column_dimensions[header.column_letter].width = width
+
+    # Set row height
+    worksheet.row_dimensions[1].height = 30  # Header
+    worksheet.row_dimensions[2].height = 20
+
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    with zipfile.ZipFile(buffer) as archive:
+        parts = [(info, archive.read(info.filename)) for info in archive.infolist()]
+
+    sheet_xml = dict((info.filename, data) for info, data in parts)[DISCHARGE_BILL_SHEET_PART].decode('utf-8')
+    value_row = re.search(r'<row r="2"[^>]*>.*?</row>', sheet_xml, re.S)
+    row_open = re.match(r'<row r="2"[^>]*>', value_row.group(0)).group(0)
+    cells = re.findall(r'<c r="([A-Z]+)2"(?: s="(\d+)")?', value_row.group(0))
+
+    return {
+        'parts': parts,
+        'sheet_head': sheet_xml[:value_row.start()] + row_open,
+        'sheet_tail': '</row>' + sheet_xml[value_row.end():],
+        'cells': [(ref, f' s="{style_id}"' if style_id else '') for ref, style_id in cells]
+    }
+
+
+def _bill_cell_xml(ref, style_attr, value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c r="{ref}2"{style_attr}><v>{value}</v></c>'
+    text = xml_escape(_XML_ILLEGAL_CHARS.sub('', '' if value is None else str(value)))
+    return f'<c r="{ref}2"{style_attr} t="inlineStr"><is><t>{text}</t></is></c>'
+
+
+def render_discharge_bill(bill_data):
+    """Render a discharge bill formatted to fit on one A4 page. Returns a BytesIO."""
+    with trace_span('discharge_bill.fill_template'):
+        template = get_discharge_bill_template()
+        row_xml = ''.join(
+            _bill_cell_xml(ref, style_attr, bill_data.get(column))
+            for (ref, style_attr), column in zip(template['cells'], DISCHARGE_BILL_COLUMNS)
+        )
+        sheet_xml = (template['sheet_head'] + row_xml + template['sheet_tail']).encode('utf-8')
+
+    # Every other part is shared with the template unchanged
+    output = io.BytesIO()
+    with trace_span('discharge_bill.zip'), zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for info, data in template['parts']:
+            archive.writestr(info, sheet_xml if info.filename == DISCHARGE_BILL_SHEET_PART else data)
+    output.seek(0)
+    return output
+
+
+def build_discharge_bill_export(patient_id):
+    """Build one patient's discharge bill. Returns (file, download_name) or None if not found."""
+    patient = mongo.db.patients.find_one(
+        {'_id': ObjectId(patient_id)},
+        {'photo1': 0, 'photo2': 0, 'photo3': 0}
+    )
+    if not patient:
+        return None
+
+    # Calculate canteen sales total for this patient
+    pipeline = [
+        {'$match': {'patient_id': ObjectId(patient_id)}},
+        {'$group': {'_id': None, 'total_sales': {'$sum': '$amount'}}}
+    ]
+    canteen_result = list(canteen_aggregate(pipeline))
+    canteen_total = canteen_result[0]['total_sales'] if canteen_result else 0
+
+    with trace_span('discharge_bill.compute'):
+        bill_data = compute_discharge_bill_data(patient, canteen_total)
+    return render_discharge_bill(bill_data), discharge_bill_filename(patient.get('name'))
+
+
 @app.route('/api/patients/<id>/discharge-bill', methods=['GET'])
 @role_required(['Admin', 'Doctor'])
 def generate_discharge_bill(id):
@@ -2256,142 +4640,14 @@ def generate_discharge_bill(id):
     if not check_db(): return jsonify({"error": "Database error"}), 500
     
     try:
-        from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
-        
-        # Fetch patient data
-        patient = mongo.db.patients.find_one({'_id': ObjectId(id)})
-        if not patient:
+        built = build_discharge_bill_export(id)
+        if built is None:
             return jsonify({"error": "Patient not found"}), 404
-        
-        # Calculate days elapsed from admission date
-        admission_date = patient.get('admissionDate')
-        days_elapsed = 0
-        if admission_date:
-            try:
-                if isinstance(admission_date, str):
-                    admission_dt = datetime.fromisoformat(admission_date.replace('Z', '+00:00'))
-                else:
-                    admission_dt = admission_date
-                days_diff = (datetime.now() - admission_dt).days
-                days_elapsed = max(0, days_diff)
-            except:
-                days_elapsed = 0
-        
-        # Calculate canteen sales total for this patient
-        pipeline = [
-            {'$match': {'patient_id': ObjectId(id)}},
-            {'$group': {'_id': None, 'total_sales': {'$sum': '$amount'}}}
-        ]
-        canteen_result = list(mongo.db.canteen_sales.aggregate(pipeline))
-        canteen_total = canteen_result[0]['total_sales'] if canteen_result else 0
-        
-        # Parse financial data and calculate prorated fee
-        monthly_fee_raw = patient.get('monthlyFee', '0')
-        monthly_fee = calculate_prorated_fee(monthly_fee_raw, days_elapsed)
-        laundry_amount = patient.get('laundryAmount', 0) if patient.get('laundryStatus', False) else 0
-        received_amount = int(str(patient.get('receivedAmount', '0')).replace(',', '') or '0')
-        
-        # Calculate totals
-        total_charges = monthly_fee + canteen_total + laundry_amount
-        balance_due = total_charges - received_amount
-        
-        # Create discharge bill data
-        bill_data = {
-            'Patient Name': patient.get('name', ''),
-            'Father Name': patient.get('fatherName', ''),
-            'CNIC': patient.get('cnic', ''),
-            'Admission Date': patient.get('admissionDate', ''),
-            'Discharge Date': patient.get('dischargeDate', '') or datetime.now().strftime('%Y-%m-%d'),
-            'Days Stayed': days_elapsed,
-            'Monthly Fee': monthly_fee,
-            'Canteen Charges': canteen_total,
-            'Laundry Charges': laundry_amount,
-            'Total Charges': total_charges,
-            'Amount Paid': received_amount,
-            'Balance Due': balance_due
-        }
-        
-        # Create Excel workbook
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            # Create a DataFrame for the bill
-            df = pd.DataFrame([bill_data])
-            df.to_excel(writer, index=False, sheet_name='Discharge Bill')
-            
-            worksheet = writer.sheets['Discharge Bill']
-            
-            # Configure A4 page setup - Portrait, fit to one page
-            worksheet.page_setup.paperSize = 9  # A4
-            worksheet.page_setup.orientation = 'portrait'
-            worksheet.page_setup.fitToPage = True
-            worksheet.page_setup.fitToWidth = 1
-            worksheet.page_setup.fitToHeight = 1  # Force to fit on 1 page height
-            worksheet.page_setup.scale = None  # Allow auto-scaling
-            
-            # Set margins to maximize space
-            worksheet.page_margins.left = 0.5
-            worksheet.page_margins.right = 0.5
-            worksheet.page_margins.top = 0.5
-            worksheet.page_margins.bottom = 0.5
-            worksheet.page_margins.header = 0.3
-            worksheet.page_margins.footer = 0.3
-            
-            # Center horizontally on page
-            worksheet.print_options.horizontalCentered = True
-            
-            # Styling
-            thin_border = Border(
-                left=Side(style='thin'),
-                right=Side(style='thin'),
-                top=Side(style='thin'),
-                bottom=Side(style='thin')
-            )
-            
-            header_fill = PatternFill(start_color='366092', end_color='366092', fill_type='solid')
-            total_fill = PatternFill(start_color='D9E1F2', end_color='D9E1F2', fill_type='solid')
-            
-            # Apply styles to header row
-            for cell in worksheet[1]:
-                cell.font = Font(bold=True, size=10, color='FFFFFF')
-                cell.fill = header_fill
-                cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-                cell.border = thin_border
-            
-            # Apply styles to data rows
-            for row in worksheet.iter_rows(min_row=2, max_row=worksheet.max_row):
-                for cell in row:
-                    cell.font = Font(size=10)
-                    cell.alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
-                    cell.border = thin_border
-                    # Highlight financial totals
-                    if 'Total' in str(worksheet.cell(1, cell.column).value) or 'Balance' in str(worksheet.cell(1, cell.column).value):
-                        cell.fill = total_fill
-                        cell.font = Font(size=10, bold=True)
-            
-            # Auto-adjust column widths (but keep them reasonable for A4)
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 25)  # Cap at 25 to fit on A4
-                worksheet.column_dimensions[column_letter].width = adjusted_width
-            
-            # Set row height
-            worksheet.row_dimensions[1].height = 30  # Header
-            for row in range(2, worksheet.max_row + 1):
-                worksheet.row_dimensions[row].height = 20
-        
-        output.seek(0)
-        
-        filename = f"discharge_bill_{patient.get('name', 'patient').replace(' ', '_')}.xlsx"
+
+        output, filename = built
         return send_file(
             output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            mimetype=XLSX_MIMETYPE,
             as_attachment=True,
             download_name=filename
         )
@@ -2400,6 +4656,380 @@ def generate_discharge_bill(id):
         return jsonify({"error": str(e)}), 500
 
 
+# --- BULK DISCHARGE BILLS ---
+
+DISCHARGE_BILL_PROCESSES = int(os.environ.get('DISCHARGE_BILL_PROCESSES', str(os.cpu_count() or 2)))
+DISCHARGE_BILL_INLINE_LIMIT = 2  # Below this, pool start-up costs more than it saves
+
+_bill_process_pool = None
+_bill_process_pool_lock = threading.Lock()
+
+
+def get_bill_process_pool():
+    """
+    Lazily create the process pool used to render discharge bills in parallel.
+    Returns None where worker processes are unavailable (serverless, no semaphores).
+    """
+    global _bill_process_pool
+    with _bill_process_pool_lock:
+        if _bill_process_pool is None:
+            if SERVERLESS:
+                _bill_process_pool = False
+                return None
+            # Spawned children start clean instead of forking a process that holds a
+            # MongoClient and background threads. They import this module, so worker
+            # init must be deferred in the environment they inherit: an initializer
+            # defined here would only run after that import.
+            os.environ['PRO_DEFER_WORKER_INIT'] = '1'
+            try:
+                _bill_process_pool = ProcessPoolExecutor(
+                    max_workers=DISCHARGE_BILL_PROCESSES, mp_context=multiprocessing.get_context('spawn')
+                )
+            except (OSError, ImportError, NotImplementedError) as e:
+                print(f"Discharge Bill Pool Error: {e}; rendering in-thread")
+                _bill_process_pool = False
+        return _bill_process_pool or None
+
+
+def render_discharge_bill_bytes(bill_data):
+    """Process pool entry point: render one bill and return the workbook bytes."""
+    return render_discharge_bill(bill_data).getvalue()
+
+
+def render_discharge_bills(bills):
+    """Render bills in the process pool when it pays off, otherwise (or if it fails) in this thread."""
+    global _bill_process_pool
+    pool = get_bill_process_pool() if len(bills) > DISCHARGE_BILL_INLINE_LIMIT else None
+    if pool is not None:
+        try:
+            return list(pool.map(render_discharge_bill_bytes, bills))
+        except (BrokenProcessPool, OSError) as e:
+            print(f"Discharge Bill Pool Error: {e}; rendering in-thread")
+            with _bill_process_pool_lock:
+                _bill_process_pool = None  # Try a fresh pool next time
+    return [render_discharge_bill_bytes(b) for b in bills]
+
+
+def leaving_patients_query(month, year):
+    """Patients discharged within the given month (dischargeDate stored as YYYY-MM-DD)."""
+    start = datetime(year, month, 1)
+    end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    return {
+        'isDischarged': True,
+        'dischargeDate': {'$gte': start.strftime('%Y-%m-%d'), '$lt': end.strftime('%Y-%m-%d')}
+    }
+
+
+@app.route('/api/discharge-bills/batch', methods=['POST'])
+@role_required(['Admin'])
+def generate_discharge_bills_batch():
+    """
+    Generate discharge bills for many patients and return them as one zip.
+
+    Body: {"patient_ids": [...]} for an explicit list, otherwise every patient
+    discharged in {"month", "year"} (default: current month). Canteen totals
+    come from a single aggregation and the workbooks render in parallel.
+    """
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    data = clean_input_data(request.get_json() or {})
+
+    try:
+        patient_ids = data.get('patient_ids')
+        projection = {'photo1': 0, 'photo2': 0, 'photo3': 0}
+        if patient_ids:
+            object_ids = [ObjectId(pid) for pid in patient_ids if ObjectId.is_valid(pid)]
+            patients = list(mongo.db.patients.find({'_id': {'$in': object_ids}}, projection))
+        else:
+            today = datetime.now()
+            month = int(data.get('month', today.month))
+            year = int(data.get('year', today.year))
+            patients = list(mongo.db.patients.find(leaving_patients_query(month, year), projection))
+
+        if not patients:
+            return jsonify({"error": "No patients found"}), 404
+
+        # One aggregation for every patient's canteen total
+        canteen_agg = canteen_aggregate([
+            {'$match': {'patient_id': {'$in': [p['_id'] for p in patients]}}},
+            {'$group': {'_id': '$patient_id', 'total_sales': {'$sum': '$amount'}}}
+        ])
+        canteen_map = {str(item['_id']): item['total_sales'] for item in canteen_agg}
+
+        with trace_span('discharge_bill.compute', {'export.bills': len(patients)}):
+            bills = [compute_discharge_bill_data(p, canteen_map.get(str(p['_id']), 0)) for p in patients]
+
+        with trace_span('discharge_bill.render_all', {'export.bills': len(bills)}):
+            rendered = render_discharge_bills(bills)
+
+        output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+        used_names = set()
+        with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for patient, content in zip(patients, rendered):
+                filename = discharge_bill_filename(patient.get('name'))
+                if filename in used_names:
+                    filename = filename.replace('.xlsx', f"_{patient['_id']}.xlsx")
+                used_names.add(filename)
+                archive.writestr(filename, content)
+        output.seek(0)
+
+        return send_file(
+            output,
+            mimetype='application/zip',
+            as_attachment=True,
+            download_name=f"discharge_bills_{datetime.now().strftime('%Y-%m-%d')}.zip"
+        )
+    except ValueError as ve:
+        return jsonify({"error": f"Invalid data format: {str(ve)}"}), 400
+    except Exception as e:
+        print(f"Batch Discharge Bill Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# --- BACKGROUND EXPORT JOBS ---
+#
+# Large exports run on a worker pool instead of inside the request:
+#   POST /api/export-jobs                   -> enqueue, returns job id (202)
+#   GET  /api/export-jobs/<id>              -> status and progress
+#   GET  /api/export-jobs/<id>/download     -> finished file
+# Job state lives in the export_jobs collection so any worker can answer a
+# status poll. Finished files are cached on disk under a key built from the
+# export parameters and the data version of the collections they read, so a
+# repeated export with unchanged data is served without rebuilding.
+
+# Jobs need a long-lived process and a shared disk; on serverless the SPA uses
+# the synchronous export routes instead.
+EXPORT_JOBS_ENABLED = os.environ.get('EXPORT_JOBS', '0' if SERVERLESS else '1') == '1'
+EXPORT_CACHE_DIR = os.environ.get('EXPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'pro_crm_exports'))
+EXPORT_CACHE_MAX_AGE_SECONDS = int(os.environ.get('EXPORT_CACHE_MAX_AGE_HOURS', '24')) * 3600
+
+# kind -> roles allowed to run it and collections whose changes invalidate it
+EXPORT_JOB_KINDS = {
+    'patients': {'roles': ['Admin', 'Doctor', 'Psychologist'], 'collections': ['patients']},
+    'payment_records': {'roles': ['Admin'], 'collections': ['expenses']},
+    'discharge_bill': {'roles': ['Admin', 'Doctor'], 'collections': ['patients', 'canteen_sales']},
+}
+
+export_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('EXPORT_WORKERS', '2')))
+
+
+def normalize_export_params(kind, params, role):
+    """Reduce request params to the values that affect the output of an export kind."""
+    if kind == 'patients':
+        return {
+            'fields': resolve_patient_export_fields(params.get('fields', 'all')),
+            'is_admin': role == 'Admin'
+        }
+    if kind == 'payment_records':
+        range_key = params.get('range', 'current')
+        start_date, end_date = payment_records_export_range(range_key)
+        return {
+            'range': range_key,
+            'start': start_date.strftime('%Y-%m-%d'),
+            'end': end_date.strftime('%Y-%m-%d')
+        }
+    if kind == 'discharge_bill':
+        patient_id = params.get('patient_id')
+        if not patient_id or not ObjectId.is_valid(patient_id):
+            raise ValueError("Valid patient_id required")
+        # Days stayed (and so the fee) changes daily
+        return {'patient_id': patient_id, 'day': datetime.now().strftime('%Y-%m-%d')}
+    raise ValueError(f"Unknown export kind: {kind}")
+
+
+def export_cache_key(kind, params):
+    stamp = get_data_version(EXPORT_JOB_KINDS[kind]['collections'])
+    raw = json.dumps({'kind': kind, 'params': params, 'version': stamp}, sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def export_artifact_path(cache_key):
+    return os.path.join(EXPORT_CACHE_DIR, f"{cache_key}.xlsx")
+
+
+def prune_export_cache():
+    """Remove cached artifacts older than EXPORT_CACHE_MAX_AGE_SECONDS."""
+    if not os.path.isdir(EXPORT_CACHE_DIR):
+        return
+    cutoff = time.time() - EXPORT_CACHE_MAX_AGE_SECONDS
+    for name in os.listdir(EXPORT_CACHE_DIR):
+        path = os.path.join(EXPORT_CACHE_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def build_export(kind, params, progress=None):
+    """Dispatch to the builder of an export kind. Returns (file, download_name) or None."""
+    if kind == 'patients':
+        return build_patients_export(params['fields'], params['is_admin'], progress=progress)
+    if kind == 'payment_records':
+        return build_payment_records_export(params['range'], progress=progress)
+    if kind == 'discharge_bill':
+        return build_discharge_bill_export(params['patient_id'])
+    raise ValueError(f"Unknown export kind: {kind}")
+
+
+def run_export_job(job_id, trace_parent=None):
+    """Worker entry point: build the artifact for a queued job and record the outcome."""
+    with trace_span('export_job', {'export.job_id': str(job_id)}, parent=trace_parent):
+        _run_export_job(job_id)
+
+
+def _run_export_job(job_id):
+    jobs = mongo.db.export_jobs
+    job = jobs.find_one({'_id': job_id})
+    if not job:
+        return
+
+    jobs.update_one({'_id': job_id}, {'$set': {'status': 'running', 'started_at': datetime.now()}})
+
+    def progress(fraction):
+        jobs.update_one({'_id': job_id}, {'$set': {'progress': int(fraction * 100)}})
+
+    try:
+        with app.app_context():
+            built = build_export(job['kind'], job['params'], progress=progress)
+        if built is None:
+            raise LookupError("Nothing to export")
+
+        output, filename = built
+        os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+        path = export_artifact_path(job['cache_key'])
+        tmp_path = f"{path}.{job_id}.tmp"
+        with output, open(tmp_path, 'wb') as fh:
+            shutil.copyfileobj(output, fh)
+        os.replace(tmp_path, path)
+
+        jobs.update_one({'_id': job_id}, {'$set': {
+            'status': 'done',
+            'progress': 100,
+            'filename': filename,
+            'finished_at': datetime.now()
+        }})
+    except Exception as e:
+        print(f"Export Job Error ({job_id}): {e}")
+        jobs.update_one({'_id': job_id}, {'$set': {
+            'status': 'failed',
+            'error': str(e),
+            'finished_at': datetime.now()
+        }})
+
+
+def serialize_export_job(job):
+    return {
+        'job_id': str(job['_id']),
+        'kind': job.get('kind'),
+        'status': job.get('status'),
+        'progress': job.get('progress', 0),
+        'filename': job.get('filename'),
+        'error': job.get('error'),
+        'created_at': job['created_at'].isoformat() if job.get('created_at') else None,
+        'finished_at': job['finished_at'].isoformat() if job.get('finished_at') else None
+    }
+
+
+def find_export_job_for_user(job_id):
+    """Load a job the current user requested (or joined), or None."""
+    if not ObjectId.is_valid(job_id):
+        return None
+    job = mongo.db.export_jobs.find_one({'_id': ObjectId(job_id)})
+    if not job or session.get('role') not in EXPORT_JOB_KINDS.get(job.get('kind'), {}).get('roles', []):
+        return None
+    username = session.get('username')
+    if job.get('created_by') != username and username not in job.get('requested_by', []):
+        return None
+    return job
+
+
+@app.route('/api/export-jobs', methods=['POST'])
+@login_required
+def create_export_job():
+    """Enqueue an export, or return an existing job that already covers the same data."""
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    if not EXPORT_JOBS_ENABLED:
+        return jsonify({"error": "Background exports are disabled; use the direct export routes"}), 503
+    data = clean_input_data(request.get_json() or {})
+    kind = data.get('kind')
+    if kind not in EXPORT_JOB_KINDS:
+        return jsonify({"error": "Unknown export kind"}), 400
+    if session.get('role') not in EXPORT_JOB_KINDS[kind]['roles']:
+        return jsonify({"error": "Access Denied"}), 403
+
+    try:
+        params = normalize_export_params(kind, data.get('params') or {}, session.get('role'))
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+
+    try:
+        prune_export_cache()
+        cache_key = export_cache_key(kind, params)
+
+        # Serve a cached artifact, or join a job that is already building it
+        existing = mongo.db.export_jobs.find_one(
+            {'cache_key': cache_key, 'status': {'$in': ['queued', 'running', 'done']}},
+            sort=[('created_at', -1)]
+        )
+        if existing and (existing['status'] != 'done' or os.path.exists(export_artifact_path(cache_key))):
+            # Joining lets this user poll and download the shared job
+            mongo.db.export_jobs.update_one(
+                {'_id': existing['_id']}, {'$addToSet': {'requested_by': session.get('username')}}
+            )
+            status_code = 200 if existing['status'] == 'done' else 202
+            return jsonify(serialize_export_job(existing)), status_code
+
+        job = {
+            'kind': kind,
+            'params': params,
+            'cache_key': cache_key,
+            'status': 'queued',
+            'progress': 0,
+            'created_by': session.get('username'),
+            'requested_by': [session.get('username')],
+            'created_at': datetime.now()
+        }
+        result = mongo.db.export_jobs.insert_one(job)
+        job['_id'] = result.inserted_id
+        export_executor.submit(run_export_job, result.inserted_id, current_span())
+        return jsonify(serialize_export_job(job)), 202
+    except Exception as e:
+        print(f"Create Export Job Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/export-jobs/<job_id>', methods=['GET'])
+@login_required
+def get_export_job(job_id):
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    job = find_export_job_for_user(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(serialize_export_job(job))
+
+
+@app.route('/api/export-jobs/<job_id>/download', methods=['GET'])
+@login_required
+def download_export_job(job_id):
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    job = find_export_job_for_user(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    if job.get('status') != 'done':
+        return jsonify({"error": "Export is not ready", "status": job.get('status')}), 409
+
+    path = export_artifact_path(job['cache_key'])
+    if not os.path.exists(path):
+        return jsonify({"error": "Export expired, please run it again"}), 410
+
+    return send_file(
+        path,
+        mimetype=XLSX_MIMETYPE,
+        as_attachment=True,
+        download_name=job.get('filename') or 'export.xlsx'
+    )
+
+
 # --- DAILY REPORT APIS ---
 
 @app.route('/api/reports', methods=['GET'])
@@ -2497,18 +5127,11 @@ def _parse_iso_date(date_str):
         return None
 
 
-@app.route('/api/psych-sessions', methods=['GET'])
-@login_required
-def list_psych_sessions():
-    if not check_db():
-        return jsonify({"error": "Database error"}), 500
-
-    role = session.get('role')
-    user_id = session.get('user_id')
-
-    start_str = request.args.get('start')
-    end_str = request.args.get('end')
-    psychologist_id = request.args.get('psychologistId')
+def psych_sessions_query(role, user_id, args):
+    """Filter for the psych session list, scoped to the caller's role."""
+    start_str = args.get('start')
+    end_str = args.get('end')
+    psychologist_id = args.get('psychologistId')
 
     start_date = _parse_iso_date(start_str) if start_str else None
     end_date = _parse_iso_date(end_str) if end_str else None
@@ -2527,50 +5150,69 @@ def list_psych_sessions():
         query['psychologist_id'] = user_id
     elif psychologist_id:
         query['psychologist_id'] = psychologist_id
+    return query
+
+
+def psych_session_name_queries(sessions):
+    """Patient and psychologist name lookups for a list of sessions (independent)."""
+    # collect ids for enrichment
+    patient_ids = set()
+    psych_ids = set()
+    for s in sessions:
+        for pid in s.get('patient_ids', []):
+            patient_ids.add(pid)
+        if s.get('psychologist_id'):
+            psych_ids.add(s.get('psychologist_id'))
+
+    queries = {}
+    if patient_ids:
+        queries['patients'] = ('patients', 'find', {
+            'filter': {"_id": {"$in": [ObjectId(pid) for pid in patient_ids if ObjectId.is_valid(pid)]}},
+            'projection': {'name': 1},
+        })
+    if psych_ids:
+        queries['users'] = ('users', 'find', {
+            'filter': {"_id": {"$in": [ObjectId(pid) for pid in psych_ids if ObjectId.is_valid(pid)]}},
+            'projection': {'name': 1, 'username': 1},
+        })
+    return queries
+
+
+def build_psych_sessions(sessions, names):
+    patient_map = {str(p['_id']): p.get('name', 'Unknown') for p in names.get('patients', [])}
+    psych_map = {str(u['_id']): u.get('name', u.get('username', 'Psych')) for u in names.get('users', [])}
+
+    result = []
+    for s in sessions:
+        result.append({
+            '_id': str(s['_id']),
+            'psychologist_id': s.get('psychologist_id'),
+            'psychologist_name': psych_map.get(s.get('psychologist_id', ''), s.get('psychologist_id', '')),
+            'date': s.get('date').strftime('%Y-%m-%d') if s.get('date') else '',
+            'time_slot': s.get('time_slot', ''),
+            'patient_ids': s.get('patient_ids', []),
+            'patient_names': [patient_map.get(pid, 'Unknown') for pid in s.get('patient_ids', [])],
+            'title': s.get('title', ''),
+            'note': s.get('note', ''),
+            'note_detail': s.get('note_detail'),
+            'note_author': s.get('note_author', ''),
+            'note_at': s.get('note_at').isoformat() if s.get('note_at') else None
+        })
+    return result
 
-    try:
-        sessions_cursor = mongo.db.psych_sessions.find(query).sort('date', 1)
-        sessions = list(sessions_cursor)
-
-        # collect ids for enrichment
-        patient_ids = set()
-        psych_ids = set()
-        for s in sessions:
-            for pid in s.get('patient_ids', []):
-                patient_ids.add(pid)
-            if s.get('psychologist_id'):
-                psych_ids.add(s.get('psychologist_id'))
-
-        patient_map = {}
-        if patient_ids:
-            patients = mongo.db.patients.find({"_id": {"$in": [ObjectId(pid) for pid in patient_ids if ObjectId.is_valid(pid)]}})
-            for p in patients:
-                patient_map[str(p['_id'])] = p.get('name', 'Unknown')
 
-        psych_map = {}
-        if psych_ids:
-            users = mongo.db.users.find({"_id": {"$in": [ObjectId(pid) for pid in psych_ids if ObjectId.is_valid(pid)]}})
-            for u in users:
-                psych_map[str(u['_id'])] = u.get('name', u.get('username', 'Psych'))
+@app.route('/api/psych-sessions', methods=['GET'])
+@login_required
+def list_psych_sessions():
+    if not check_db():
+        return jsonify({"error": "Database error"}), 500
 
-        result = []
-        for s in sessions:
-            result.append({
-                '_id': str(s['_id']),
-                'psychologist_id': s.get('psychologist_id'),
-                'psychologist_name': psych_map.get(s.get('psychologist_id', ''), s.get('psychologist_id', '')),
-                'date': s.get('date').strftime('%Y-%m-%d') if s.get('date') else '',
-                'time_slot': s.get('time_slot', ''),
-                'patient_ids': s.get('patient_ids', []),
-                'patient_names': [patient_map.get(pid, 'Unknown') for pid in s.get('patient_ids', [])],
-                'title': s.get('title', ''),
-                'note': s.get('note', ''),
-                'note_detail': s.get('note_detail'),
-                'note_author': s.get('note_author', ''),
-                'note_at': s.get('note_at').isoformat() if s.get('note_at') else None
-            })
+    query = psych_sessions_query(session.get('role'), session.get('user_id'), request.args)
 
-        return jsonify(result)
+    try:
+        sessions = list(mongo.db.psych_sessions.find(query).sort('date', 1))
+        names = run_read_queries(psych_session_name_queries(sessions))
+        return jsonify(build_psych_sessions(sessions, names))
     except Exception as e:
         print(f"Psych sessions fetch error: {e}")
         return jsonify({"error": str(e)}), 500
@@ -2664,11 +5306,8 @@ def add_psych_session_note(session_id):
         print(f"Psych session note error: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/attendance')
-def get_attendance():
-    year = int(request.args.get('year'))
-    month = int(request.args.get('month'))
-
+def compute_attendance_grid(month, year):
+    """{employee_id: {day: mark}} for a month."""
     records = mongo.db.attendance.find({
         "year": year,
         "month": month
@@ -2678,8 +5317,15 @@ def get_attendance():
     for rec in records:
         emp_id = str(rec["employee_id"])
         result[emp_id] = rec.get("days", {})
+    return result
+
+@app.route('/api/attendance')
+def get_attendance():
+    year = int(request.args.get('year'))
+    month = int(request.args.get('month'))
 
-    return jsonify(result)
+    snapshot = closed_month_report('attendance', month, year)
+    return jsonify(snapshot if snapshot is not None else compute_attendance_grid(month, year))
 
 @app.route('/api/attendance', methods=['POST'])
 def save_attendance():
@@ -2691,6 +5337,9 @@ def save_attendance():
     month = int(data['month'])
     mark = data['mark']  # 'P', 'A', or ''
 
+    blocked = month_write_guard(month, year, ('attendance',))
+    if blocked: return blocked
+
     query = {
         "employee_id": employee_id,
         "year": year,
@@ -2713,19 +5362,21 @@ def save_attendance():
     return jsonify(success=True)
 
 # --- EMERGENCY DASHBOARD APIs ---
+def serialize_emergency_alert(a):
+    a['_id'] = str(a['_id'])
+    # Format: 12 Oct, 04:30 PM
+    if a.get('created_at'):
+        a['date'] = a['created_at'].strftime('%d %b, %I:%M %p')
+    else:
+        a['date'] = 'Just now'
+    return a
+
 @app.route('/api/emergency', methods=['GET'])
 @login_required
 def get_emergency_alerts():
     if not check_db(): return jsonify({"error": "Database error"}), 500
     try:
-        alerts = list(mongo.db.emergency_alerts.find().sort('created_at', -1))
-        for a in alerts:
-            a['_id'] = str(a['_id'])
-            # Format: 12 Oct, 04:30 PM
-            if a.get('created_at'):
-                a['date'] = a['created_at'].strftime('%d %b, %I:%M %p')
-            else:
-                a['date'] = 'Just now'
+        alerts = [serialize_emergency_alert(a) for a in mongo.db.emergency_alerts.find().sort('created_at', -1)]
         return jsonify(alerts)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -2744,6 +5395,7 @@ def add_emergency_alert():
             'created_at': datetime.now()
         }
         mongo.db.emergency_alerts.insert_one(alert)
+        publish_event('emergency', {'action': 'added', 'alert': serialize_emergency_alert(dict(alert))})
         return jsonify({"message": "Alert added"}), 201
     except Exception as e:
         print(f"Emergency Save Error: {e}") # Added debug print
@@ -2754,7 +5406,9 @@ def add_emergency_alert():
 def delete_emergency_alert(id):
     if not check_db(): return jsonify({"error": "Database error"}), 500
     try:
-        mongo.db.emergency_alerts.delete_one({'_id': ObjectId(id)})
+        result = mongo.db.emergency_alerts.delete_one({'_id': ObjectId(id)})
+        if result.deleted_count:
+            publish_event('emergency', {'action': 'resolved', 'id': id})
         return jsonify({"message": "Alert resolved"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -2820,22 +5474,23 @@ def get_patient_payment_history(id):
 
 # --- OLD BALANCE / RECOVERY ROUTES ---
 
+def serialize_old_balance(b):
+    return {
+        'id': str(b['_id']),
+        'name': b.get('name', ''),
+        'amount': b.get('amount', 0),
+        'commitment_date': b.get('commitment_date', ''),
+        'last_call_date': b.get('last_call_date', ''),
+        'note': b.get('note', '')
+    }
+
 @app.route('/api/old-balances', methods=['GET'])
 @role_required(['Admin'])
 def get_old_balances():
     if not check_db(): return jsonify({"error": "Database error"}), 500
     try:
         cursor = mongo.db.old_balances.find().sort('created_at', -1)
-        balances = []
-        for b in cursor:
-            balances.append({
-                'id': str(b['_id']),
-                'name': b.get('name', ''),
-                'amount': b.get('amount', 0),
-                'commitment_date': b.get('commitment_date', ''),
-                'last_call_date': b.get('last_call_date', ''),
-                'note': b.get('note', '')
-            })
+        balances = [serialize_old_balance(b) for b in cursor]
         return jsonify(balances)
     except Exception as e:
         print(f"Old Balance Fetch Error: {e}")
@@ -2854,6 +5509,7 @@ def add_old_balance():
             'last_call_date': data.get('last_call_date'),
             'note': data.get('note', ''),
             'created_at': datetime.now(),
+            'updated_at': datetime.now(),
             'added_by': session.get('username')
         }
         result = mongo.db.old_balances.insert_one(record)
@@ -2866,11 +5522,1235 @@ def add_old_balance():
 def delete_old_balance(id):
     if not check_db(): return jsonify({"error": "Database error"}), 500
     try:
-        mongo.db.old_balances.delete_one({'_id': ObjectId(id)})
+        result = mongo.db.old_balances.delete_one({'_id': ObjectId(id)})
+        if result.deleted_count:
+            record_tombstone('old_balances', id)
         return jsonify({"message": "Record deleted"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# --- ARCHIVE (DISCHARGED PATIENTS & CLOSED CANTEEN MONTHS) ---
+#
+# Settled patients discharged before the archive cutoff (the start of the month
+# ARCHIVE_AFTER_MONTHS back) are moved out of the hot collections: the patient
+# into `patients_archive` with a pre-summed `archive` block (canteen totals per
+# month and the discharge bill balances), their canteen rows into
+# `canteen_sales_archive`, and their daily canteen amounts are added to
+# `canteen_archive_daily`, which the overhead reports union back in so monthly
+# and annual canteen revenue is unchanged. A patient still owing money, with
+# canteen rows on or after the cutoff, or with any month of their stay or their
+# canteen rows not yet closed, is left in place. Per-patient views (the canteen
+# monthly table) read only the hot collections, so archiving is limited to
+# finished months, whose closed snapshots still list the patient. The accounts
+# summary covers current patients only, so settled archived patients leave it;
+# they can be searched and restored on demand.
+
+ARCHIVE_AFTER_MONTHS = int(os.environ.get('ARCHIVE_AFTER_MONTHS', '3'))
+ARCHIVE_FIELDS = ('archive', 'archived_at', 'archived_by')
+
+
+def archive_cutoff(months=None):
+    return _month_start_n_months_ago(ARCHIVE_AFTER_MONTHS if months is None else months)
+
+
+def archived_canteen_daily_union(start_date, end_date, project=None):
+    """$unionWith stage adding archived daily canteen amounts ({date, amount}) to a report pipeline."""
+    return {'$unionWith': {
+        'coll': 'canteen_archive_daily',
+        'pipeline': [{'$match': {'date': {'$gte': start_date, '$lt': end_date}}}] + ([{'$project': project}] if project else [])
+    }}
+
+
+def summarize_archived_canteen(rows):
+    """Pre-sum a patient's canteen rows: totals, per-month totals and per-day amounts."""
+    total = spent = 0
+    months = {}
+    daily = {}
+    for row in rows:
+        amount = row.get('amount', 0) or 0
+        total += amount
+        if row.get('entry_type') != 'other':
+            spent += amount
+        date = row.get('date')
+        if isinstance(date, datetime):
+            month = months.setdefault((date.year, date.month), {'year': date.year, 'month': date.month, 'total': 0, 'entries': 0})
+            month['total'] += amount
+            month['entries'] += 1
+            day = date.strftime('%Y-%m-%d')
+            daily[day] = daily.get(day, 0) + amount
+    return {
+        'canteenTotal': total,
+        'canteenSpent': spent,
+        'months': [months[key] for key in sorted(months)],
+    }, daily
+
+
+def apply_archived_daily(daily, sign):
+    """Add (sign=1) or remove (sign=-1) a patient's daily canteen amounts from the pre-summed days."""
+    if daily:
+        mongo.db.canteen_archive_daily.bulk_write([
+            UpdateOne(
+                {'_id': day},
+                {'$inc': {'amount': sign * amount}, '$setOnInsert': {'date': datetime.strptime(day, '%Y-%m-%d')}},
+                upsert=True
+            )
+            for day, amount in daily.items()
+        ], ordered=False)
+
+
+def months_closed(months):
+    """True if every (year, month) in `months` has been closed."""
+    keys = [month_close_key(month, year) for year, month in months]
+    return mongo.db.month_closes.count_documents({'_id': {'$in': keys}, 'status': 'closed'}) == len(keys)
+
+
+def archivable_canteen(patient, cutoff):
+    """
+    Canteen rows and pre-summed archive block of a discharged patient, or None
+    when the patient is not settled, still has canteen rows on or after the cutoff,
+    or has a month of their stay or canteen rows that is not closed.
+    """
+    discharged_at = _parse_iso_date(str(patient.get('dischargeDate') or '')[:10])
+    if discharged_at is None or discharged_at >= cutoff:
+        return None
+
+    rows = list(canteen_find({'patient_id': patient['_id']}))
+    if any(isinstance(r.get('date'), datetime) and r['date'] >= cutoff for r in rows):
+        return None
+
+    summary, daily = summarize_archived_canteen(rows)
+    months = {(m['year'], m['month']) for m in summary['months']}
+    month = _parse_iso_date(str(patient.get('admissionDate') or '')[:10]) or discharged_at
+    while month <= discharged_at:
+        months.add((month.year, month.month))
+        month = (month.replace(day=1) + timedelta(days=32)).replace(day=1)
+    if not months_closed(months):
+        return None
+
+    bill = compute_discharge_bill_data(patient, summary['canteenTotal'], as_of=discharged_at)
+    if bill['Balance Due'] > 0:
+        return None
+    summary['bill'] = bill
+    summary['daily'] = daily
+    return rows, summary
+
+
+def canteen_rows_signature(rows):
+    return sorted((str(r['_id']), r.get('amount', 0), str(r.get('updated_at'))) for r in rows)
+
+
+def discard_archive_copy(patient_id, summary):
+    """Undo the archive copies of a patient whose hot data was left in place."""
+    if mongo.db.patients_archive.update_one(
+        {'_id': patient_id, 'archive.carried': True}, {'$set': {'archive.carried': False}}
+    ).modified_count:
+        apply_archived_daily(summary['daily'], -1)
+    mongo.db.canteen_sales_archive.delete_many({'patient_id': patient_id})
+    mongo.db.patients_archive.delete_one({'_id': patient_id})
+
+
+def archive_patient(patient, cutoff, archived_by=None):
+    """Move one discharged patient and their canteen rows to the archive. Returns the summary or None."""
+    archivable = archivable_canteen(patient, cutoff)
+    if archivable is None:
+        return None
+    rows, summary = archivable
+
+    # Copies first, so an interrupted run leaves the hot data intact and can be repeated
+    mongo.db.patients_archive.replace_one(
+        {'_id': patient['_id']},
+        {**patient, 'archive': summary, 'archived_at': datetime.now(), 'archived_by': archived_by},
+        upsert=True
+    )
+    if rows:
+        mongo.db.canteen_sales_archive.bulk_write(
+            [ReplaceOne({'_id': r['_id']}, r, upsert=True) for r in rows], ordered=False
+        )
+    # Carry the daily amounts forward exactly once, even if this patient is archived again after a crash
+    if mongo.db.patients_archive.update_one(
+        {'_id': patient['_id'], 'archive.carried': {'$ne': True}}, {'$set': {'archive.carried': True}}
+    ).modified_count:
+        apply_archived_daily(summary['daily'], 1)
+
+    # Only delete what was copied: give up if the patient or their canteen rows
+    # changed since they were read
+    current = list(canteen_find({'patient_id': patient['_id']}))
+    if canteen_rows_signature(current) != canteen_rows_signature(rows) or not mongo.db.patients.delete_one(
+        {'_id': patient['_id'], 'updated_at': patient.get('updated_at')}
+    ).deleted_count:
+        discard_archive_copy(patient['_id'], summary)
+        return None
+
+    delete_canteen_entries(rows)
+    record_tombstone('patients', patient['_id'])
+    # A sale recorded between the check and the deletes would be left without its patient
+    if next(iter(canteen_find({'patient_id': patient['_id']}, {'_id': 1}, limit=1)), None):
+        restore_archived_patient(patient['_id'])
+        return None
+    return summary
+
+
+def run_patient_archive(months=None, dry_run=False, archived_by=None):
+    """Archive every eligible patient. Returns counts and the archived/skipped patient ids."""
+    cutoff = archive_cutoff(months)
+    candidates = mongo.db.patients.find({
+        'isDischarged': True,
+        'dischargeDate': {'$type': 'string', '$lt': cutoff.strftime('%Y-%m-%d')}
+    })
+
+    archived, skipped = [], []
+    for patient in candidates:
+        if dry_run:
+            eligible = archivable_canteen(patient, cutoff) is not None
+        else:
+            eligible = archive_patient(patient, cutoff, archived_by) is not None
+        (archived if eligible else skipped).append(str(patient['_id']))
+
+    if archived and not dry_run:
+        bump_data_version('patients', 'canteen_sales')
+    return {
+        'cutoff': cutoff.strftime('%Y-%m-%d'),
+        'dry_run': dry_run,
+        'archived': len(archived),
+        'skipped': len(skipped),
+        'archived_ids': archived,
+        'skipped_ids': skipped,
+    }
+
+
+def restore_archived_patient(patient_id):
+    """Move an archived patient and their canteen rows back. Returns False if not archived."""
+    archived = mongo.db.patients_archive.find_one({'_id': patient_id})
+    if not archived:
+        return False
+
+    rows = list(mongo.db.canteen_sales_archive.find({'patient_id': patient_id}))
+    now = datetime.now()
+    restore_canteen_entries([{**r, 'updated_at': now} for r in rows])
+    patient = {k: v for k, v in archived.items() if k not in ARCHIVE_FIELDS}
+    patient['updated_at'] = now
+    mongo.db.patients.replace_one({'_id': patient_id}, patient, upsert=True)
+    mongo.db.tombstones.delete_many({'collection': 'patients', 'doc_id': str(patient_id)})
+
+    if mongo.db.patients_archive.update_one(
+        {'_id': patient_id, 'archive.carried': True}, {'$set': {'archive.carried': False}}
+    ).modified_count:
+        apply_archived_daily(archived['archive'].get('daily', {}), -1)
+
+    mongo.db.canteen_sales_archive.delete_many({'patient_id': patient_id})
+    mongo.db.patients_archive.delete_one({'_id': patient_id})
+    bump_data_version('patients', 'canteen_sales')
+    return True
+
+
+def serialize_archived_patient(p, detail=False):
+    archive = p.get('archive', {})
+    data = {
+        'id': str(p['_id']),
+        'name': p.get('name', ''),
+        'fatherName': p.get('fatherName', ''),
+        'cnic': p.get('cnic', ''),
+        'admissionDate': p.get('admissionDate', ''),
+        'dischargeDate': p.get('dischargeDate', ''),
+        'archivedAt': p['archived_at'].isoformat() if p.get('archived_at') else None,
+        'canteenTotal': archive.get('canteenTotal', 0),
+        'canteenSpent': archive.get('canteenSpent', 0),
+        'balanceDue': archive.get('bill', {}).get('Balance Due', 0),
+    }
+    if detail:
+        data['bill'] = archive.get('bill', {})
+        data['canteenMonths'] = archive.get('months', [])
+    return data
+
+
+@app.route('/api/archive/run', methods=['POST'])
+@role_required(['Admin'])
+def run_archive():
+    """Archive settled patients discharged before the cutoff. Body: {"months": 3, "dry_run": false}."""
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    data = request.get_json(silent=True) or {}
+    try:
+        months = int(data['months']) if data.get('months') is not None else None
+        if months is not None and months < 1:
+            return jsonify({"error": "months must be at least 1"}), 400
+        result = run_patient_archive(months, bool(data.get('dry_run')), session.get('username'))
+        return jsonify(result)
+    except ValueError as ve:
+        return jsonify({"error": f"Invalid data format: {str(ve)}"}), 400
+    except Exception as e:
+        print(f"Archive Run Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/archive/patients', methods=['GET'])
+@role_required(['Admin'])
+def search_archived_patients():
+    """Search archived patients by name, father name or CNIC (?q=), newest discharge first."""
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    try:
+        query = {}
+        term = (request.args.get('q') or '').strip()
+        if term:
+            pattern = {'$regex': re.escape(term), '$options': 'i'}
+            query = {'$or': [{'name': pattern}, {'fatherName': pattern}, {'cnic': pattern}]}
+        limit = min(int(request.args.get('limit', 50)), 500)
+        cursor = mongo.db.patients_archive.find(
+            query, {'photo1': 0, 'photo2': 0, 'photo3': 0, 'archive.daily': 0}
+        ).sort('dischargeDate', -1).limit(limit)
+        return jsonify([serialize_archived_patient(p) for p in cursor])
+    except Exception as e:
+        print(f"Archive Search Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/archive/patients/<id>', methods=['GET'])
+@role_required(['Admin'])
+def get_archived_patient(id):
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    try:
+        p = mongo.db.patients_archive.find_one({'_id': ObjectId(id)}, {'archive.daily': 0})
+        if not p:
+            return jsonify({"error": "Archived patient not found"}), 404
+        return jsonify(serialize_archived_patient(p, detail=True))
+    except Exception as e:
+        print(f"Archive Fetch Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/archive/patients/<id>/restore', methods=['POST'])
+@role_required(['Admin'])
+def restore_archive_patient(id):
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    try:
+        if not restore_archived_patient(ObjectId(id)):
+            return jsonify({"error": "Archived patient not found"}), 404
+        return jsonify({"message": "Patient restored"})
+    except Exception as e:
+        print(f"Archive Restore Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.cli.command('archive-patients')
+def archive_patients_command():
+    """Archive settled patients discharged before the cutoff (flask --app app archive-patients)."""
+    result = run_patient_archive(archived_by='cli')
+    print(f"Archived {result['archived']} patients, skipped {result['skipped']} (cutoff {result['cutoff']})")
+
+
+# --- MONTH CLOSE ---
+#
+# Closing a past month freezes its reports: each one is computed once and
+# stored as an insert-only snapshot in `month_snapshots` (JSON text plus a
+# sha256), and `month_closes` points at the current snapshot of each report.
+# While a month is closed its reports are served from the snapshots, and writes
+# that touch it are refused with 409 unless the month is reopened or the write
+# is sent as an adjustment (Admin only, with `adjustment_reason` in the body or
+# an X-Adjustment-Reason header). An adjustment is logged in
+# `month_adjustments` and the affected reports are re-frozen as a new version;
+# earlier snapshots are kept.
+
+# Reports changed by a canteen sale or daily entry
+CANTEEN_MONTH_REPORTS = ('canteen_table', 'overheads')
+
+
+def month_close_key(month, year):
+    return f"{year}-{month:02d}"
+
+
+def is_payment_record(expense):
+    """Patient fee receipts are what the payment-record export lists."""
+    return expense.get('type') == 'incoming' and expense.get('category') == 'Patient Fee'
+
+
+def payment_records_month(month, year):
+    start = datetime(year, month, 1)
+    end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    return list(iter_live_payment_record_rows(start, end))
+
+
+# report -> compute(month, year); the snapshot is the route's JSON payload
+MONTH_CLOSE_REPORTS = {
+    'canteen_table': compute_canteen_monthly_table,
+    'overheads': compute_overheads_month,
+    'call_meeting_summary': compute_call_meeting_summary,
+    'payment_records': payment_records_month,
+    'attendance': compute_attendance_grid,
+}
+
+
+def get_month_close(month, year):
+    return mongo.db.month_closes.find_one({'_id': month_close_key(month, year), 'status': 'closed'})
+
+
+def closed_month_report(report, month, year):
+    """The frozen payload of a report for a closed month, or None if the month is open."""
+    close = get_month_close(month, year)
+    if not close or report not in close.get('snapshots', {}):
+        return None
+    snapshot = mongo.db.month_snapshots.find_one({'_id': close['snapshots'][report]}, {'payload': 1})
+    return json.loads(snapshot['payload']) if snapshot else None
+
+
+def freeze_month_report(report, month, year, version, created_by, reason=None):
+    """Compute a report and store it as a new snapshot. Returns the snapshot id."""
+    payload = app.json.dumps(MONTH_CLOSE_REPORTS[report](month, year))
+    return mongo.db.month_snapshots.insert_one({
+        'month': month,
+        'year': year,
+        'report': report,
+        'version': version,
+        'payload': payload,
+        'sha256': hashlib.sha256(payload.encode('utf-8')).hexdigest(),
+        'reason': reason,
+        'created_by': created_by,
+        'created_at': datetime.now()
+    }).inserted_id
+
+
+def month_write_guard(month, year, reports):
+    """
+    Call before a write that changes the given reports of (month, year).
+    Returns a 409 response when the month is closed and the request is not an
+    adjustment; for an adjustment the reports are re-frozen after the write succeeds.
+    """
+    close = get_month_close(month, year)
+    if close is None:
+        return None
+
+    body = request.get_json(silent=True)
+    reason = (body.get('adjustment_reason') if isinstance(body, dict) else None) or request.headers.get('X-Adjustment-Reason')
+    if not reason or session.get('role') != 'Admin':
+        return jsonify({
+            "error": f"{month_close_key(month, year)} is closed. Reopen the month or send the change as an adjustment with an adjustment_reason.",
+            "closed": True
+        }), 409
+
+    @after_this_request
+    def record_adjustment(response):
+        if response.status_code < 300:
+            try:
+                record_month_adjustment(month, year, reports, reason)
+            except Exception as e:
+                print(f"Month Adjustment Error: {e}")
+        return response
+    return None
+
+
+def record_month_adjustment(month, year, reports, reason):
+    """Log an adjustment to a closed month and re-freeze the reports it changed."""
+    username = session.get('username')
+    close = mongo.db.month_closes.find_one_and_update(
+        {'_id': month_close_key(month, year), 'status': 'closed'},
+        {'$inc': {'version': 1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if close is None:
+        return
+    now = datetime.now()
+    mongo.db.month_adjustments.insert_one({
+        'month': month,
+        'year': year,
+        'reports': list(reports),
+        'reason': reason,
+        'method': request.method,
+        'path': request.path,
+        'recorded_by': username,
+        'recorded_at': now,
+        'version': close['version']
+    })
+    snapshots = {
+        f'snapshots.{report}': freeze_month_report(report, month, year, close['version'], username, reason)
+        for report in reports
+    }
+    mongo.db.month_closes.update_one(
+        {'_id': close['_id']},
+        {'$set': {**snapshots, 'adjusted_at': now},
+         '$push': {'history': {'action': 'adjusted', 'by': username, 'at': now, 'reason': reason, 'reports': list(reports)}}}
+    )
+
+
+def serialize_month_close(close, detail=False):
+    data = {
+        'month': close['month'],
+        'year': close['year'],
+        'status': close['status'],
+        'version': close.get('version', 1),
+        'closedAt': close['closed_at'].isoformat() if close.get('closed_at') else None,
+        'closedBy': close.get('closed_by'),
+        'adjustedAt': close['adjusted_at'].isoformat() if close.get('adjusted_at') else None,
+    }
+    if detail:
+        data['history'] = [
+            {**h, 'at': h['at'].isoformat() if h.get('at') else None} for h in close.get('history', [])
+        ]
+        snapshots = {}
+        for s in mongo.db.month_snapshots.find({'_id': {'$in': list(close.get('snapshots', {}).values())}}):
+            snapshots[s['report']] = {
+                'version': s['version'],
+                'createdAt': s['created_at'].isoformat(),
+                'intact': hashlib.sha256(s['payload'].encode('utf-8')).hexdigest() == s['sha256']
+            }
+        data['snapshots'] = snapshots
+        data['adjustments'] = [{
+            'reports': a['reports'],
+            'reason': a['reason'],
+            'path': a['path'],
+            'recordedBy': a.get('recorded_by'),
+            'recordedAt': a['recorded_at'].isoformat(),
+            'version': a['version']
+        } for a in mongo.db.month_adjustments.find({'month': close['month'], 'year': close['year']}).sort('recorded_at', 1)]
+    return data
+
+
+@app.route('/api/month-close', methods=['GET'])
+@role_required(['Admin'])
+def list_month_closes():
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    try:
+        closes = mongo.db.month_closes.find().sort([('year', -1), ('month', -1)])
+        return jsonify([serialize_month_close(c) for c in closes])
+    except Exception as e:
+        print(f"Month Close List Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/month-close/<int:month>/<int:year>', methods=['GET'])
+@role_required(['Admin'])
+def get_month_close_status(month, year):
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    try:
+        close = mongo.db.month_closes.find_one({'_id': month_close_key(month, year)})
+        if not close:
+            return jsonify({'month': month, 'year': year, 'status': 'open'})
+        return jsonify(serialize_month_close(close, detail=True))
+    except Exception as e:
+        print(f"Month Close Status Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/month-close/<int:month>/<int:year>', methods=['POST'])
+@role_required(['Admin'])
+def close_month(month, year):
+    """Freeze every month-close report of a past month."""
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    if not 1 <= month <= 12:
+        return jsonify({"error": "Invalid month"}), 400
+    today = datetime.now()
+    if (year, month) >= (today.year, today.month):
+        return jsonify({"error": "Only past months can be closed"}), 400
+
+    key = month_close_key(month, year)
+    username = session.get('username')
+    try:
+        existing = mongo.db.month_closes.find_one({'_id': key})
+        if existing and existing['status'] == 'closed':
+            return jsonify({"error": f"{key} is already closed"}), 409
+
+        version = (existing or {}).get('version', 0) + 1
+        snapshots = {
+            report: freeze_month_report(report, month, year, version, username)
+            for report in MONTH_CLOSE_REPORTS
+        }
+        now = datetime.now()
+        mongo.db.month_closes.update_one(
+            {'_id': key},
+            {'$set': {
+                'month': month,
+                'year': year,
+                'status': 'closed',
+                'version': version,
+                'snapshots': snapshots,
+                'closed_at': now,
+                'closed_by': username
+            }, '$push': {'history': {'action': 'closed', 'by': username, 'at': now}}},
+            upsert=True
+        )
+        return jsonify(serialize_month_close(mongo.db.month_closes.find_one({'_id': key}), detail=True))
+    except Exception as e:
+        print(f"Month Close Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/month-close/<int:month>/<int:year>/reopen', methods=['POST'])
+@role_required(['Admin'])
+def reopen_month(month, year):
+    """Serve the month live again and allow edits. Body: {"reason": "..."}."""
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    reason = ((request.get_json(silent=True) or {}).get('reason') or '').strip()
+    if not reason:
+        return jsonify({"error": "A reason is required to reopen a month"}), 400
+    try:
+        username = session.get('username')
+        result = mongo.db.month_closes.update_one(
+            {'_id': month_close_key(month, year), 'status': 'closed'},
+            {'$set': {'status': 'reopened'},
+             '$push': {'history': {'action': 'reopened', 'by': username, 'at': datetime.now(), 'reason': reason}}}
+        )
+        if not result.modified_count:
+            return jsonify({"error": f"{month_close_key(month, year)} is not closed"}), 409
+        return jsonify({"message": "Month reopened"})
+    except Exception as e:
+        print(f"Month Reopen Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# --- REQUEST PROFILING ---
+#
+# With REQUEST_PROFILING=1, an admin can profile a single request by sending
+# the header "X-Profile: sample" (or "cprofile"), or by adding ?_profile=sample.
+# "sample" polls the request thread's stack every PROFILE_SAMPLE_INTERVAL_MS and
+# writes collapsed stacks (<id>.folded, ready for flamegraph.pl/speedscope);
+# "cprofile" runs cProfile and writes <id>.prof (pstats). Both write <id>.json
+# with the request, timings and every Mongo command it issued. When the setting
+# is off nothing is installed, and when it is on unflagged requests only pay a
+# header lookup.
+
+REQUEST_PROFILING = os.environ.get('REQUEST_PROFILING') == '1'
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'pro_crm_profiles'))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', '2'))
+PROFILE_MAX_KEPT = 200
+PROFILE_MODES = ('sample', 'cprofile')
+PROFILE_ARTIFACTS = {'json': 'application/json', 'folded': 'text/plain', 'prof': 'application/octet-stream'}
+PROFILE_EXCLUDED_PATHS = ('/api/events',)  # Never ends, so it cannot be buffered
+
+profile_local = threading.local()
+
+
+class ProfileCommandListener(monitoring.CommandListener):
+    """Records Mongo commands issued by a thread that is being profiled."""
+
+    def started(self, event):
+        commands = getattr(profile_local, 'commands', None)
+        if commands is not None:
+            target = event.command.get(event.command_name)
+            profile_local.pending[event.request_id] = (
+                event.command_name, target if isinstance(target, str) else None, time.perf_counter()
+            )
+
+    def _finish(self, event, ok):
+        commands = getattr(profile_local, 'commands', None)
+        if commands is None:
+            return
+        name, collection, started = profile_local.pending.pop(event.request_id, (event.command_name, None, None))
+        commands.append({
+            'command': name,
+            'collection': collection,
+            'ms': round(event.duration_micros / 1000, 3),
+            'offset_ms': round((started - profile_local.started) * 1000, 3) if started else None,
+            'ok': ok,
+        })
+
+    def succeeded(self, event):
+        self._finish(event, True)
+
+    def failed(self, event):
+        self._finish(event, False)
+
+
+def requested_profile_mode(environ):
+    mode = environ.get('HTTP_X_PROFILE')
+    if mode is None and '_profile=' in environ.get('QUERY_STRING', ''):
+        mode = parse_qs(environ['QUERY_STRING']).get('_profile', ['sample'])[0]
+    if mode is None:
+        return None
+    return mode if mode in PROFILE_MODES else 'sample'
+
+
+def profile_request_allowed(environ):
+    """Only admins may profile; the session cookie is read without a request context."""
+    if environ.get('PATH_INFO') in PROFILE_EXCLUDED_PATHS:
+        return False
+    user_session = app.session_interface.open_session(app, app.request_class(environ))
+    return user_session is not None and user_session.get('role') == 'Admin'
+
+
+def sample_thread_stacks(thread_id, stop, counts):
+    """Count collapsed stacks of one thread until stop is set."""
+    interval = PROFILE_SAMPLE_INTERVAL_MS / 1000
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            key = ';'.join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+
+
+def prune_profiles():
+    """Keep only the newest PROFILE_MAX_KEPT profiles."""
+    reports = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith('.json'))
+    for name in reports[:-PROFILE_MAX_KEPT]:
+        profile_id = name[:-len('.json')]
+        for ext in PROFILE_ARTIFACTS:
+            try:
+                os.remove(os.path.join(PROFILE_DIR, f"{profile_id}.{ext}"))
+            except OSError:
+                pass
+
+
+def run_profiled_request(wsgi_app, environ, start_response, mode):
+    """Run one request under the profiler, buffer its response and save the profile."""
+    captured = {'written': []}
+
+    def capture_start_response(status, headers, exc_info=None):
+        captured['status'] = status
+        captured['headers'] = headers
+        captured['exc_info'] = exc_info
+        return captured['written'].append
+
+    profile_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.urandom(4).hex()}"
+    profile_local.started = time.perf_counter()
+    profile_local.pending = {}
+    profile_local.commands = []
+    counts = {}
+    profiler = None
+    stop = threading.Event()
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        sampler = threading.Thread(target=sample_thread_stacks, args=(threading.get_ident(), stop, counts), daemon=True)
+        sampler.start()
+    try:
+        app_iter = wsgi_app(environ, capture_start_response)
+        try:
+            body = b''.join(captured['written']) + b''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        else:
+            stop.set()
+            sampler.join()
+        elapsed_ms = (time.perf_counter() - profile_local.started) * 1000
+        commands = profile_local.commands
+        profile_local.commands = None
+
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, profile_id)
+        if profiler is not None:
+            profiler.dump_stats(f"{base}.prof")
+        else:
+            with open(f"{base}.folded", 'w', encoding='utf-8') as f:
+                for stack, count in sorted(counts.items()):
+                    f.write(f"{stack} {count}\n")
+        with open(f"{base}.json", 'w', encoding='utf-8') as f:
+            json.dump({
+                'id': profile_id,
+                'mode': mode,
+                'method': environ.get('REQUEST_METHOD'),
+                'path': environ.get('PATH_INFO'),
+                'query': environ.get('QUERY_STRING', ''),
+                'status': captured.get('status'),
+                'created_at': datetime.now().isoformat(),
+                'elapsed_ms': round(elapsed_ms, 3),
+                'samples': sum(counts.values()) if profiler is None else None,
+                'mongo_ms': round(sum(c['ms'] for c in commands), 3),
+                'mongo_commands': commands,
+            }, f, indent=1)
+        prune_profiles()
+    except Exception as e:
+        print(f"Profile Save Error: {e}")
+        profile_id = None
+
+    headers = list(captured['headers'])
+    if profile_id:
+        headers.append(('X-Profile-Id', profile_id))
+    start_response(captured['status'], headers, captured['exc_info'])
+    return [body]
+
+
+def profiling_middleware(wsgi_app):
+    def middleware(environ, start_response):
+        mode = requested_profile_mode(environ)
+        if mode is None or not profile_request_allowed(environ):
+            return wsgi_app(environ, start_response)
+        return run_profiled_request(wsgi_app, environ, start_response, mode)
+    return middleware
+
+
+if REQUEST_PROFILING:
+    app.wsgi_app = profiling_middleware(app.wsgi_app)
+    MONGO_EVENT_LISTENERS.append(ProfileCommandListener())
+
+
+@app.route('/api/profiles', methods=['GET'])
+@role_required(['Admin'])
+def list_profiles():
+    """Saved request profiles, newest first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return jsonify([])
+    try:
+        profiles = []
+        for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(PROFILE_DIR, name), encoding='utf-8') as f:
+                report = json.load(f)
+            report['mongo_command_count'] = len(report.pop('mongo_commands', []))
+            report['artifacts'] = [ext for ext in PROFILE_ARTIFACTS
+                                   if os.path.exists(os.path.join(PROFILE_DIR, f"{report['id']}.{ext}"))]
+            profiles.append(report)
+        return jsonify(profiles)
+    except Exception as e:
+        print(f"Profile List Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/profiles/<profile_id>/<artifact>', methods=['GET'])
+@role_required(['Admin'])
+def download_profile(profile_id, artifact):
+    if artifact not in PROFILE_ARTIFACTS or not re.fullmatch(r'[0-9]{8}-[0-9]{6}-[0-9a-f]{8}', profile_id):
+        return jsonify({"error": "Profile not found"}), 404
+    path = os.path.join(PROFILE_DIR, f"{profile_id}.{artifact}")
+    if not os.path.exists(path):
+        return jsonify({"error": "Profile not found"}), 404
+    return send_file(path, mimetype=PROFILE_ARTIFACTS[artifact], as_attachment=True,
+                     download_name=f"{profile_id}.{artifact}")
+
+
+# --- BATCHED READS ---
+#
+# POST /api/batch {"requests": [{"id": "dash", "path": "/api/dashboard"}, ...]}
+# runs several GET routes in one round trip. Each sub-request is dispatched
+# through the normal Flask pipeline with the caller's cookies, so session and
+# role checks apply exactly as if it had been sent on its own.
+
+BATCH_MAX_REQUESTS = 20
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', '6'))
+# Recursive, streaming or file-download endpoints; sub-requests must return JSON
+BATCH_EXCLUDED_ENDPOINTS = {
+    'batch_requests', 'stream_events', 'export_patients', 'export_payment_records',
+    'generate_discharge_bill', 'download_export_job', 'download_profile',
+}
+
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+
+
+def batch_path_allowed(path):
+    """True if `path` routes to a GET /api/ endpoint that may run inside a batch."""
+    if not isinstance(path, str):
+        return False
+    # Match the route the sub-request would actually reach, after percent-decoding
+    adapter = app.url_map.bind(request.host, url_scheme=request.scheme)
+    try:
+        rule, _ = adapter.match(unquote(path.split('?')[0]), method='GET', return_rule=True)
+    except HTTPException:
+        return False
+    return rule.rule.startswith('/api/') and rule.endpoint not in BATCH_EXCLUDED_ENDPOINTS
+
+
+def dispatch_subrequest(path, base_url, headers, trace_parent=None):
+    """Run one GET through the app and return {status, body}."""
+    environ = EnvironBuilder(path=path, method='GET', base_url=base_url, headers=headers).get_environ()
+    with trace_span(f"GET {path.split('?')[0]}", {'http.target': path}, parent=trace_parent), app.request_context(environ):
+        response = app.full_dispatch_request()
+    try:
+        if response.is_json:
+            return {'status': response.status_code, 'body': response.get_json()}
+        return {'status': response.status_code, 'body': None, 'error': 'Non-JSON response'}
+    finally:
+        response.close()
+
+
+@app.route('/api/batch', methods=['POST'])
+@login_required
+def batch_requests():
+    """Execute up to BATCH_MAX_REQUESTS independent GET sub-requests concurrently."""
+    data = request.get_json() or {}
+    sub_requests = data.get('requests')
+    if not isinstance(sub_requests, list) or not sub_requests:
+        return jsonify({"error": "requests must be a non-empty list"}), 400
+    if len(sub_requests) > BATCH_MAX_REQUESTS:
+        return jsonify({"error": f"At most {BATCH_MAX_REQUESTS} requests per batch"}), 400
+
+    for index, sub in enumerate(sub_requests):
+        if not isinstance(sub, dict):
+            return jsonify({"error": f"Request {index} must be an object"}), 400
+        path = sub.get('path')
+        method = str(sub.get('method', 'GET')).upper()
+        if method != 'GET':
+            return jsonify({"error": f"Request {index}: only GET is supported"}), 400
+        if not batch_path_allowed(path):
+            return jsonify({"error": f"Request {index}: path not allowed"}), 400
+
+    # Forward what identifies the caller; everything else is rebuilt per sub-request
+    headers = {k: v for k, v in request.headers.items() if k in ('Cookie', 'Authorization', 'Accept-Language')}
+    base_url = request.host_url
+
+    futures = [
+        batch_executor.submit(dispatch_subrequest, sub['path'], base_url, headers, current_span())
+        for sub in sub_requests
+    ]
+
+    responses = []
+    for sub, future in zip(sub_requests, futures):
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"Batch Sub-request Error ({sub['path']}): {e}")
+            result = {'status': 500, 'body': {"error": str(e)}}
+        responses.append({'id': sub.get('id', sub['path']), 'path': sub['path'], **result})
+
+    return jsonify({'responses': responses})
+
+
+# --- DELTA SYNC ---
+#
+# Writes to the synced collections stamp `updated_at`, and hard deletes leave
+# a row in `tombstones`. GET /api/sync?since=<token> returns only what changed
+# after the token, for the collections the caller's role may read. Without a
+# token (or with one older than the tombstone retention) it returns a full
+# snapshot and sets "full": true.
+
+SYNC_TOMBSTONE_RETENTION_DAYS = 30
+SYNC_OVERLAP_SECONDS = 5  # Re-send a few seconds to cover writes still in flight
+
+# collection -> roles allowed to read it (None = any logged-in user)
+SYNC_COLLECTIONS = {
+    'patients': None,
+    'expenses': None,
+    'employees': ['Admin'],
+    'old_balances': ['Admin'],
+    'utility_bills': ['Admin'],
+}
+
+
+def sync_changed_docs(name, since):
+    """Serialized documents of one collection changed after `since` (all when None)."""
+    query = {'updated_at': {'$gt': since}} if since else {}
+
+    if name == 'patients':
+        if since:
+            # Canteen sales change a patient's canteenSpent without touching the patient
+            touched = canteen_patients_changed_since(since)
+            if touched:
+                query = {'$or': [query, {'_id': {'$in': touched}}]}
+        patients = list(mongo.db.patients.find(query))
+        totals = canteen_spent_totals([p['_id'] for p in patients] if since else None)
+        return [serialize_patient(p, totals) for p in patients]
+    if name == 'expenses':
+        return [serialize_expense(e) for e in mongo.db.expenses.find(query, {'screenshot': 0})]
+    if name == 'employees':
+        return [serialize_employee(e) for e in mongo.db.employees.find(query)]
+    if name == 'old_balances':
+        return [serialize_old_balance(b) for b in mongo.db.old_balances.find(query)]
+    if name == 'utility_bills':
+        return [serialize_utility_bill(b) for b in mongo.db.utility_bills.find(query)]
+    return []
+
+
+@app.route('/api/sync', methods=['GET'])
+@login_required
+def sync_changes():
+    """
+    Return documents changed since `since` plus ids deleted since then.
+    ?collections=patients,expenses limits the response to those collections.
+    """
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+
+    role = session.get('role')
+    allowed = [name for name, roles in SYNC_COLLECTIONS.items() if roles is None or role in roles]
+    requested = request.args.get('collections')
+    collections = [c for c in requested.split(',') if c in allowed] if requested else allowed
+
+    since_str = request.args.get('since')
+    since = _parse_iso_date(since_str) if since_str else None
+    if since_str and since is None:
+        return jsonify({"error": "Invalid since token"}), 400
+
+    now = datetime.now()
+    if since and since < now - timedelta(days=SYNC_TOMBSTONE_RETENTION_DAYS):
+        since = None  # Deletes before this may be forgotten; start over
+
+    try:
+        changes = {name: sync_changed_docs(name, since) for name in collections}
+
+        deleted = {name: [] for name in collections}
+        if since:
+            for t in mongo.db.tombstones.find({'collection': {'$in': collections}, 'deleted_at': {'$gt': since}}):
+                deleted[t['collection']].append(t['doc_id'])
+
+        return jsonify({
+            'token': (now - timedelta(seconds=SYNC_OVERLAP_SECONDS)).isoformat(),
+            'full': since is None,
+            'changes': changes,
+            'deleted': deleted
+        })
+    except Exception as e:
+        print(f"Sync Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# --- SCHEDULED JOBS ---
+#
+# A small in-process scheduler runs the report precomputes and the KPI
+# snapshots once a day at SCHEDULER_RUN_AT (local time, HH:MM). Every worker
+# runs the scheduler thread, but each job has one document in scheduled_jobs
+# that doubles as its lock: a worker only runs a due job after claiming the
+# document with a lease, so a job runs once per day however many workers are
+# up. A worker that dies mid-run leaves the lease to expire and the job is
+# picked up again. Every run is also recorded in job_runs for the admin status
+# endpoint. The scheduler needs a long-lived process, so it is off unless
+# SCHEDULER_ENABLED=1 (gunicorn_conf.py sets it); serverless and ad-hoc
+# processes (CLI commands, scripts) leave it off.
+#
+# Report caches live in Mongo and help every worker, but precomputed exports are
+# files in EXPORT_CACHE_DIR: they only speed up downloads served by the host that
+# built them (a shared EXPORT_CACHE_DIR extends that to every host).
+#   GET  /api/admin/jobs              -> job status, next run and recent timings
+#   POST /api/admin/jobs/<name>/run   -> mark a job due now
+
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', '0') not in ('0', 'false', 'False')
+SCHEDULER_RUN_AT = os.environ.get('SCHEDULER_RUN_AT', '02:30')
+SCHEDULER_POLL_SECONDS = 60
+SCHEDULER_LEASE_SECONDS = 30 * 60
+JOB_RUN_RETENTION_DAYS = 30
+
+scheduler_wakeup = threading.Event()
+scheduler_lock = threading.Lock()
+scheduler_thread = None
+
+
+def precompute_export(kind, params):
+    """Build an export artifact on this host unless one for the current data already exists. Returns True if built."""
+    cache_key = export_cache_key(kind, params)
+    if os.path.exists(export_artifact_path(cache_key)):
+        return False
+    job_id = mongo.db.export_jobs.insert_one({
+        'kind': kind,
+        'params': params,
+        'cache_key': cache_key,
+        'status': 'queued',
+        'progress': 0,
+        'created_by': 'scheduler',
+        'created_at': datetime.now()
+    }).inserted_id
+    run_export_job(job_id)
+    job = mongo.db.export_jobs.find_one({'_id': job_id}, {'status': 1, 'error': 1})
+    if job['status'] != 'done':
+        raise RuntimeError(job.get('error') or f"{kind} export failed")
+    return True
+
+
+def job_accounts_summary():
+    return {'patients': len(accounts_summary_report())}
+
+
+def job_overheads_annual():
+    year = datetime.now().year
+    overheads_annual_report(year)
+    return {'year': year}
+
+
+def job_canteen_breakdown():
+    return {'patients': len(canteen_breakdown_report())}
+
+
+def job_payment_record_exports():
+    prune_export_cache()
+    built = []
+    for range_key in ('current', 'six_months'):
+        params = normalize_export_params('payment_records', {'range': range_key}, 'Admin')
+        if precompute_export('payment_records', params):
+            built.append(range_key)
+    return {'built': built}
+
+
+SCHEDULED_JOBS = {
+    'accounts_summary': job_accounts_summary,
+    'overheads_annual': job_overheads_annual,
+    'canteen_breakdown': job_canteen_breakdown,
+    'payment_record_exports': job_payment_record_exports,
+    'kpi_snapshots': record_kpi_snapshots,
+}
+
+
+def next_scheduled_run(after):
+    """First SCHEDULER_RUN_AT strictly after the given time."""
+    hour, minute = (int(part) for part in SCHEDULER_RUN_AT.split(':'))
+    run_at = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return run_at if run_at > after else run_at + timedelta(days=1)
+
+
+def scheduler_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def ensure_scheduled_jobs():
+    """Create the state document of each job on first start."""
+    now = datetime.now()
+    for name in SCHEDULED_JOBS:
+        try:
+            mongo.db.scheduled_jobs.update_one(
+                {'_id': name},
+                {'$setOnInsert': {'status': 'idle', 'next_run_at': next_scheduled_run(now), 'runs': 0}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            pass  # Another worker created it first
+
+
+def claim_scheduled_job(name, now):
+    """Take the lease on a due job. Returns the job document, or None if not due or held elsewhere."""
+    return mongo.db.scheduled_jobs.find_one_and_update(
+        {'_id': name, 'next_run_at': {'$lte': now},
+         '$or': [{'lease_expires_at': None}, {'lease_expires_at': {'$lt': now}}]},
+        {'$set': {
+            'status': 'running',
+            'lease_owner': scheduler_worker_id(),
+            'lease_expires_at': now + timedelta(seconds=SCHEDULER_LEASE_SECONDS),
+            'last_started_at': now
+        }},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def run_scheduled_job(name, job):
+    """Run a claimed job, then release the lease and record the outcome."""
+    started = datetime.now()
+    t0 = time.perf_counter()
+    status, error, result = 'ok', None, None
+    try:
+        with app.app_context():
+            result = SCHEDULED_JOBS[name]()
+    except Exception as e:
+        print(f"Scheduled Job Error ({name}): {e}")
+        status, error = 'failed', str(e)
+    duration_ms = round((time.perf_counter() - t0) * 1000, 1)
+    finished = datetime.now()
+
+    mongo.db.job_runs.insert_one({
+        'job': name,
+        'status': status,
+        'error': error,
+        'result': result,
+        'trigger': job.get('trigger', 'schedule'),
+        'worker': scheduler_worker_id(),
+        'started_at': started,
+        'finished_at': finished,
+        'duration_ms': duration_ms
+    })
+    mongo.db.scheduled_jobs.update_one(
+        {'_id': name, 'lease_owner': scheduler_worker_id()},
+        {'$set': {
+            'status': status,
+            'last_error': error,
+            'last_result': result,
+            'last_finished_at': finished,
+            'last_duration_ms': duration_ms,
+            'next_run_at': next_scheduled_run(finished),
+            'lease_owner': None,
+            'lease_expires_at': None,
+            'trigger': 'schedule'
+        }, '$inc': {'runs': 1}}
+    )
+
+
+def run_due_jobs():
+    for name in SCHEDULED_JOBS:
+        job = claim_scheduled_job(name, datetime.now())
+        if job is not None:
+            run_scheduled_job(name, job)
+
+
+def scheduler_loop():
+    try:
+        ensure_scheduled_jobs()
+    except Exception as e:
+        print(f"Scheduler Setup Error: {e}")
+    while True:
+        try:
+            run_due_jobs()
+        except Exception as e:
+            print(f"Scheduler Error: {e}")
+        scheduler_wakeup.wait(SCHEDULER_POLL_SECONDS)
+        scheduler_wakeup.clear()
+
+
+def start_scheduler():
+    """Start the scheduler thread once per process."""
+    global scheduler_thread
+    if not SCHEDULER_ENABLED:
+        return
+    with scheduler_lock:
+        if scheduler_thread is None or not scheduler_thread.is_alive():
+            scheduler_thread = threading.Thread(target=scheduler_loop, name="scheduler", daemon=True)
+            scheduler_thread.start()
+
+
+def serialize_scheduled_job(job, runs):
+    return {
+        'name': job['_id'],
+        'status': job.get('status'),
+        'runs': job.get('runs', 0),
+        'next_run_at': job['next_run_at'].isoformat() if job.get('next_run_at') else None,
+        'last_started_at': job['last_started_at'].isoformat() if job.get('last_started_at') else None,
+        'last_finished_at': job['last_finished_at'].isoformat() if job.get('last_finished_at') else None,
+        'last_duration_ms': job.get('last_duration_ms'),
+        'last_error': job.get('last_error'),
+        'last_result': job.get('last_result'),
+        'lease_owner': job.get('lease_owner'),
+        'recent_runs': [{
+            'status': r['status'],
+            'trigger': r.get('trigger'),
+            'worker': r.get('worker'),
+            'started_at': r['started_at'].isoformat(),
+            'duration_ms': r['duration_ms'],
+            'error': r.get('error')
+        } for r in runs]
+    }
+
+
+@app.route('/api/admin/jobs', methods=['GET'])
+@role_required(['Admin'])
+def list_scheduled_jobs():
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    try:
+        limit = min(int(request.args.get('runs', 10)), 100)
+        jobs = {j['_id']: j for j in mongo.db.scheduled_jobs.find({'_id': {'$in': list(SCHEDULED_JOBS)}})}
+        result = []
+        for name in SCHEDULED_JOBS:
+            if name not in jobs:
+                continue
+            runs = list(mongo.db.job_runs.find({'job': name}).sort('started_at', -1).limit(limit))
+            result.append(serialize_scheduled_job(jobs[name], runs))
+        return jsonify({
+            'enabled': SCHEDULER_ENABLED,
+            'run_at': SCHEDULER_RUN_AT,
+            'jobs': result
+        })
+    except Exception as e:
+        print(f"List Jobs Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/admin/jobs/<name>/run', methods=['POST'])
+@role_required(['Admin'])
+def trigger_scheduled_job(name):
+    """Make a job due now; the next scheduler poll on any worker runs it."""
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    if name not in SCHEDULED_JOBS:
+        return jsonify({"error": "Unknown job"}), 404
+    try:
+        ensure_scheduled_jobs()
+        mongo.db.scheduled_jobs.update_one(
+            {'_id': name},
+            {'$set': {'next_run_at': datetime.now(), 'trigger': f"manual:{session.get('username')}"}}
+        )
+        scheduler_wakeup.set()
+        return jsonify({"message": "Job queued", "scheduler_enabled": SCHEDULER_ENABLED}), 202
+    except Exception as e:
+        print(f"Trigger Job Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
 # --- HEALTH CHECK ENDPOINT (for cron-job.org) ---
 
 @app.route('/health', methods=['GET'])
@@ -2887,5 +6767,26 @@ def health_check():
         return jsonify({"status": "error", "message": str(e)}), 503
     
 
+def init_worker(run_setup=True):
+    """Per-process setup: Mongo client, initial admin, indexes, email worker, trace exporter and scheduler."""
+    init_db_client()
+
+    # Run initial setup outside of request context
+    if run_setup:
+        with app.app_context():
+            ensure_initial_admin()
+            ensure_indexes()
+
+    # Deliver anything left in the outbox by a previous run
+    if not SERVERLESS:
+        start_email_worker()
+    start_trace_exporter()
+    start_scheduler()
+
+
+if not DEFER_WORKER_INIT:
+    init_worker()
+
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
@@ -0,0 +1,273 @@
+"""
+ASGI entry point: hot read routes on Quart + Motor, everything else on Flask.
+
+    hypercorn asgi:application --workers 4 --bind 0.0.0.0:8000
+
+The routes in ASYNC_ROUTES are served by an async Quart app that runs their
+queries on Motor with asyncio.gather, so a worker keeps serving other requests
+while MongoDB answers. Every other request (writes, exports, SSE, the SPA) is
+passed through unchanged to the Flask app in app.py. Both apps share the same
+SECRET_KEY and session cookie, and the same query specs and response builders,
+so responses are identical to the WSGI deployment.
+"""
+import asyncio
+import json
+from functools import wraps
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from bson.objectid import ObjectId
+from datetime import datetime
+from motor.motor_asyncio import AsyncIOMotorClient
+from quart import Quart, jsonify, request, session
+
+from app import (
+    app as flask_app,
+    REPORT_CACHE_SOURCES,
+    accounts_summary_queries,
+    build_accounts_summary,
+    build_canteen_monthly_table,
+    build_dashboard_metrics,
+    build_patients_list,
+    build_psych_sessions,
+    canteen_table_base_queries,
+    canteen_table_sales_queries,
+    dashboard_queries,
+    format_data_version,
+    month_close_key,
+    patients_queries,
+    psych_session_name_queries,
+    psych_sessions_query,
+    report_cache_stamp,
+)
+
+quart_app = Quart(__name__)
+quart_app.config["SECRET_KEY"] = flask_app.config["SECRET_KEY"]
+
+motor_state = {'client': None, 'db': None}
+
+
+@quart_app.before_serving
+async def open_motor():
+    # Created inside the worker's event loop, after any fork
+    try:
+        motor_state['client'] = AsyncIOMotorClient(flask_app.config["MONGO_URI"])
+        motor_state['db'] = motor_state['client'].get_default_database()
+    except Exception as e:
+        print(f"Error initializing Motor: {e}")
+
+
+@quart_app.after_serving
+async def close_motor():
+    if motor_state['client'] is not None:
+        motor_state['client'].close()
+
+
+def check_db():
+    if motor_state['db'] is None:
+        print("Database connection failed or not initialized.")
+        return False
+    return True
+
+
+# --- QUERY EXECUTION ---
+
+async def run_read_query(spec):
+    """Run one (collection, kind, args) spec from app.py on Motor."""
+    collection, kind, args = spec
+    coll = motor_state['db'][collection]
+    if kind == 'count':
+        return await coll.count_documents(args['filter'])
+    if kind == 'aggregate':
+        return await coll.aggregate(args['pipeline']).to_list(None)
+    cursor = coll.find(args['filter'], args.get('projection'))
+    if args.get('sort'):
+        cursor = cursor.sort(args['sort'])
+    return await cursor.to_list(None)
+
+
+async def gather_read_queries(queries):
+    """Async counterpart of app.run_read_queries: all queries run concurrently."""
+    names = list(queries)
+    values = await asyncio.gather(*(run_read_query(queries[name]) for name in names))
+    return dict(zip(names, values))
+
+
+async def closed_month_report(report, month, year):
+    """Async counterpart of app.closed_month_report."""
+    db = motor_state['db']
+    close = await db.month_closes.find_one({'_id': month_close_key(month, year), 'status': 'closed'})
+    if not close or report not in close.get('snapshots', {}):
+        return None
+    snapshot = await db.month_snapshots.find_one({'_id': close['snapshots'][report]}, {'payload': 1})
+    return json.loads(snapshot['payload']) if snapshot else None
+
+
+async def cached_report(key, period, compute):
+    """Async counterpart of app.cached_report: the stored report if its stamp is current, else compute and store it."""
+    db = motor_state['db']
+    collections = REPORT_CACHE_SOURCES[key]
+    versions = await db.data_versions.find({'_id': {'$in': list(collections)}}).to_list(None)
+    stamp = report_cache_stamp(period, format_data_version(versions, collections))
+    doc = await db.report_cache.find_one({'_id': key, 'stamp': stamp}, {'payload': 1})
+    if doc is not None:
+        return json.loads(doc['payload'])
+
+    result = await compute()
+    await db.report_cache.replace_one({'_id': key}, {
+        'stamp': stamp,
+        'payload': flask_app.json.dumps(result),
+        'computed_at': datetime.now()
+    }, upsert=True)
+    return result
+
+
+inflight_reports = {}
+
+
+async def single_flight(key, compute):
+    """Async counterpart of app.single_flight: concurrent callers in this worker share one compute()."""
+    task = inflight_reports.get(key)
+    if task is None:
+        task = asyncio.ensure_future(compute())
+        inflight_reports[key] = task
+        task.add_done_callback(lambda _: inflight_reports.pop(key, None))
+    # A caller that disconnects must not cancel the computation the others are waiting on
+    return await asyncio.shield(task)
+
+
+# --- AUTH ---
+
+def login_required(f):
+    @wraps(f)
+    async def wrapper(*args, **kwargs):
+        if 'user_id' not in session:
+            return jsonify({"error": "Unauthorized"}), 401
+        return await f(*args, **kwargs)
+    return wrapper
+
+
+def role_required(roles):
+    def decorator(f):
+        @wraps(f)
+        @login_required
+        async def wrapper(*args, **kwargs):
+            user = await motor_state['db'].users.find_one({"_id": ObjectId(session['user_id'])}, {'role': 1})
+            if user and user.get('role') in roles:
+                return await f(*args, **kwargs)
+            return jsonify({"error": "Access Denied"}), 403
+        return wrapper
+    return decorator
+
+
+# --- HOT READ ROUTES ---
+
+@quart_app.route('/api/dashboard', methods=['GET'])
+@login_required
+async def get_dashboard_metrics():
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    try:
+        async def compute():
+            return build_dashboard_metrics(await gather_read_queries(dashboard_queries(datetime.now())))
+        return jsonify(await single_flight('dashboard', compute))
+    except Exception as e:
+        print(f"DB Metric Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@quart_app.route('/api/patients', methods=['GET'])
+@login_required
+async def get_patients():
+    if not check_db(): return jsonify([])
+    try:
+        results = await gather_read_queries(patients_queries())
+        return jsonify(build_patients_list(results))
+    except Exception as e:
+        print(f"DB Fetch Error: {e}")
+        return jsonify([])
+
+
+@quart_app.route('/api/canteen/monthly-table', methods=['GET'])
+@role_required(['Admin', 'Canteen'])
+async def get_canteen_monthly_table():
+    """JSON monthly table; CSV/Parquet downloads are routed to Flask."""
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    try:
+        month = int(request.args.get('month', datetime.now().month))
+        year = int(request.args.get('year', datetime.now().year))
+
+        snapshot = await closed_month_report('canteen_table', month, year)
+        if snapshot is not None:
+            return jsonify(snapshot)
+
+        async def compute():
+            base = await gather_read_queries(canteen_table_base_queries(month, year))
+            sales = None
+            if base['patients']:
+                patient_ids = [p['_id'] for p in base['patients']]
+                sales = await gather_read_queries(canteen_table_sales_queries(patient_ids, month, year))
+            return build_canteen_monthly_table(month, year, base, sales)
+        return jsonify(await single_flight(f'canteen_monthly_table:{year}-{month:02d}', compute))
+    except Exception as e:
+        print(f"Monthly Table Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@quart_app.route('/api/accounts/summary', methods=['GET'])
+@role_required(['Admin'])
+async def get_accounts_summary():
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+    try:
+        async def compute():
+            return build_accounts_summary(await gather_read_queries(accounts_summary_queries()))
+        return jsonify(await single_flight('accounts_summary', lambda: cached_report(
+            'accounts_summary', datetime.now().strftime('%Y-%m-%d'), compute
+        )))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@quart_app.route('/api/psych-sessions', methods=['GET'])
+@login_required
+async def list_psych_sessions():
+    if not check_db(): return jsonify({"error": "Database error"}), 500
+
+    query = psych_sessions_query(session.get('role'), session.get('user_id'), request.args)
+
+    try:
+        sessions = await motor_state['db'].psych_sessions.find(query).sort('date', 1).to_list(None)
+        names = await gather_read_queries(psych_session_name_queries(sessions))
+        return jsonify(build_psych_sessions(sessions, names))
+    except Exception as e:
+        print(f"Psych sessions fetch error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# --- DISPATCH ---
+
+ASYNC_ROUTES = {
+    '/api/dashboard',
+    '/api/patients',
+    '/api/canteen/monthly-table',
+    '/api/accounts/summary',
+    '/api/psych-sessions',
+}
+
+wsgi_application = WsgiToAsgi(flask_app)
+
+
+def serves_async(scope):
+    if scope['method'] != 'GET' or scope['path'] not in ASYNC_ROUTES:
+        return False
+    if scope['path'] == '/api/canteen/monthly-table':
+        fmt = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('format', ['json'])[0]
+        return fmt.lower() == 'json'
+    return True
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await quart_app(scope, receive, send)
+    if scope['type'] == 'http' and serves_async(scope):
+        return await quart_app(scope, receive, send)
+    return await wsgi_application(scope, receive, send)
@@ -0,0 +1,12 @@
+"""
+Load benchmarks for the PRO CRM.
+
+    python -m benchmarks.seed --uri mongodb://localhost:27017/pro_bench --drop
+    python -m benchmarks.load --uri mongodb://localhost:27017/pro_bench --save-baseline benchmarks/baselines/main.json
+    python -m benchmarks.load --uri mongodb://localhost:27017/pro_bench --baseline benchmarks/baselines/main.json
+
+seed fills a local mongod with a reproducible hospital dataset, load drives
+the app's routes through the Flask test client (or a running server with
+--base-url) and report prints latency percentiles, throughput and Mongo
+commands per request, failing when a route regresses past the threshold.
+"""
@@ -0,0 +1,239 @@
+"""
+Drive every route at a fixed concurrency and report latency, throughput and
+Mongo commands per request.
+
+    python -m benchmarks.load --uri mongodb://localhost:27017/pro_bench
+    python -m benchmarks.load --base-url http://127.0.0.1:8000 --uri mongodb://localhost:27017/pro_bench
+
+Without --base-url the app is imported and called through the Flask test
+client, and Mongo commands are counted exactly per request with a PyMongo
+command listener. With --base-url requests go over HTTP to a running server;
+commands are then estimated from the server's opcounters, so other traffic on
+the same mongod inflates them.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from pymongo import MongoClient, monitoring
+
+from benchmarks import report
+from benchmarks.routes import build_scenarios, coverage_gaps, dataset_fixtures
+from benchmarks.seed import BENCH_PASSWORD, BENCH_USERS
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Counts commands started by threads inside begin()/end()."""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def begin(self):
+        self.local.count = 0
+        self.local.active = True
+
+    def end(self):
+        self.local.active = False
+        return self.local.count
+
+    def started(self, event):
+        if getattr(self.local, 'active', False):
+            self.local.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def session_cookie(set_cookie_headers):
+    for header in set_cookie_headers:
+        if header.startswith('session='):
+            return header.split(';', 1)[0]
+    return None
+
+
+class ClientTransport:
+    """Calls the app in-process through the Flask test client."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, path, body=None, cookie=None):
+        client = self.app.test_client(use_cookies=False)
+        headers = {'Cookie': cookie} if cookie else {}
+        response = client.open(path, method=method, json=body, headers=headers)
+        try:
+            response.get_data()  # Drain streamed bodies so generation time is measured
+            return response.status_code, response.headers.getlist('Set-Cookie')
+        finally:
+            response.close()
+
+
+class HttpTransport:
+    """Calls a running server over HTTP."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, body=None, cookie=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        if data is not None:
+            req.add_header('Content-Type', 'application/json')
+        if cookie:
+            req.add_header('Cookie', cookie)
+        try:
+            with urllib.request.urlopen(req, timeout=120) as response:
+                response.read()
+                return response.status, response.headers.get_all('Set-Cookie') or []
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code, []
+
+
+def login_cookies(transport):
+    """Log in once per role; requests reuse the cookie so the login limiter is never hit."""
+    cookies = {}
+    for username, role in BENCH_USERS.items():
+        status, set_cookie = transport.request(
+            'POST', '/api/auth/login', {'username': username, 'password': BENCH_PASSWORD}
+        )
+        if status != 200:
+            raise SystemExit(f"Login as {username} failed with HTTP {status}; run benchmarks.seed first")
+        cookies[role] = session_cookie(set_cookie)
+    return cookies
+
+
+def server_op_total(db):
+    counters = db.command('serverStatus')['opcounters']
+    return sum(counters.values())
+
+
+def run_scenario(transport, scenario, cookie, requests, concurrency, warmup, counter=None, db=None):
+    """Time `requests` calls of one scenario with `concurrency` threads."""
+    for _ in range(warmup):
+        transport.request(scenario['method'], scenario['path'], scenario['body'], cookie)
+
+    def one(_):
+        if counter:
+            counter.begin()
+        started = time.perf_counter()
+        status, _ = transport.request(scenario['method'], scenario['path'], scenario['body'], cookie)
+        elapsed = time.perf_counter() - started
+        return elapsed, status, counter.end() if counter else 0
+
+    ops_before = server_op_total(db) if db is not None and counter is None else None
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(one, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    if counter:
+        db_calls = sum(calls for _, _, calls in outcomes)
+    elif ops_before is not None:
+        db_calls = max(server_op_total(db) - ops_before - 1, 0)  # Minus our own serverStatus
+    else:
+        db_calls = None
+    errors = sum(1 for _, status, _ in outcomes if status >= 400)
+    return report.summarize([latency for latency, _, _ in outcomes], errors, elapsed, db_calls)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def run(transport, db, args, counter=None):
+    fixtures = dataset_fixtures(db)
+    only = set(args.routes.split(',')) if args.routes else None
+    scenarios = build_scenarios(fixtures, include_writes=args.include_writes, only=only)
+    cookies = login_cookies(transport)
+
+    dataset = db.bench_meta.find_one({'_id': 'dataset'}, {'_id': 0})
+    results = {
+        'meta': {
+            'mode': 'http' if args.base_url else 'client',
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'dataset': json.loads(json.dumps(dataset, default=str)) if dataset else None,
+            'commit': git_commit(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+        },
+        'routes': {},
+    }
+    for scenario in scenarios:
+        cookie = cookies.get(scenario['role']) if scenario['role'] else None
+        results['routes'][scenario['name']] = run_scenario(
+            transport, scenario, cookie, args.requests, args.concurrency, args.warmup, counter, db
+        )
+        print(f"  {scenario['name']}: p95 {results['routes'][scenario['name']]['p95_ms']:.2f} ms", file=sys.stderr)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uri', default='mongodb://localhost:27017/pro_bench', help='Seeded benchmark database')
+    parser.add_argument('--base-url', help='Benchmark a running server instead of the test client')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=100, help='Timed requests per route')
+    parser.add_argument('--warmup', type=int, default=3, help='Untimed requests per route')
+    parser.add_argument('--routes', help='Comma-separated scenario names (default: all)')
+    parser.add_argument('--include-writes', action='store_true', help='Also run write scenarios (mutates the dataset)')
+    parser.add_argument('--output', help='Write the results JSON here')
+    parser.add_argument('--save-baseline', help='Write the results JSON as the new baseline')
+    parser.add_argument('--baseline', help='Compare against this baseline and fail on regressions')
+    parser.add_argument('--threshold', type=float, default=0.15, help='Allowed p95 growth as a fraction')
+    args = parser.parse_args(argv)
+
+    db = MongoClient(args.uri).get_default_database()
+    counter = None
+    if args.base_url:
+        transport = HttpTransport(args.base_url)
+    else:
+        counter = CommandCounter()
+        monitoring.register(counter)  # Must precede the app's MongoClient
+        os.environ['MONGO_URI'] = args.uri
+        os.environ.setdefault('SECRET_KEY', 'bench-secret')
+        os.environ.setdefault('SCHEDULER_ENABLED', '0')  # Keep nightly jobs out of the command counts
+        from app import app
+        transport = ClientTransport(app)
+        for method, rule in coverage_gaps(app):
+            print(f"warning: no scenario for {method} {rule}", file=sys.stderr)
+
+    results = run(transport, db, args, counter)
+
+    baseline = report.load(args.baseline) if args.baseline else None
+    print(report.format_table(results, baseline))
+    if args.output:
+        report.save(results, args.output)
+    if args.save_baseline:
+        report.save(results, args.save_baseline)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if baseline:
+        for note in report.dataset_mismatch(results, baseline):
+            print(f"warning: not comparable, {note}", file=sys.stderr)
+        regressions = report.find_regressions(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.threshold:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nNo regressions beyond {args.threshold:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,38 @@
+import base64
+import os
+import random
+import sys
+
+import pytest
+
+# Importing app needs these, but the micro-benchmarks never touch Mongo
+os.environ.setdefault('MONGO_URI', 'mongodb://localhost:27017/pro_bench')
+os.environ.setdefault('SECRET_KEY', 'bench-secret')
+os.environ['PRO_DEFER_WORKER_INIT'] = '1'
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    import app
+    return app
+
+
+def photo_data_url(rng, kilobytes):
+    raw = bytes(rng.getrandbits(8) for _ in range(kilobytes * 768))
+    return 'data:image/jpeg;base64,' + base64.b64encode(raw).decode('ascii')
+
+
+@pytest.fixture(scope='session')
+def patient_payload():
+    """What the SPA posts when admitting a patient: text fields plus three camera photos."""
+    rng = random.Random(7)
+    return {
+        'name': ' Muhammad Ali Khan ', 'fatherName': 'Abdul Rehman ', 'age': '34',
+        'cnic': '35202-1234567-1', 'contactNo': '03001234567 ', 'address': 'House 12, Street 4, Gulberg ',
+        'admissionDate': '2025-03-14', 'monthlyFee': '35,000', 'monthlyAllowance': '5,000',
+        'receivedAmount': '70,000', 'drug': 'Ice ', 'laundryStatus': True, 'laundryAmount': 3500,
+        'photo1': photo_data_url(rng, 180), 'photo2': photo_data_url(rng, 150), 'photo3': photo_data_url(rng, 120),
+        'notes': [{'text': ' Admitted by family ', 'date': '2025-03-14'}],
+        'tags': [' relapse ', 'second admission'],
+    }
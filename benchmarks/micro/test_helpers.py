@@ -0,0 +1,43 @@
+"""
+Micro-benchmarks for helpers that run once per document in report loops.
+
+    pytest benchmarks/micro --benchmark-compare --benchmark-compare-fail=min:25%
+"""
+from datetime import datetime
+
+import pytest
+
+NOW = datetime(2026, 1, 31, 12, 0)
+
+
+@pytest.mark.parametrize('fee, days', [
+    ('35,000', 45),    # Within 90 days: flat monthly fee
+    ('35,000', 200),   # Prorated per day
+    ('', 120),         # Missing fee
+])
+def test_calculate_prorated_fee(benchmark, app_module, fee, days):
+    benchmark(app_module.calculate_prorated_fee, fee, days)
+
+
+def test_clean_input_data_patient_with_photos(benchmark, app_module, patient_payload):
+    result = benchmark(app_module.clean_input_data, patient_payload)
+    assert result['name'] == 'Muhammad Ali Khan'
+
+
+def test_clean_input_data_canteen_entry(benchmark, app_module):
+    payload = {'patient_id': '65f1c2a9e4b0a1b2c3d4e5f6', 'date': '2026-01-30', 'amount': '150 ', 'entry_type': 'daily'}
+    benchmark(app_module.clean_input_data, payload)
+
+
+@pytest.mark.parametrize('raw', ['5,000', 'Rs. 3000', None, '', 8000])
+def test_safe_int(benchmark, app_module, raw):
+    benchmark(app_module._safe_int, raw)
+
+
+@pytest.mark.parametrize('admission', [
+    '2025-03-14',                   # What the SPA stores
+    '2025-03-14T10:20:00.000Z',     # ISO timestamp from older clients
+    datetime(2025, 3, 14),          # Imported records
+])
+def test_days_since_admission(benchmark, app_module, admission):
+    benchmark(app_module.days_since_admission, admission, NOW)
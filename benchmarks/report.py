@@ -0,0 +1,94 @@
+"""
+Latency/throughput summaries, baseline files and regression checks.
+"""
+import json
+import os
+
+
+def percentile(sorted_values, q):
+    """Linear-interpolated percentile of an already sorted list (q in 0..100)."""
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def summarize(latencies, errors, elapsed, db_calls):
+    """Stats for one scenario. latencies are seconds; db_calls is a total or None."""
+    ordered = sorted(latencies)
+    count = len(ordered)
+    return {
+        'requests': count,
+        'errors': errors,
+        'p50_ms': round(percentile(ordered, 50) * 1000, 2),
+        'p95_ms': round(percentile(ordered, 95) * 1000, 2),
+        'p99_ms': round(percentile(ordered, 99) * 1000, 2),
+        'throughput_rps': round(count / elapsed, 1) if elapsed else 0.0,
+        'db_calls_per_request': round(db_calls / count, 2) if db_calls is not None and count else None,
+    }
+
+
+def format_table(results, baseline=None):
+    routes = results['routes']
+    base_routes = (baseline or {}).get('routes', {})
+    width = max([len(name) for name in routes] + [8])
+    lines = [f"{'route':<{width}}  {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>8} {'db/req':>7} {'err':>4}  {'p95 vs base':>11}"]
+    for name, r in routes.items():
+        db = '-' if r['db_calls_per_request'] is None else f"{r['db_calls_per_request']:g}"
+        delta = ''
+        if name in base_routes and base_routes[name]['p95_ms']:
+            change = (r['p95_ms'] - base_routes[name]['p95_ms']) / base_routes[name]['p95_ms'] * 100
+            delta = f"{change:+.1f}%"
+        lines.append(
+            f"{name:<{width}}  {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f} "
+            f"{r['throughput_rps']:>8.1f} {db:>7} {r['errors']:>4}  {delta:>11}"
+        )
+    return '\n'.join(lines)
+
+
+def find_regressions(results, baseline, threshold, min_delta_ms=2.0):
+    """
+    Routes that got slower or chattier than the baseline.
+
+    A route regresses when its p95 grows by more than `threshold` (a fraction)
+    and by at least min_delta_ms, so sub-millisecond noise is ignored, or when
+    it issues more Mongo commands per request than before.
+    """
+    regressions = []
+    for name, now in results['routes'].items():
+        before = baseline.get('routes', {}).get(name)
+        if not before:
+            continue
+        limit = before['p95_ms'] * (1 + threshold)
+        if now['p95_ms'] > limit and now['p95_ms'] - before['p95_ms'] >= min_delta_ms:
+            regressions.append(f"{name}: p95 {before['p95_ms']:.2f} -> {now['p95_ms']:.2f} ms")
+        if (now['db_calls_per_request'] is not None and before.get('db_calls_per_request') is not None
+                and now['db_calls_per_request'] > before['db_calls_per_request']):
+            regressions.append(
+                f"{name}: db calls {before['db_calls_per_request']:g} -> {now['db_calls_per_request']:g} per request"
+            )
+    return regressions
+
+
+def dataset_mismatch(results, baseline):
+    """Describe differences in dataset or run settings that make a comparison unfair."""
+    notes = []
+    for key in ('dataset', 'mode', 'concurrency'):
+        if results['meta'].get(key) != baseline.get('meta', {}).get(key):
+            notes.append(f"{key}: baseline {baseline.get('meta', {}).get(key)!r}, now {results['meta'].get(key)!r}")
+    return notes
+
+
+def save(results, path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, default=str)
+        f.write('\n')
+
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
@@ -0,0 +1,200 @@
+"""
+Catalog of benchmark scenarios, one per route in app.py.
+
+Paths may use {placeholders} that are filled from the seeded dataset by
+dataset_fixtures(). Write scenarios only run with --include-writes; routes that
+cannot be repeated meaningfully (logout, streams, deletes) are listed in
+SKIPPED with the reason so coverage_gaps() can still account for them.
+"""
+from datetime import timedelta
+
+READ_SCENARIOS = [
+    ('index', 'GET', '/', None),
+    ('health', 'GET', '/health', None),
+    ('auth_session', 'GET', '/api/auth/session', 'Admin'),
+    ('dashboard', 'GET', '/api/dashboard', 'Admin'),
+    ('dashboard_admissions', 'GET', '/api/dashboard/admissions', 'Admin'),
+    ('debug_dashboard', 'GET', '/api/debug/dashboard', 'Admin'),
+    ('patients', 'GET', '/api/patients', 'Admin'),
+    ('patient_records', 'GET', '/api/patients/{patient_id}/records', 'Doctor'),
+    ('patient_payment_history', 'GET', '/api/patients/{patient_id}/payment_history', 'Admin'),
+    ('discharge_bill', 'GET', '/api/patients/{patient_id}/discharge-bill', 'Admin'),
+    ('canteen_monthly_table', 'GET', '/api/canteen/monthly-table?month={month}&year={year}', 'Canteen'),
+    ('canteen_monthly_table_csv', 'GET', '/api/canteen/monthly-table?month={month}&year={year}&format=csv', 'Canteen'),
+    ('canteen_daily_sheet', 'GET', '/api/canteen/daily-sheet?date={date}', 'Canteen'),
+    ('canteen_breakdown', 'GET', '/api/canteen/sales/breakdown', 'Admin'),
+    ('canteen_history', 'GET', '/api/canteen/sales/history?patient_id={patient_id}', 'Admin'),
+    ('expenses', 'GET', '/api/expenses', 'Admin'),
+    ('expenses_summary', 'GET', '/api/expenses/summary', 'Admin'),
+    ('accounts_summary', 'GET', '/api/accounts/summary', 'Admin'),
+    ('call_meeting', 'GET', '/api/call_meeting_tracker?month={month}&year={year}', 'Admin'),
+    ('call_meeting_summary', 'GET', '/api/call_meeting_tracker/summary/{month}/{year}', 'Admin'),
+    ('utility_bills', 'GET', '/api/utility_bills', 'Admin'),
+    ('employees', 'GET', '/api/employees', 'Admin'),
+    ('old_balances', 'GET', '/api/old-balances', 'Admin'),
+    ('overheads_month', 'GET', '/api/overheads/{month}/{year}', 'Admin'),
+    ('overheads_annual', 'GET', '/api/overheads/annual/{year}', 'Admin'),
+    ('overheads_canteen_sync', 'GET', '/api/overheads/canteen-sync/{month}/{year}', 'Admin'),
+    ('payment_records', 'GET', '/api/payment-records', 'Admin'),
+    ('payment_records_export', 'GET', '/api/payment-records/export?range=current&format=csv', 'Admin'),
+    ('psych_sessions', 'GET', '/api/psych-sessions?start={month_start}&end={date}', 'Psychologist'),
+    ('reports', 'GET', '/api/reports?date={date}', 'Admin'),
+    ('reports_config', 'GET', '/api/reports/config', 'Admin'),
+    ('emergency', 'GET', '/api/emergency', 'Admin'),
+    ('attendance', 'GET', '/api/attendance?month={month}&year={year}', 'Admin'),
+    ('users', 'GET', '/api/users', 'Admin'),
+    ('sync_patients', 'GET', '/api/sync?collections=patients', 'Admin'),
+    ('admin_jobs', 'GET', '/api/admin/jobs', 'Admin'),
+    ('kpi_trend', 'GET', '/api/kpi/trend?days=90', 'Admin'),
+    ('census', 'GET', '/api/census', 'Admin'),
+    ('month_closes', 'GET', '/api/month-close', 'Admin'),
+    ('month_close_status', 'GET', '/api/month-close/{month}/{year}', 'Admin'),
+    ('archived_patients', 'GET', '/api/archive/patients?q=a', 'Admin'),
+    ('archived_patient', 'GET', '/api/archive/patients/{archived_patient_id}', 'Admin'),
+    ('profiles', 'GET', '/api/profiles', 'Admin'),
+]
+
+# (name, method, path, role, json body); repeated runs upsert the same documents where possible
+WRITE_SCENARIOS = [
+    ('export_patients', 'POST', '/api/export', 'Admin', {'format': 'csv'}),
+    ('batch_startup', 'POST', '/api/batch', 'Admin', {'requests': [
+        {'path': '/api/dashboard'}, {'path': '/api/emergency'}, {'path': '/api/sync?collections=patients'}]}),
+    ('canteen_daily_entry', 'POST', '/api/canteen/daily-entry', 'Admin',
+     {'patient_id': '{patient_id}', 'date': '{date}', 'amount': 150, 'entry_type': 'daily'}),
+    ('canteen_old_balance', 'POST', '/api/canteen/old-balance', 'Admin',
+     {'patient_id': '{patient_id}', 'month': '{month}', 'year': '{year}', 'old_balance': 5000}),
+    ('overhead_entry', 'POST', '/api/overheads/entry', 'Admin',
+     {'date': '{date}', 'month': '{month}', 'year': '{year}', 'kitchen': 5000, 'others': 100}),
+    ('attendance_mark', 'POST', '/api/attendance', 'Admin',
+     {'empId': '{employee_id}', 'day': 1, 'month': '{month}', 'year': '{year}', 'mark': 'P'}),
+    ('reports_update', 'POST', '/api/reports/update', 'Admin',
+     {'date': '{date}', 'patient_id': '{patient_id}', 'time_slot': '10am', 'status': 'done'}),
+    ('reports_config_save', 'POST', '/api/reports/config', 'Admin',
+     {'day_columns': ['10am', '2pm'], 'night_columns': ['10pm']}),
+    ('overheads_month_save', 'POST', '/api/overheads/month/{month}/{year}', 'Admin',
+     {'entries': [{'date': '{date}', 'kitchen': 5000, 'others': 100}]}),
+    # The remaining writes add a document per request
+    ('add_patient', 'POST', '/api/patients', 'Admin',
+     {'name': 'Bench Patient', 'admissionDate': '{date}', 'monthlyFee': '30,000'}),
+    ('patient_payment', 'POST', '/api/patients/{patient_id}/payment', 'Admin',
+     {'amount': 100, 'payment_method': 'Cash'}),
+    ('session_note', 'POST', '/api/patients/{patient_id}/session_note', 'Psychologist', {'text': 'Bench note'}),
+    ('medical_record', 'POST', '/api/patients/{patient_id}/medical_record', 'Doctor',
+     {'title': 'Bench record', 'details': 'n/a'}),
+    ('canteen_sale', 'POST', '/api/canteen/sales', 'Canteen',
+     {'patient_id': '{patient_id}', 'amount': 100, 'item': 'Tea'}),
+    ('add_expense', 'POST', '/api/expenses', 'Admin', {'type': 'outgoing', 'amount': 500, 'category': 'Misc'}),
+    ('add_utility_bill', 'POST', '/api/utility_bills', 'Admin', {'type': 'Gas', 'amount': 1000, 'due_date': '{date}'}),
+    ('add_employee', 'POST', '/api/employees', 'Admin', {'name': 'Bench Employee', 'designation': 'Cook'}),
+    ('add_old_balance', 'POST', '/api/old-balances', 'Admin', {'name': 'Bench', 'amount': 1000}),
+    ('add_emergency', 'POST', '/api/emergency', 'Admin', {'patient_name': 'Bench', 'note': 'Bench alert', 'severity': 'low'}),
+    ('create_psych_session', 'POST', '/api/psych-sessions', 'Admin',
+     {'date': '{date}', 'psychologist_id': '{psychologist_id}', 'patient_ids': ['{patient_id}'], 'time_slot': '10:00-11:00'}),
+    ('call_meeting_entry', 'POST', '/api/call_meeting_tracker', 'Admin',
+     {'name': 'Bench Caller', 'day': 1, 'month': '{month}', 'year': '{year}',
+      'date_of_admission': '{date}', 'status': 'Call'}),
+    ('discharge_bills_batch', 'POST', '/api/discharge-bills/batch', 'Admin', {'month': '{month}', 'year': '{year}'}),
+    ('archive_dry_run', 'POST', '/api/archive/run', 'Admin', {'dry_run': True}),
+]
+
+SKIPPED = {
+    '/api/events': 'long-lived SSE stream',
+    '/api/auth/login': 'exercised once per role during setup',
+    '/api/auth/logout': 'would end the shared session',
+    '/api/auth/forgot': 'rate limited and queues mail',
+    '/api/auth/reset': 'needs a mailed token',
+    '/api/export-jobs': 'asynchronous; timed through /api/export instead',
+    '/api/export-jobs/<job_id>': 'asynchronous job polling',
+    '/api/export-jobs/<job_id>/download': 'asynchronous job download',
+    '/api/users': 'POST would create login accounts',
+    '/api/psych-sessions/<session_id>/note': 'a session note can only be saved once',
+    '/api/users/change_password': 'would change the benchmark password',
+    '/static/<path:filename>': 'static files',
+    '/api/admin/jobs/<name>/run': 'runs a nightly job',
+    '/api/kpi/backfill': 'rebuilds the KPI history',
+    '/api/month-close/<int:month>/<int:year>': 'POST freezes the month and blocks later writes (GET is read-timed)',
+    '/api/month-close/<int:month>/<int:year>/reopen': 'needs a closed month',
+    '/api/archive/patients/<id>/restore': 'moves an archived patient back into the live data',
+    '/api/profiles/<profile_id>/<artifact>': 'needs a saved request profile',
+}
+# Creates, updates and deletes would change the dataset between runs
+SKIPPED_METHODS = {'PUT', 'DELETE'}
+
+
+def dataset_fixtures(db):
+    """Values for the path placeholders, taken from the seeded data."""
+    meta = db.bench_meta.find_one({'_id': 'dataset'}) or {}
+    active = db.patients.find_one({'isDischarged': {'$ne': True}}, {'_id': 1}, sort=[('admissionDate', 1)])
+    anyone = active or db.patients.find_one({}, {'_id': 1})
+    employee = db.employees.find_one({}, {'_id': 1})
+    psych = db.users.find_one({'role': 'Psychologist'}, {'_id': 1})
+    archived = db.patients_archive.find_one({}, {'_id': 1})
+    day = meta.get('end')
+    if day is None:
+        latest = db.canteen_sales.find_one({}, {'date': 1}, sort=[('date', -1)])
+        day = latest['date'] if latest else None
+    day = (day - timedelta(days=1)) if day else None
+    return {
+        'patient_id': str(anyone['_id']) if anyone else '',
+        'employee_id': str(employee['_id']) if employee else '',
+        'psychologist_id': str(psych['_id']) if psych else '',
+        # Without archived patients this times the 404 lookup
+        'archived_patient_id': str((archived or anyone)['_id']) if archived or anyone else '',
+        'date': day.strftime('%Y-%m-%d') if day else '',
+        'month_start': day.replace(day=1).strftime('%Y-%m-%d') if day else '',
+        'month': day.month if day else 1,
+        'year': day.year if day else 2024,
+    }
+
+
+def fill(value, fixtures):
+    """Substitute placeholders in a path or JSON body."""
+    if isinstance(value, str):
+        if value.startswith('{') and value.endswith('}') and value[1:-1] in fixtures:
+            return fixtures[value[1:-1]]  # Keep ints as ints in JSON bodies
+        return value.format(**fixtures)
+    if isinstance(value, dict):
+        return {k: fill(v, fixtures) for k, v in value.items()}
+    if isinstance(value, list):
+        return [fill(v, fixtures) for v in value]
+    return value
+
+
+def build_scenarios(fixtures, include_writes=False, only=None):
+    scenarios = [
+        {'name': name, 'method': method, 'path': fill(path, fixtures), 'role': role, 'body': None}
+        for name, method, path, role in READ_SCENARIOS
+    ]
+    if include_writes:
+        scenarios += [
+            {'name': name, 'method': method, 'path': fill(path, fixtures), 'role': role, 'body': fill(body, fixtures)}
+            for name, method, path, role, body in WRITE_SCENARIOS
+        ]
+    if only:
+        scenarios = [s for s in scenarios if s['name'] in only]
+    return scenarios
+
+
+def coverage_gaps(app):
+    """(method, rule) pairs in the app that no scenario or skip entry accounts for."""
+    covered = set()
+    for name, method, path, *_ in READ_SCENARIOS + WRITE_SCENARIOS:
+        covered.add((method, path.split('?')[0]))
+    gaps = []
+    for rule in app.url_map.iter_rules():
+        for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+            if rule.rule in SKIPPED or method in SKIPPED_METHODS:
+                continue
+            pattern = rule.rule
+            for arg in rule.arguments:
+                for conv in ('', 'int:', 'path:'):
+                    pattern = pattern.replace(f'<{conv}{arg}>', '{' + arg + '}')
+            templates = {p for m, p in covered if m == method}
+            if not any(_same_shape(pattern, t) for t in templates):
+                gaps.append((method, rule.rule))
+    return gaps
+
+
+def _same_shape(rule_pattern, template):
+    a, b = rule_pattern.strip('/').split('/'), template.strip('/').split('/')
+    return len(a) == len(b) and all(x == y or (x.startswith('{') and y.startswith('{')) for x, y in zip(a, b))
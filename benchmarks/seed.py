@@ -0,0 +1,265 @@
+"""
+Seeded generator for a realistic benchmark dataset.
+
+Every run with the same --seed and sizes produces the same documents, so
+numbers from different commits are measured against identical data.
+"""
+import argparse
+import base64
+import random
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from pymongo import MongoClient
+from werkzeug.security import generate_password_hash
+
+BENCH_PASSWORD = 'bench-password'
+BENCH_USERS = {
+    'bench_admin': 'Admin',
+    'bench_canteen': 'Canteen',
+    'bench_doctor': 'Doctor',
+    'bench_psych': 'Psychologist',
+    'bench_staff': 'General Staff',
+}
+
+FIRST_NAMES = ['Ali', 'Ahmed', 'Bilal', 'Hamza', 'Usman', 'Faisal', 'Imran', 'Kashif', 'Zubair', 'Naveed',
+               'Saad', 'Tariq', 'Waqas', 'Yasir', 'Adnan', 'Asif', 'Junaid', 'Rizwan', 'Sohail', 'Umair']
+LAST_NAMES = ['Khan', 'Malik', 'Butt', 'Chaudhry', 'Sheikh', 'Qureshi', 'Awan', 'Raja', 'Mirza', 'Siddiqui']
+AREAS = ['Gulberg', 'Model Town', 'Johar Town', 'DHA', 'Samanabad', 'Iqbal Town', 'Cantt', 'Wapda Town']
+DRUGS = ['Heroin', 'Ice', 'Cannabis', 'Alcohol', 'Opioids', 'Mixed']
+CANTEEN_ITEMS = ['Tea', 'Biscuits', 'Juice', 'Cigarettes', 'Snacks', 'Soap', 'Toothpaste']
+EXPENSE_CATEGORIES = ['Kitchen', 'Medicine', 'Maintenance', 'Salaries', 'Transport', 'Misc']
+DESIGNATIONS = ['Ward Boy', 'Nurse', 'Cook', 'Guard', 'Counselor', 'Cleaner']
+TIME_SLOTS = ['10:00-11:00', '11:00-12:00', '14:00-15:00', '16:00-17:00']
+BATCH = 5000
+
+
+def fake_photo(rng, kilobytes):
+    """A base64 data URL of roughly the size the SPA uploads."""
+    raw = bytes(rng.getrandbits(8) for _ in range(kilobytes * 768))
+    return 'data:image/jpeg;base64,' + base64.b64encode(raw).decode('ascii')
+
+
+def money(value):
+    return f"{value:,}"
+
+
+def insert_batched(collection, docs):
+    buffer = []
+    for doc in docs:
+        buffer.append(doc)
+        if len(buffer) >= BATCH:
+            collection.insert_many(buffer)
+            buffer = []
+    if buffer:
+        collection.insert_many(buffer)
+
+
+def seed_users(db):
+    ids = {}
+    password = generate_password_hash(BENCH_PASSWORD)
+    for username, role in BENCH_USERS.items():
+        result = db.users.insert_one({
+            'username': username, 'password': password, 'role': role,
+            'name': username.replace('_', ' ').title(), 'email': f"{username}@example.com",
+            'created_at': datetime(2020, 1, 1)
+        })
+        ids[username] = result.inserted_id
+    return ids
+
+
+def make_patients(rng, count, start, end, photo_kb):
+    """Admissions spread over [start, end); stays of 30-270 days, most already discharged."""
+    span_days = (end - start).days
+    # A handful of distinct photos keeps generation fast while sizes stay realistic
+    photos = [fake_photo(rng, photo_kb) for _ in range(8)] if photo_kb else ['']
+    patients = []
+    for i in range(count):
+        admitted = start + timedelta(days=rng.randrange(span_days))
+        stay = rng.randint(30, 270)
+        left = admitted + timedelta(days=stay)
+        discharged = left < end
+        fee = rng.choice([25000, 30000, 35000, 40000, 50000])
+        months = max(1, stay // 30)
+        patients.append({
+            '_id': ObjectId(),
+            'name': f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {i}",
+            'fatherName': f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+            'age': str(rng.randint(16, 65)),
+            'cnic': f"35202-{rng.randint(1000000, 9999999)}-{rng.randint(1, 9)}",
+            'contactNo': f"03{rng.randint(100000000, 499999999)}",
+            'address': rng.choice(AREAS),
+            'admissionDate': admitted.strftime('%Y-%m-%d'),
+            'monthlyFee': money(fee),
+            'monthlyAllowance': money(rng.choice([3000, 5000, 8000])),
+            'receivedAmount': money(fee * rng.randint(0, months)),
+            'drug': rng.choice(DRUGS),
+            'photo1': rng.choice(photos),
+            'photo2': rng.choice(photos) if rng.random() < 0.5 else '',
+            'photo3': '',
+            'laundryStatus': rng.random() < 0.4,
+            'laundryAmount': 3500,
+            'isDischarged': discharged,
+            'dischargeDate': left.strftime('%Y-%m-%d') if discharged else None,
+            'notes': [],
+            'created_at': admitted,
+            'updated_at': left if discharged else admitted,
+        })
+    return patients
+
+
+def iter_canteen_sales(rng, patients, end):
+    """One to three purchases per patient per day of stay, plus a monthly 'other' adjustment."""
+    for p in patients:
+        day = datetime.strptime(p['admissionDate'], '%Y-%m-%d')
+        last = datetime.strptime(p['dischargeDate'], '%Y-%m-%d') if p['dischargeDate'] else end
+        while day < last:
+            for _ in range(rng.randint(1, 3)):
+                yield {
+                    'patient_id': p['_id'], 'item': rng.choice(CANTEEN_ITEMS),
+                    'amount': rng.choice([50, 80, 100, 150, 200, 300]),
+                    'date': day + timedelta(hours=rng.randint(8, 20)),
+                    'recorded_by': 'bench_canteen', 'updated_at': day,
+                }
+            if day.day == 28 and rng.random() < 0.3:
+                yield {
+                    'patient_id': p['_id'], 'entry_type': 'other', 'item': 'Adjustment',
+                    'amount': rng.choice([200, 500, 1000]),
+                    'date': day.replace(hour=0), 'recorded_by': 'bench_admin', 'updated_at': day,
+                }
+            day += timedelta(days=1)
+
+
+def iter_days(start, end):
+    day = start
+    while day < end:
+        yield day
+        day += timedelta(days=1)
+
+
+def iter_expenses(rng, start, end):
+    for day in iter_days(start, end):
+        for _ in range(rng.randint(2, 6)):
+            incoming = rng.random() < 0.3
+            yield {
+                'type': 'incoming' if incoming else 'outgoing',
+                'amount': rng.randint(500, 60000),
+                'category': 'Patient Fee' if incoming else rng.choice(EXPENSE_CATEGORIES),
+                'note': '', 'date': day + timedelta(hours=rng.randint(9, 18)),
+                'recorded_by': 'bench_admin', 'created_at': day, 'updated_at': day,
+            }
+
+
+def iter_overheads(rng, start, end):
+    for day in iter_days(start, end):
+        kitchen = float(rng.randint(3000, 12000))
+        canteen = float(rng.randint(500, 4000))
+        others = float(rng.randint(0, 3000))
+        advance = float(rng.choice([0, 0, 0, 2000, 5000]))
+        yield {
+            'date': day.strftime('%Y-%m-%d'), 'month': day.month, 'year': day.year,
+            'kitchen': kitchen, 'canteen_auto': canteen, 'others': others, 'pay_advance': advance,
+            'employee_names': '', 'income': float(rng.choice([0, 0, 30000, 50000])),
+            'total_expense': kitchen + canteen + others + advance, 'last_updated': day,
+        }
+
+
+def iter_attendance(rng, employee_ids, start, end):
+    month = start.replace(day=1)
+    while month < end:
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        for emp_id in employee_ids:
+            days = {str(d): ('P' if rng.random() < 0.9 else 'A') for d in range(1, (next_month - month).days + 1)}
+            yield {'employee_id': str(emp_id), 'year': month.year, 'month': month.month, 'days': days}
+        month = next_month
+
+
+def iter_psych_sessions(rng, psych_id, patients, start, end):
+    for day in iter_days(start, end):
+        if day.weekday() == 6:
+            continue
+        active = [str(p['_id']) for p in patients
+                  if p['admissionDate'] <= day.strftime('%Y-%m-%d')
+                  and (not p['dischargeDate'] or p['dischargeDate'] > day.strftime('%Y-%m-%d'))]
+        if not active:
+            continue
+        for slot in rng.sample(TIME_SLOTS, 2):
+            yield {
+                'psychologist_id': str(psych_id), 'date': day, 'time_slot': slot,
+                'patient_ids': rng.sample(active, min(len(active), rng.randint(1, 4))),
+                'title': 'Group session', 'note': 'Attended' if rng.random() < 0.7 else '',
+                'created_at': day,
+            }
+
+
+def seed(db, patients=300, years=3, employees=25, photo_kb=60, seed_value=42, end=None):
+    """Fill db with the benchmark dataset and return a summary of document counts."""
+    rng = random.Random(seed_value)
+    end = (end or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+    start = end.replace(year=end.year - years)
+
+    users = seed_users(db)
+    patient_docs = make_patients(rng, patients, start, end, photo_kb)
+    insert_batched(db.patients, patient_docs)
+    insert_batched(db.canteen_sales, iter_canteen_sales(rng, patient_docs, end))
+    insert_batched(db.expenses, iter_expenses(rng, start, end))
+    insert_batched(db.overheads, iter_overheads(rng, start, end))
+
+    employee_docs = [{
+        '_id': ObjectId(), 'name': f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+        'designation': rng.choice(DESIGNATIONS), 'pay': money(rng.choice([20000, 25000, 35000])),
+        'advance': '', 'duty_timings': '8am-8pm', 'date_of_joining': start.strftime('%Y-%m-%d'),
+        'cnic': '', 'phone': '', 'created_at': start, 'updated_at': start,
+    } for _ in range(employees)]
+    insert_batched(db.employees, employee_docs)
+    insert_batched(db.attendance, iter_attendance(rng, [e['_id'] for e in employee_docs], start, end))
+    insert_batched(db.psych_sessions, iter_psych_sessions(rng, users['bench_psych'], patient_docs, start, end))
+
+    insert_batched(db.utility_bills, ({
+        'type': rng.choice(['Electricity', 'Gas', 'Water', 'Internet']), 'provider': 'LESCO',
+        'amount': rng.randint(5000, 90000), 'due_date': (end + timedelta(days=i)).strftime('%Y-%m-%d'),
+        'ref_no': str(rng.randint(10 ** 9, 10 ** 10)), 'created_at': end, 'updated_at': end,
+    } for i in range(12)))
+    insert_batched(db.call_meeting_tracker, ({
+        'name': p['name'], 'day': rng.randint(1, 28), 'month': end.month, 'year': end.year,
+        'type': t, 'status': t, 'date_of_admission': p['admissionDate'],
+        'recorded_by': 'bench_admin', 'created_at': end,
+    } for p in patient_docs if not p['isDischarged'] for t in [rng.choice(['Call', 'Meeting'])]))
+
+    db.bench_meta.replace_one({'_id': 'dataset'}, {
+        '_id': 'dataset', 'patients': patients, 'years': years, 'employees': employees,
+        'photo_kb': photo_kb, 'seed': seed_value, 'end': end,
+    }, upsert=True)
+
+    names = ['users', 'patients', 'canteen_sales', 'expenses', 'overheads', 'employees',
+             'attendance', 'psych_sessions', 'utility_bills', 'call_meeting_tracker']
+    return {name: db[name].count_documents({}) for name in names}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--uri', default='mongodb://localhost:27017/pro_bench')
+    parser.add_argument('--patients', type=int, default=300)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--employees', type=int, default=25)
+    parser.add_argument('--photo-kb', type=int, default=60, help='Approximate size of each patient photo')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--end', help='Last day of data (YYYY-MM-DD), defaults to today')
+    parser.add_argument('--drop', action='store_true', help='Drop the database first')
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+    db = client.get_default_database()
+    if 'bench' not in db.name:
+        parser.error(f"Refusing to seed '{db.name}': use a database whose name contains 'bench'")
+    if args.drop:
+        client.drop_database(db.name)
+
+    end = datetime.strptime(args.end, '%Y-%m-%d') if args.end else None
+    counts = seed(db, args.patients, args.years, args.employees, args.photo_kb, args.seed, end)
+    for name, count in counts.items():
+        print(f"{name:22} {count:>9,}")
+
+
+if __name__ == '__main__':
+    main()
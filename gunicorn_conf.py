@@ -0,0 +1,43 @@
+"""
+Gunicorn settings for preload mode:
+
+    gunicorn -c gunicorn_conf.py app:app
+
+app.py and its heavy dependencies (openpyxl, pyarrow, the discharge bill
+template) are loaded once in the master and shared copy-on-write by every
+worker. The Mongo client, initial-admin/index setup and the email worker are
+created after fork in post_fork, since none of them are fork-safe.
+"""
+import multiprocessing
+import os
+
+# Must be set before gunicorn imports app.py in the master
+os.environ.setdefault("PRO_DEFER_WORKER_INIT", "1")
+# gthread workers can hold a few SSE streams without starving other requests
+os.environ.setdefault("LIVE_EVENTS", "1")
+# Long-lived workers can run the nightly jobs (a lock keeps each to one worker)
+os.environ.setdefault("SCHEDULER_ENABLED", "1")
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# Threads keep SSE streams and export downloads from tying up a whole worker
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+preload_app = True
+
+
+def when_ready(server):
+    """Warm DB-free state in the master so workers inherit it."""
+    try:
+        import openpyxl  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+        from app import get_discharge_bill_template
+        get_discharge_bill_template()
+    except ImportError as ie:
+        server.log.warning(f"Preload skipped missing '{ie.name}' library")
+
+
+def post_fork(server, worker):
+    from app import init_worker
+    # Admin/index setup only needs to run once; the first worker does it
+    init_worker(run_setup=worker.age == 1)